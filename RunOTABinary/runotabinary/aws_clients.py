@@ -0,0 +1,178 @@
+# Process wide registry of the AWS session and clients. Clients are created lazily on
+# first use and shared by every task of the process, so parallel canaries pay TLS setup
+# and credential resolution once. Clients are thread-safe, resources are not and are
+# therefore kept per thread. Client calls, including those made by the resources, go
+# through the throttle layer, which owns the retries, and are traced. The managed
+# transfers of S3 make their requests from their own threads, their client keeps the
+# retries of botocore.
+import threading
+from runotabinary import throttle, tracing
+from runotabinary.logger import logger
+
+DEFAULT_CONFIG = {
+    'region_name': None,
+    'max_pool_connections': 32,
+    'max_attempts': 5,
+    'retry_mode': 'standard',
+}
+
+_lock = threading.RLock()
+_config = dict(DEFAULT_CONFIG)
+_session = None
+_clients = {}
+_transfer_clients = {}
+_registered = {}
+_generation = 0
+_local = threading.local()
+_once_results = {}
+_once_locks = {}
+
+
+def configure(**kwargs):
+    """
+    Set the session and client settings, see DEFAULT_CONFIG for the accepted keys.
+    Clients already created are dropped only if a setting actually changes.
+    """
+    global _session, _generation
+    unknown = set(kwargs) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError(f'Unknown AWS client settings: {sorted(unknown)}')
+    with _lock:
+        config = dict(_config, **kwargs)
+        if config == _config:
+            return
+        _config.update(config)
+        _session = None
+        _clients.clear()
+        _transfer_clients.clear()
+        _generation += 1
+        logger.debug(f'AWS clients configured with {_config}')
+
+
+def configure_from_project(project):
+    configure(
+        max_pool_connections=project.aws_max_pool_connections,
+        max_attempts=project.aws_max_attempts,
+        retry_mode=project.aws_retry_mode,
+    )
+    throttle.configure_from_project(project)
+    if project.local_cloud_dir:
+        # Also points the endpoint fields of project at the local cloud, see LocalCloud.project_settings()
+        from runotabinary import local_cloud
+        local_cloud.install_from_project(project)
+
+
+def _botocore_config(retries=True):
+    """
+    :param retries: False for the clients whose calls are retried by the throttle layer
+    """
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=_config['max_pool_connections'],
+        retries={'max_attempts': _config['max_attempts'], 'mode': _config['retry_mode']} if retries else
+                {'total_max_attempts': 1, 'mode': _config['retry_mode']},
+    )
+
+
+def _wrap(service, client):
+    return throttle.throttled_client(service, tracing.traced_client(service, client))
+
+
+def get_session():
+    """
+    The boto3 session shared by the process.
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            import boto3
+            _session = boto3.session.Session(region_name=_config['region_name'])
+        return _session
+
+
+def get_client(service):
+    """
+    The shared client of an AWS service, created on first use. Every call made
+    through it is rate limited, retried and traced, see throttle.py.
+    """
+    client = _registered.get(service) or _clients.get(service)
+    if client is not None:
+        return client
+    with _lock:
+        if service not in _clients:
+            _clients[service] = _wrap(service, get_session().client(service, config=_botocore_config(retries=False)))
+        return _clients[service]
+
+
+def get_transfer_client(service):
+    """
+    The shared client of the managed transfers of an AWS service, e.g. upload_file of S3.
+    A transfer is a single call of the throttle layer while the parts are requested by
+    s3transfer on the client itself, so this client retries them with botocore.
+    """
+    client = _registered.get(service) or _transfer_clients.get(service)
+    if client is not None:
+        return client
+    with _lock:
+        if service not in _transfer_clients:
+            _transfer_clients[service] = _wrap(service, get_session().client(service, config=_botocore_config()))
+        return _transfer_clients[service]
+
+
+def get_resource(service):
+    """
+    The resource of an AWS service for the calling thread, created on first use. Its
+    calls are made through the shared client, see get_client().
+    """
+    if getattr(_local, 'generation', None) != _generation:
+        _local.generation = _generation
+        _local.resources = {}
+    resources = _local.resources
+    if service not in resources:
+        with _lock:
+            resource = get_session().resource(service, config=_botocore_config(retries=False))
+            # Sub-resources and actions take the client of their parent
+            resource.meta.client = get_client(service)
+            resources[service] = resource
+    return resources[service]
+
+
+def register_client(service, client):
+    """
+    Use client for service from now on, e.g. a stub in tests. Registered clients
+    are kept when the settings change, reset() drops them.
+    """
+    with _lock:
+        _registered[service] = _wrap(service, client)
+
+
+def once(key, fn):
+    """
+    Call fn the first time key is seen and cache its result for the life of the process.
+    Concurrent callers of the same key wait for the first one. Failures are not cached.
+    """
+    if key in _once_results:
+        return _once_results[key]
+    with _lock:
+        key_lock = _once_locks.setdefault(key, threading.Lock())
+    with key_lock:
+        if key not in _once_results:
+            _once_results[key] = fn()
+        return _once_results[key]
+
+
+def reset():
+    """
+    Forget the session, the clients and the cached checks.
+    """
+    global _session, _generation
+    with _lock:
+        _config.clear()
+        _config.update(DEFAULT_CONFIG)
+        _session = None
+        _clients.clear()
+        _transfer_clients.clear()
+        _registered.clear()
+        _generation += 1
+        _once_results.clear()
+        _once_locks.clear()
@@ -1,23 +1,69 @@
 import traceback
 import subprocess
 import os
-import re
-import sys
-import fileinput
-import boto3
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import PIPE, STDOUT
+from runotabinary import aws_clients, tracing
+from runotabinary.cert_cache import shared_cache
 from runotabinary.configs.config_project import OtaProject
 from runotabinary.logger import logger
+from runotabinary.patcher import SourcePatcher, write_if_changed
+from runotabinary.version_stamp import PLACEHOLDER_VERSION, VersionStamper
 from pathlib import Path
 from enum import Enum
 from datetime import datetime
 
 STATUS = Enum("STATUS", "PASS FAIL ERROR TIMEOUT")
 
+SIGNER_CERTIFICATE_TAG = 'static const char signingcredentialSIGNING_CERTIFICATE_PEM[] = '
+
+# Directory inside the build dir holding one copy of every artifact, keyed by build fingerprint
+ARTIFACT_CACHE_DIR = 'runota_artifacts'
+# Directory inside the build dir holding one build dir per variant slot, see build_variants
+VARIANT_BUILD_DIR = 'runota_variants'
+# Directory inside the build dir holding the images stamped with a version, see stamp_variants
+STAMPED_DIR = 'runota_stamped'
+
+# Directories of the repository which are not build inputs, hidden directories are skipped too
+FINGERPRINT_EXCLUDED_DIRS = ('build',)
+# Files written next to the sources by the builds themselves
+FINGERPRINT_EXCLUDED_SUFFIXES = ('_build_log.txt',)
+
+# Compiler caches used as compiler launcher, in order of preference
+COMPILER_CACHES = ('ccache', 'sccache')
+
+# Macros of demo_config.h which a variant overrides
+VARIANT_MACROS = ('#define APP_VERSION_MAJOR', '#define APP_VERSION_MINOR', '#define APP_VERSION_BUILD', '#define AWS_IOT_ENDPOINT',
+                  '#define CLIENT_IDENTIFIER', '#define CLIENT_CERT_PATH', '#define CLIENT_PRIVATE_KEY_PATH')
+
+
+@dataclass(frozen=True)
+class BuildVariant:
+    """
+    One image to build. Fields left to None take the value of the project: the target
+    follows the protocol, e.g. ota_demo_core_http for "HTTP". The identity of the thing
+    is compiled in the image, a fleet builds one variant per device.
+    """
+
+    target: str = None
+    version: str = None # "major.minor.build"
+    protocol: str = None
+    endpoint: str = None
+    thing_name: str = None
+    client_cert_path: str = None
+    client_private_key_path: str = None
+
+
 class BuildBinary:
     def __init__(self, ota_project):
         self.project = ota_project
         #TODO self.project.check_setup()
+        aws_clients.configure_from_project(self.project)
 
         self.ota_targets = [
             'ota_demo_core_mqtt',
@@ -36,78 +82,394 @@ class BuildBinary:
         self.OTA_CODESIGNER_CERTIFICATE_PATH = Path(f'platform/posix/ota_pal/source/ota_pal_posix.c')
         self.OTA_DEMO_PATH = Path(f'demos/ota/OTA_TARGET/OTA_TARGET.c')
         self.OTA_PAL_PATH = Path('platform/posix/ota_pal/source/ota_pal_posix.c')
+        self._toolchain_fingerprint = None
+        # path -> ((size, mtime), sha256) of the files of the source tree, see source_tree_digest
+        self._file_digests = {}
+        self._tree_lock = threading.Lock()
 
+        # Source edits are applied through the patcher which only rewrites files whose
+        # content changes, changed_files lists the files changed since the last build.
+        self.patcher = SourcePatcher()
+        self._batch_patches = False
+        self.changed_files = set()
+        self.latest_build_firmware_path = None
+        self.application_version = None
+        self._stamper = None
+        self.certificate_cache = shared_cache(self.project.certificate_cache_dir, self.project.certificate_cache_ttl_sec)
 
-        self.set_identifier_in_file(
-            {
-                '#define AWS_IOT_ENDPOINT': '\"' + self.project.aws_iot_endpoint + '\"',
-                '#define CLIENT_CERT_PATH': '\"' + self.project.client_cert_path + '\"',
-                '#define CLIENT_PRIVATE_KEY_PATH': '\"' + self.project.client_private_key_path + '\"',
-                '#define CLIENT_IDENTIFIER': '\"' + self.project.thing_name + '\"'
-            },
-            os.path.join(self.project.repository_root, self.DEMO_CONFIG_PATH)
-        )
+        with self.batch_patches():
+            self.set_identifier_in_file(
+                {
+                    '#define AWS_IOT_ENDPOINT': '\"' + self.project.aws_iot_endpoint + '\"',
+                    '#define CLIENT_CERT_PATH': '\"' + self.project.client_cert_path + '\"',
+                    '#define CLIENT_PRIVATE_KEY_PATH': '\"' + self.project.client_private_key_path + '\"',
+                    '#define CLIENT_IDENTIFIER': '\"' + self.project.thing_name + '\"'
+                },
+                os.path.join(self.project.repository_root, self.DEMO_CONFIG_PATH)
+            )
+
+            self.set_codesigner_certificate(self.get_code_signer_certificate_from_arn())
+
+    @contextmanager
+    def batch_patches(self):
+        """
+        Defer the source edits made inside the block and apply them together on exit,
+        so that every file is read and written at most once.
+        """
+        if self._batch_patches:
+            yield
+            return
+        self._batch_patches = True
+        try:
+            yield
+        finally:
+            self._batch_patches = False
+        self.apply_patches()
+
+    def apply_patches(self):
+        """
+        Apply the queued source edits unless they are being batched.
+        :return: List of the files whose content changed
+        """
+        if self._batch_patches:
+            return []
+        with tracing.span('build.patch') as patch_span:
+            changed = self.patcher.apply()
+            patch_span.set(changed_files=len(changed))
+        self.changed_files.update(changed)
+        return changed
 
-        self.set_codesigner_certificate(self.get_code_signer_certificate_from_arn())
-    
     def set_identifier_in_file(self, prefixToValue, filePath):
         """
         CSDK has multiple targets to be built for tests. They have different source
         files.  This call will change source files for all targets.
+        :return: List of the files whose content changed
         """
         for target in self.ota_targets:
             target_path = Path(str(filePath).replace('OTA_TARGET', target))
             logger.debug(target_path)
-            macros = "|".join(prefixToValue.keys())
-            is_comment = False
-            buffer = []
-            ignore_list = []
-            macros_regex = re.compile(macros)
-            # for line in host_tools_afr._process_file(path):
-            for line in fileinput.input(files=target_path, inplace=True):
-                if "/*" in line:
-                    is_comment = True
-                if "*/" in line:
-                    is_comment = False
-                match = macros_regex.search(line)
-                if match:
-                    matched_macro = match.group()
-                    if prefixToValue[matched_macro] is not None:
-                        prefixToValue_line = '{} {}\n'.format(matched_macro, prefixToValue[matched_macro])
-                        if matched_macro in ignore_list:
-                            line = "____ignore_this__line_"
-                        else:
-                            ignore_list.append(matched_macro)
-                            if is_comment:
-                                buffer.append(prefixToValue_line)
-                            else:
-                                line = prefixToValue_line
-                if line != "____ignore_this__line_":
-                    sys.stdout.write(line)
-                if not is_comment and buffer:
-                    sys.stdout.write("".join(buffer))
-                    buffer = []
+            self.patcher.set_macros(target_path, prefixToValue)
+        return self.apply_patches()
+
+    def target_file(self, path, target=None):
+        """
+        Path of a source file of the target inside the repository.
+        """
+        target = target or self.ota_firmware_path_used_in_job
+        return Path(str(os.path.join(self.project.repository_root, path)).replace('OTA_TARGET', target))
+
+    def toolchain_fingerprint(self, generator):
+        """
+        Identify the toolchain used for the build: cmake version, generator and compilers.
+        """
+        if self._toolchain_fingerprint is None:
+            version = subprocess.run(['cmake', '--version'], stdout=PIPE, stderr=STDOUT, encoding="utf-8").stdout
+            compilers = [os.environ.get(name, '') for name in ('CC', 'CXX', 'CFLAGS', 'CMAKE_TOOLCHAIN_FILE')]
+            self._toolchain_fingerprint = '|'.join([version.splitlines()[0] if version else ''] + compilers)
+        return f'{self._toolchain_fingerprint}|{generator}'
+
+    def source_tree_digest(self):
+        """
+        Hash of the path and content of every file of the repository, but those of the
+        build dir and of the hidden dirs such as .git. A file is only read again when its
+        size or modification time changed since the last call.
+        """
+        root = Path(self.project.repository_root)
+        digest = hashlib.sha256()
+        with self._tree_lock:
+            for directory, dirs, files in os.walk(root):
+                top = Path(directory) == root
+                dirs[:] = sorted(name for name in dirs
+                                 if not name.startswith('.') and not (top and name in FINGERPRINT_EXCLUDED_DIRS))
+                for name in sorted(files):
+                    if name.endswith(FINGERPRINT_EXCLUDED_SUFFIXES):
+                        continue
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    key = (stat.st_size, stat.st_mtime_ns)
+                    cached = self._file_digests.get(path)
+                    if cached is None or cached[0] != key:
+                        file_hash = hashlib.sha256()
+                        with open(path, 'rb') as source:
+                            for chunk in iter(lambda: source.read(1024 * 1024), b''):
+                                file_hash.update(chunk)
+                        cached = self._file_digests[path] = (key, file_hash.digest())
+                    digest.update(os.path.relpath(path, root).encode())
+                    digest.update(cached[1])
+        return digest.hexdigest()
+
+    def build_fingerprint(self, generator, target=None, overlay=''):
+        """
+        Hash every input of the build: the whole source tree with its CMakeLists, the
+        patched demo and OTA configs and the PAL holding the signer certificate read
+        again in full, the target name, the toolchain and the config overlay of a variant.
+        """
+        target = target or self.ota_firmware_path_used_in_job
+        digest = hashlib.sha256()
+        digest.update(target.encode())
+        digest.update(self.toolchain_fingerprint(generator).encode())
+        digest.update(overlay.encode())
+        digest.update(self.source_tree_digest().encode())
+        for path in (self.DEMO_CONFIG_PATH, self.OTA_CONFIG_PATH, self.OTA_DEMO_PATH, self.OTA_CODESIGNER_CERTIFICATE_PATH):
+            source = self.target_file(path, target)
+            digest.update(str(path).encode())
+            digest.update(source.read_bytes() if source.exists() else b'')
+        return digest.hexdigest()[:16]
+
+    def use_artifact(self, cached_artifact):
+        """
+        Mark an artifact of the cache as used, the least recently used are evicted first.
+        """
+        os.utime(cached_artifact.parent)
+        return str(cached_artifact)
+
+    def evict_artifacts(self, in_use=()):
+        """
+        Delete the least recently used artifacts of the cache beyond build_cache_max_artifacts.
+        :param in_use: Paths of the artifacts just handed out, never evicted
+        :return: List of the fingerprint dirs deleted
+        """
+        keep = self.project.build_cache_max_artifacts
+        cache_dir = Path(self.project.repository_root) / 'build' / ARTIFACT_CACHE_DIR
+        if not keep or not cache_dir.is_dir():
+            return []
+        entries = sorted(cache_dir.iterdir(), key=lambda path: path.stat().st_mtime, reverse=True)
+        pinned = {Path(path).parent for path in in_use if path}
+        evicted = [path for path in entries[keep:] if path not in pinned]
+        for path in evicted:
+            shutil.rmtree(path, ignore_errors=True)
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} artifacts from {cache_dir}")
+        return evicted
+
+    def compiler_launcher(self):
+        """
+        Compiler cache used to launch the compiler, None if disabled or none is installed.
+        """
+        if not self.project.compiler_cache:
+            return None
+        for name in COMPILER_CACHES:
+            path = shutil.which(name)
+            if path:
+                return path
+        return None
+
+    def configure_command(self, build_dir, generator, c_flags=None):
+        command = ['cmake', '-S', '.', '-B', str(build_dir), '-G', generator]
+        launcher = self.compiler_launcher()
+        if launcher:
+            command += [f'-DCMAKE_C_COMPILER_LAUNCHER={launcher}', f'-DCMAKE_CXX_COMPILER_LAUNCHER={launcher}']
+        if c_flags:
+            command.append(f'-DCMAKE_C_FLAGS={c_flags}')
+        return command
+
+    def cmake_generator(self, build_dir):
+        """
+        Generator of an existing build dir, otherwise Ninja if it is installed.
+        """
+        cache = build_dir / 'CMakeCache.txt'
+        if cache.exists():
+            for line in cache.read_text(errors='replace').splitlines():
+                if line.startswith('CMAKE_GENERATOR:INTERNAL='):
+                    return line.split('=', 1)[1]
+        return 'Ninja' if shutil.which('ninja') else 'Unix Makefiles'
 
     def build(self):
+        """
+        Build the target, reusing the artifact of an earlier build with the same fingerprint.
+        The configure step only runs when the build dir has no valid CMake cache, cmake
+        --build re-runs it by itself whenever a CMakeLists.txt changes.
+        """
+        with tracing.span('build', target=self.ota_firmware_path_used_in_job, version=self.application_version) as build_span:
+            status, path = self._build(build_span)
+            build_span.set(status=status.name)
+            return status, path
+
+    def _build(self, build_span):
         logger.info("Building image")
         try:
-            cmd = f'cmake -S . -B build && cmake --build build --target {self.ota_firmware_path_used_in_job}'
+            root = Path(self.project.repository_root)
+            build_dir = root / 'build'
+            generator = self.cmake_generator(build_dir)
+            fingerprint = self.build_fingerprint(generator)
+            build_span.set(fingerprint=fingerprint, generator=generator)
+            cached_artifact = build_dir / ARTIFACT_CACHE_DIR / fingerprint / self.ota_firmware_path_used_in_job
+            if cached_artifact.exists():
+                logger.info(f"Build inputs unchanged ({fingerprint}), reusing {cached_artifact}")
+                self.latest_build_firmware_path = self.use_artifact(cached_artifact)
+                self.changed_files.clear()
+                build_span.set(cached=True)
+                return STATUS.PASS, self.latest_build_firmware_path
+
+            commands = []
+            if not (build_dir / 'CMakeCache.txt').exists():
+                commands.append(self.configure_command('build', generator))
+            commands.append(['cmake', '--build', 'build', '--target', self.ota_firmware_path_used_in_job,
+                             '--parallel', str(os.cpu_count() or 1)])
+
             with open (f'{self.ota_firmware_path_used_in_job}_{datetime.now().strftime("%m%d%H%S")}_build_log.txt', 'w') as buildlog :
-                result = subprocess.run(
-                    cmd, stdout=buildlog, stderr=STDOUT, shell=True, encoding="utf-8", cwd=str(self.project.repository_root), check=True
-                )    
+                for cmd in commands:
+                    step = 'compile' if '--build' in cmd else 'configure'
+                    with tracing.span(f'build.{step}', command=' '.join(cmd)):
+                        result = subprocess.run(
+                            cmd, stdout=buildlog, stderr=STDOUT, encoding="utf-8", cwd=str(root), check=True
+                        )
 
-            file_path = f'{self.project.repository_root}/build/bin/'
-            self.latest_build_firmware_path = f"{file_path}{self.ota_firmware_path_used_in_job}"
+            built_artifact = build_dir / 'bin' / self.ota_firmware_path_used_in_job
+            cached_artifact.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(built_artifact, cached_artifact)
+            self.latest_build_firmware_path = self.use_artifact(cached_artifact)
+            self.changed_files.clear()
+            build_span.set(cached=False)
+            self.evict_artifacts([self.latest_build_firmware_path])
 
         except Exception as e:
             logger.error(f"Error occured: {e}")
             traceback.print_exc()
             return STATUS.ERROR, ''
 
-        logger.info("Build completed")
+        logger.info(f"Build completed ({fingerprint})")
         return STATUS.PASS, self.latest_build_firmware_path
 
+    def resolve_variant(self, variant):
+        """
+        Variant with every field set, the fields left to None being taken from the project.
+        """
+        protocol = variant.protocol or self.project.data_protocol
+        target = variant.target or (self.ota_targets[0] if "MQTT" in protocol else self.ota_targets[1])
+        if target not in self.ota_targets:
+            raise ValueError(f'Unknown target {target}, expected one of {self.ota_targets}')
+        version = variant.version or f'{self.project.version_major}.{self.project.version_minor}.{self.project.version_build}'
+        if len(str(version).split('.')) != 3:
+            raise ValueError(f'Version {version} is not major.minor.build')
+        return BuildVariant(target, str(version), protocol, variant.endpoint or self.project.aws_iot_endpoint,
+                            variant.thing_name or self.project.thing_name,
+                            variant.client_cert_path or self.project.client_cert_path,
+                            variant.client_private_key_path or self.project.client_private_key_path)
+
+    def variant_overlay(self, variant):
+        """
+        Content of the header overriding the demo config of the target for the variant.
+        """
+        major, minor, build = variant.version.split('.')
+        strings = (variant.endpoint, variant.thing_name, variant.client_cert_path, variant.client_private_key_path)
+        values = [major, minor, build] + ['\"' + value + '\"' for value in strings]
+        lines = [f'/* Generated by runota: {variant.target} {variant.version} over {variant.protocol} */\n']
+        lines += [f'{macro} {value}\n' for macro, value in zip(VARIANT_MACROS, values)]
+        return ''.join(lines)
+
+    def build_variants(self, variants, max_workers=None):
+        """
+        Build several variants concurrently, e.g. the versions of a canary or a protocol matrix.
+
+        The source tree is shared: its demo configs only get the overridden macros
+        guarded once. Every variant is built in its own build dir under
+        build/runota_variants, with a generated overlay header force-included ahead of
+        the demo config, so that building a variant never invalidates another one. The
+        build dirs are reused by the next call and artifacts are cached by fingerprint,
+        as by build().
+        :param variants: List of BuildVariant
+        :return: Map of every variant to its artifact path, '' for the variants which failed to build
+        """
+        variants = list(dict.fromkeys(variants))
+        if not variants:
+            return {}
+        # Variants resolving to the same configuration are built once, they would share a cached artifact
+        resolved_by_variant = {variant: self.resolve_variant(variant) for variant in variants}
+        resolved = list(dict.fromkeys(resolved_by_variant.values()))
+        with self.batch_patches():
+            for target in self.ota_targets:
+                self.patcher.guard_macros(self.target_file(self.DEMO_CONFIG_PATH, target), VARIANT_MACROS)
+
+        workers = max(1, min(len(resolved), max_workers or self.project.build_max_workers))
+        jobs = max(1, (os.cpu_count() or 1) // workers)
+        parent = tracing.current_span()
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='build-variant') as executor:
+            futures = [executor.submit(self._build_variant, slot, variant, jobs, parent) for slot, variant in enumerate(resolved)]
+            paths = dict(zip(resolved, [future.result() for future in futures]))
+        self.evict_artifacts(paths.values())
+        return {variant: paths[resolved_by_variant[variant]] for variant in variants}
+
+    def _build_variant(self, slot, variant, jobs, parent):
+        with tracing.span('build.variant', parent=parent, target=variant.target, version=variant.version,
+                          protocol=variant.protocol) as variant_span:
+            try:
+                root = Path(self.project.repository_root)
+                build_dir = root / 'build' / VARIANT_BUILD_DIR / str(slot)
+                build_dir.mkdir(parents=True, exist_ok=True)
+                overlay = self.variant_overlay(variant)
+                generator = self.cmake_generator(build_dir)
+                fingerprint = self.build_fingerprint(generator, variant.target, overlay)
+                variant_span.set(fingerprint=fingerprint, slot=slot)
+                cached_artifact = root / 'build' / ARTIFACT_CACHE_DIR / fingerprint / variant.target
+                if cached_artifact.exists():
+                    logger.info(f"Variant {variant} unchanged ({fingerprint}), reusing {cached_artifact}")
+                    variant_span.set(cached=True)
+                    return self.use_artifact(cached_artifact)
+
+                overlay_path = build_dir / 'runota_overlay.h'
+                write_if_changed(overlay_path, overlay)
+                commands = []
+                if not (build_dir / 'CMakeCache.txt').exists():
+                    commands.append(self.configure_command(build_dir, generator, f'-include {overlay_path}'))
+                commands.append(['cmake', '--build', str(build_dir), '--target', variant.target, '--parallel', str(jobs)])
+                with open(f'{variant.target}_{slot}_{datetime.now().strftime("%m%d%H%S")}_build_log.txt', 'w') as buildlog:
+                    for cmd in commands:
+                        step = 'compile' if '--build' in cmd else 'configure'
+                        with tracing.span(f'build.{step}', command=' '.join(cmd)):
+                            subprocess.run(cmd, stdout=buildlog, stderr=STDOUT, encoding="utf-8", cwd=str(root), check=True)
+
+                cached_artifact.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(build_dir / 'bin' / variant.target, cached_artifact)
+                variant_span.set(cached=False)
+                logger.info(f"Built variant {variant} ({fingerprint})")
+                return self.use_artifact(cached_artifact)
+            except Exception as e:
+                logger.error(f"Error occured building variant {variant}: {e}")
+                variant_span.set(status=STATUS.ERROR.name)
+                return ''
+
+    def version_stamper(self):
+        """
+        Stamper of the image built with the placeholder version. The template goes
+        through build(), so it is only compiled again when its fingerprint changed, and
+        the stamper is reused as long as the template is the same artifact.
+        """
+        with tracing.span('build.template', target=self.ota_firmware_path_used_in_job):
+            self.set_application_version(*PLACEHOLDER_VERSION)
+            status, path = self.build()
+            if status != STATUS.PASS:
+                raise RuntimeError('Build of the version template failed')
+            if self._stamper is None or self._stamper.template != Path(path):
+                self._stamper = VersionStamper(path)
+        return self._stamper
+
+    def stamp_variants(self, variants):
+        """
+        Produce the images of versions without compiling: the image built once with the
+        placeholder version is copied and its version constant patched, see version_stamp.
+        Only the version of the variants may differ from the project.
+        :param variants: List of BuildVariant
+        :return: Map of every variant to its image path
+        """
+        variants = list(dict.fromkeys(variants))
+        if not variants:
+            return {}
+        template = self.resolve_variant(BuildVariant())
+        stamper = self.version_stamper()
+        paths = {}
+        with tracing.span('build.stamp', versions=len(variants)):
+            for variant in variants:
+                resolved = self.resolve_variant(variant)
+                if (resolved.target, resolved.endpoint) != (template.target, template.endpoint):
+                    raise ValueError(f'Only the version can be stamped, {variant} needs a build')
+                output = Path(self.project.repository_root) / 'build' / STAMPED_DIR / resolved.version / resolved.target
+                paths[variant] = str(stamper.stamp([int(part) for part in resolved.version.split('.')], output))
+        return paths
+
     def set_application_version(self, major=None, minor=None, build=None):
         """Set aws_application_version.h with the input version.
 
@@ -123,7 +485,7 @@ class BuildBinary:
         if build == None:
             build = self.project.version_build
 
-        self.set_identifier_in_file(
+        changed = self.set_identifier_in_file(
             {
                 '#define APP_VERSION_MAJOR': major,
                 '#define APP_VERSION_MINOR': minor,
@@ -131,7 +493,9 @@ class BuildBinary:
             },
             os.path.join(self.project.repository_root, self.DEMO_CONFIG_PATH)
         )
+        self.application_version = f'{major}.{minor}.{build}'
         logger.debug(f'Setting version {major}.{minor}.{build} in {self.DEMO_CONFIG_PATH}')
+        return changed
 
     def increase_application_build_version(self):
         """Increase the build version and store it
@@ -141,26 +505,53 @@ class BuildBinary:
     
     def set_codesigner_certificate(self, certificate):
         """Set aws_ota_codesigner_certificate.h with the certificate specified.
+        The file is left alone when it already embeds the certificate.
         """
+        if self.get_embedded_codesigner_certificate() == certificate:
+            logger.debug(f'Code signer certificate already set in {self.OTA_CODESIGNER_CERTIFICATE_PATH}')
+            return []
         codeSignerCertificatePath = os.path.join(self.project.repository_root, self.OTA_CODESIGNER_CERTIFICATE_PATH)
-        signerCertificateTag = 'static const char signingcredentialSIGNING_CERTIFICATE_PEM[] = '
-        for line in fileinput.input(files=codeSignerCertificatePath, inplace=True):
-            if (signerCertificateTag in line):
-                line = '{} {}\n'.format(signerCertificateTag, '\"' + certificate.replace('\n', '\\n') + '\";')
-            sys.stdout.write(line)
-    
+        self.patcher.set_line(
+            codeSignerCertificatePath,
+            SIGNER_CERTIFICATE_TAG,
+            '{} {}\n'.format(SIGNER_CERTIFICATE_TAG, '\"' + certificate.replace('\n', '\\n') + '\";')
+        )
+        return self.apply_patches()
+
+    def get_embedded_codesigner_certificate(self):
+        """
+        Certificate currently embedded in the OTA PAL, None if it cannot be found.
+        """
+        codeSignerCertificatePath = Path(os.path.join(self.project.repository_root, self.OTA_CODESIGNER_CERTIFICATE_PATH))
+        if not codeSignerCertificatePath.exists():
+            return None
+        with open(codeSignerCertificatePath, 'r', encoding='utf-8') as source:
+            for line in source:
+                if SIGNER_CERTIFICATE_TAG in line:
+                    value = line.split(SIGNER_CERTIFICATE_TAG, 1)[1].strip()
+                    if value.startswith('"') and value.endswith('";'):
+                        return value[1:-2].replace('\\n', '\n')
+                    return None
+        return None
+
     def get_code_signer_certificate_from_arn(self, certArn=None):
         """
         Get the certificate stored in ACM identified by the input ARN.
         If we are running in the beta stage, the certificate ARN for the designated region
         should have been configured the board configuration JSON.
+        Certificates are cached on disk, ACM is only called once the cached one is stale.
         """
         if not certArn:
             certArn = self.project.ecdsa_signer_certificate_arn
 
-        certificate = ''
-        certificate = boto3.client('acm').get_certificate(CertificateArn=certArn)['Certificate']
-        return certificate
+        with tracing.span('build.certificate', certificate_arn=certArn):
+            return self.certificate_cache.get(certArn, self.fetch_code_signer_certificate)
+
+    def fetch_code_signer_certificate(self, certArn):
+        """
+        Get the certificate identified by the input ARN from ACM.
+        """
+        return aws_clients.get_client('acm').get_certificate(CertificateArn=certArn)['Certificate']
 
 def main():
     task = BuildBinary(OtaProject())
@@ -1,54 +1,371 @@
+import os
+import sys
+import time
+import argparse
 from os.path import basename
 from pathlib import Path
+from dataclasses import dataclass, field
+from runotabinary import throttle, tracing
+from runotabinary.checkpoint import CheckpointStore
+from runotabinary.run_history import RunHistory, RunRecorder, git_commit
 from runotabinary.configs.config_project import OtaProject
 from runotabinary.logger import logger
-from runotabinary.build_binary import BuildBinary, STATUS
+from runotabinary.build_binary import BuildBinary, BuildVariant, STATUS
 from runotabinary.run_binary import RunBinary
-from runotabinary.create_update import CreateUpdate
+from runotabinary.create_update import CreateUpdate, file_digest
+from runotabinary.fault_injection import FaultInjector, format_report as format_injections
+from runotabinary.jobs_mqtt import shared_observer
+from runotabinary.ota_log_parser import OtaLogParser
+from runotabinary.pipeline import Pipeline
 
 
+@dataclass
+class CanaryStep:
+    """
+    One version of the canary as it moves through the build, upload and rollout stages
+    """
+
+    version_build: int
+    update_counter: int
+    build_path: str = ''
+    build_sha256: str = None
+    file_name: str = ''
+    s3_object: tuple = None
+    ota_update_id: str = None
+    status: str = ''
+    summary: str = None
+    # Last stage completed, see checkpoint.STAGES
+    stage: str = ''
+    # Seconds spent in every stage which did work in this run, and end-to-end in 'update'
+    timings: dict = field(default_factory=dict)
+    # time.perf_counter() when its build started in this run
+    build_started: float = None
+
+    def restore(self, row):
+        """
+        Take the progress recorded in a checkpoint row. A failed rollout is redone, from the uploaded image.
+        """
+        self.update_counter = row['update_counter']
+        self.build_path = row['build_path'] or ''
+        self.build_sha256 = row['build_sha256']
+        self.file_name = row['file_name'] or ''
+        self.s3_object = (row['s3_key'], row['s3_version']) if row['s3_key'] else None
+        self.ota_update_id = row['ota_update_id']
+        self.status = row['job_status'] or ''
+        self.summary = row['summary']
+        self.stage = row['stage']
+        if self.stage == 'finished' and self.status != 'SUCCEEDED':
+            self.stage, self.ota_update_id, self.status = 'uploaded', None, ''
+
+    @property
+    def succeeded(self):
+        return self.stage == 'finished' and self.status == 'SUCCEEDED'
+
+    def artifact_intact(self):
+        return bool(self.build_path) and Path(self.build_path).exists() and file_digest(self.build_path) == self.build_sha256
+
+
+# OTA updates a resumed run reattaches to rather than creating them again
+REATTACHABLE_OTA_UPDATE_STATUSES = ('CREATE_PENDING', 'CREATE_IN_PROGRESS', 'CREATE_COMPLETE')
+
 
 class OtaCanary:
-    def __init__(self, ota_project):
+    def __init__(self, ota_project, checkpoint=None):
         self.project = ota_project
         self.update_counter = 1
-    
-    def start(self):
+        self.pipeline = None
+        self.checkpoint = checkpoint
+        self.run_id = None
+        # Whether the last run rolled out every version
+        self.completed = False
+
+    def start(self, iterations=None, lookahead=None, resume=False):
+        """
+        Build the initial image, start the device and roll out the next versions.
+
+        The versions go through a pipeline: while the device downloads update N, the
+        images of the next versions are built and uploaded, up to lookahead of them.
+        Update N+1 is only created once update N finished.
+
+        Every completed stage is recorded in the checkpoint store of the project. With
+        resume, the last run of the thing which did not complete is resumed: finished
+        versions are skipped, intact images are not built nor uploaded again and the
+        device reattaches to the update in flight. Otherwise a new run is started.
+
+        The stage durations, job outcomes, image sizes and device timings are recorded
+        in the run history of the project.
+
+        A stage which failed is raised again once the device is stopped and the run
+        is recorded.
+        :return: Steps which went through the rollout, None when the initial build failed
+        """
+        self.completed = False
+        tracing.configure_from_project(self.project)
+        if self.checkpoint is None and self.project.canary_checkpoint_path:
+            self.checkpoint = CheckpointStore(self.project.canary_checkpoint_path)
+        try:
+            with tracing.span('canary', thing=self.project.thing_name) as canary_span:
+                return self._start(canary_span, iterations, lookahead, resume)
+        finally:
+            tracing.flush()
+
+    def _plan(self, iterations, resume):
+        """
+        Steps of the run, restored from the checkpoint store when the run is resumed.
+        :return: (steps, run recorded in the checkpoint store or None)
+        """
+        run = None
+        if self.checkpoint is not None:
+            run, resumed = self.checkpoint.open_run(self.project.thing_name, self.project.version_build, iterations, resume)
+            self.run_id = run['run_id']
+            if resumed:
+                started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['created_at']))
+                logger.warning(f"Resuming canary run {self.run_id} of {self.project.thing_name} started {started}: "
+                               f"{run['iterations']} versions after {run['base_version_build']}, from {self.checkpoint.path}")
+                self.project.version_build = run['base_version_build']
+                iterations = run['iterations']
+
+        steps = []
+        for counter in range(iterations):
+            self.update_counter += 1
+            steps.append(CanaryStep(self.project.version_build + counter + 1, self.update_counter))
+        if run is None:
+            return steps, None
+
+        rows = self.checkpoint.steps(self.run_id)
+        for step in steps:
+            if step.version_build in rows:
+                step.restore(rows[step.version_build])
+        self.update_counter = max([self.update_counter] + [step.update_counter for step in steps])
+        done = [step for step in steps if step.succeeded]
+        if done:
+            self.project.version_build = done[-1].version_build
+            logger.info(f'Versions {[step.version_build for step in done]} already rolled out by run {self.run_id}')
+        return [step for step in steps if not step.succeeded], run
+
+    def _record(self, step, stage, **fields):
+        step.stage = stage
+        if self.checkpoint is not None:
+            self.checkpoint.record(self.run_id, step.version_build, step.update_counter, stage, **fields)
+
+    def _start(self, canary_span, iterations, lookahead, resume=False):
+        if iterations is None:
+            iterations = self.project.canary_iterations
+        if lookahead is None:
+            lookahead = self.project.canary_lookahead
+
+        steps, run = self._plan(iterations, resume)
+        if run is not None and not steps:
+            logger.info(f'Canary run {self.run_id} already completed every version')
+            self.checkpoint.set_run(self.run_id, status='completed')
+            self.completed = True
+            return []
+
+        # A resumed run restarts the device on the image it ran last
+        device_image = None
+        if run is not None:
+            for image, digest in ((run['device_image'], None), (run['initial_image'], run['initial_sha256'])):
+                if image and Path(image).exists() and (digest is None or file_digest(image) == digest):
+                    device_image = image
+                    break
+
         build_task = BuildBinary(self.project)
-        build_task.set_application_version()
-        status, build_path = build_task.build()
+        images = {}
+        if self.project.canary_version_stamping:
+            # One build, then every version is a patched copy of the image
+            try:
+                images = build_task.stamp_variants([self._variant(self.project.version_build)] +
+                                                   [self._variant(step.version_build) for step in steps])
+                build_path = images[self._variant(self.project.version_build)]
+                status = STATUS.PASS
+            except (RuntimeError, ValueError) as e:
+                logger.error(f'Unable to stamp the versions: {e}')
+                build_path, status = '', STATUS.ERROR
+        elif self.project.canary_parallel_builds:
+            # The initial image and every version are built at once, each in its own build dir
+            images = build_task.build_variants([self._variant(self.project.version_build)] +
+                                               [self._variant(step.version_build) for step in steps])
+            build_path = images[self._variant(self.project.version_build)]
+            status = STATUS.PASS if build_path else STATUS.ERROR
+        elif device_image:
+            build_path, status = device_image, STATUS.PASS
+        else:
+            build_task.set_application_version()
+            status, build_path = build_task.build()
         print(build_path)
 
         if status != STATUS.PASS:
             return
-        
-        run_task = RunBinary(build_path)
+        if run is not None and not device_image:
+            self.checkpoint.set_run(self.run_id, initial_image=build_path, initial_sha256=file_digest(build_path))
+        build_path = device_image or build_path
+
+        recorder = None
+        if self.project.run_history_path:
+            recorder = RunRecorder(RunHistory(self.project.run_history_path), 'canary', thing_name=self.project.thing_name,
+                                   tool_commit=git_commit(), repository_commit=git_commit(self.project.repository_root),
+                                   settings={'iterations': len(steps), 'lookahead': lookahead,
+                                             'parallel_builds': self.project.canary_parallel_builds,
+                                             'version_stamping': self.project.canary_version_stamping})
+
+        run_task = RunBinary(build_path, index_log=self.project.device_log_index)
+        device_metrics = OtaLogParser(trace_attributes={'thing': self.project.thing_name})
+        run_task.add_line_consumer(device_metrics.feed)
+        faults = None
+        if self.project.fault_plan:
+            faults = FaultInjector.from_project(self.project).start()
+            run_task.add_line_consumer(faults.feed)
+            if self.project.jobs_observer:
+                shared_observer(self.project).add_listener(faults.on_job_status)
         run_task.start()
 
-        update_task = CreateUpdate()
+        update_task = CreateUpdate(ota_project=self.project)
 
-        for counter in range(3):
-            build_task.increase_application_build_version()
-            status, build_path = build_task.build()
-            if status != STATUS.PASS:
-                return
-            
+        def reattachable(step):
+            return step.stage == 'created' and bool(step.ota_update_id) and \
+                update_task.get_ota_update_status(step.ota_update_id) in REATTACHABLE_OTA_UPDATE_STATUSES
 
-            self.update_counter += 1
-            fileToUpload = f'{basename(build_path)}_{self.update_counter}'
-            update_task.setParams(fileToUpload,build_path)
-            update_task.clear_pending_jobs()
-            ota_update_id = update_task.create_ota_update()
-            update_status, summary = update_task.get_ota_update_result(ota_update_id, 600)
+        def build_stage(step):
+            if step.stage in ('built', 'uploaded', 'created') and step.artifact_intact():
+                logger.info(f'Version {step.version_build} already built as {step.build_path}')
+                return step
+            if reattachable(step):
+                logger.info(f'Version {step.version_build} is rolled out by OTA update {step.ota_update_id}, '
+                            f'its image {step.build_path} is not needed')
+                return step
+            step.stage = ''
+            start = step.build_started = time.perf_counter()
+            if images:
+                step.build_path = images[self._variant(step.version_build)]
+                if not step.build_path:
+                    raise RuntimeError(f'Build of version {step.version_build} failed')
+            else:
+                with tracing.span('canary.build', parent=canary_span, version_build=step.version_build):
+                    build_task.set_application_version(build=step.version_build)
+                    status, step.build_path = build_task.build()
+                if status != STATUS.PASS:
+                    raise RuntimeError(f'Build of version {step.version_build} failed')
+            step.timings['build'] = time.perf_counter() - start
+            step.file_name = f'{basename(step.build_path)}_{step.update_counter}'
+            step.build_sha256 = file_digest(step.build_path)
+            self._record(step, 'built', build_path=step.build_path, build_sha256=step.build_sha256, file_name=step.file_name)
+            return step
+
+        def upload_stage(step):
+            if step.stage in ('uploaded', 'created') and step.s3_object:
+                logger.info(f'Version {step.version_build} already uploaded as {step.s3_object[0]}')
+                return step
+            start = time.perf_counter()
+            with tracing.span('canary.upload', parent=canary_span, version_build=step.version_build):
+                step.s3_object = update_task.upload_firmware_to_s3_bucket(step.build_path, step.file_name)
+            step.timings['upload'] = time.perf_counter() - start
+            self._record(step, 'uploaded', s3_key=step.s3_object[0], s3_version=step.s3_object[1])
+            return step
+
+        # End of the last rollout, from which the device can take the next update
+        last_rollout = {'finished': None}
+
+        def rollout_stage(step):
+            with tracing.span('canary.rollout', parent=canary_span, version_build=step.version_build) as rollout_span:
+                update_task.setParams(step.file_name, step.build_path)
+                reattach = reattachable(step)
+                if reattach:
+                    # The job of the update in flight is left alone, the device picks it up again
+                    logger.info(f'Reattaching to OTA update {step.ota_update_id} of version {step.version_build}')
+                else:
+                    update_task.clear_pending_jobs()
+                    created_at = device_metrics.clock()
+                    step.ota_update_id = update_task.create_ota_update(s3Object=step.s3_object)
+                    step.timings['create'] = device_metrics.clock() - created_at
+                    device_metrics.mark_update_created(created_at)
+                    self._record(step, 'created', ota_update_id=step.ota_update_id)
+                if faults is not None:
+                    # The time triggers count from the creation of the update, or from the reattachment
+                    faults.start_update(file_size=os.path.getsize(step.build_path) if os.path.exists(step.build_path) else None)
+                start = time.perf_counter()
+                update_status, step.summary = update_task.get_ota_update_result(step.ota_update_id, self.project.ota_timeout_sec)
+                finished = time.perf_counter()
+                step.timings['rollout'] = finished - start
+                if step.build_started is not None:
+                    # End-to-end as timed by the benchmark: from the end of the previous rollout, or
+                    # from the build when it was not done ahead, until the job finished
+                    step.timings['update'] = finished - max(step.build_started, last_rollout['finished'] or 0)
+                last_rollout['finished'] = finished
+                step.status = update_status.status
+                rollout_span.set(ota_update_id=step.ota_update_id, status=step.status, reattached=bool(reattach))
+            self._record(step, 'finished', job_status=step.status, summary=step.summary and str(step.summary))
+            if recorder is not None:
+                self._record_history(recorder, step)
             print(update_status)
-            if update_status.status != "SUCCEEDED":
-                break
+            logger.info(f'Device metrics: {device_metrics.snapshot()}')
+            if step.status != "SUCCEEDED":
+                self.pipeline.stop()
+            else:
+                self.project.version_build = step.version_build
+                if self.checkpoint is not None:
+                    self.checkpoint.set_run(self.run_id, device_image=step.build_path)
+            return step
+
+        self.pipeline = Pipeline(
+            [('build', build_stage), ('upload', upload_stage), ('rollout', rollout_stage)],
+            lookahead=lookahead
+        )
+        results = self.pipeline.run(steps)
+        self.completed = self.pipeline.error is None and len(results) == len(steps) and \
+            all(step.status == 'SUCCEEDED' for step in results)
+        if self.checkpoint is not None:
+            self.checkpoint.set_run(self.run_id, status='completed' if self.completed else 'failed')
+
         run_task.close()
+        update_task.close()
+        if faults is not None:
+            faults.stop()
+            logger.info(f'Interrupts of the run:\n{format_injections(faults.injections)}')
+        if recorder is not None:
+            recorder.device(device_metrics, run_task.restarts)
+            if faults is not None:
+                recorder.samples('interrupt_send_ms', [injection.send_ms for injection in faults.injections])
+                recorder.samples('interrupt_ack_ms', [injection.ack_ms for injection in faults.injections])
+            recorder.finish()
+            recorder.history.close()
+        for stage in self.pipeline.report():
+            logger.info(f'Canary stage {stage}')
+        logger.info(f'Device metrics of the run:\n{device_metrics.format_summary()}')
+        logger.info(f'AWS calls of the run:\n{throttle.format_counters()}')
+        if self.pipeline.error is not None:
+            raise self.pipeline.error
+        return results
+
+    @staticmethod
+    def _record_history(recorder, step):
+        """
+        Record the stage durations, the outcome and the image size of a step which finished.
+        A resumed step only has the durations of the stages it did in this run, its
+        update time is not recorded when it was built in an earlier run.
+        """
+        image_bytes = os.path.getsize(step.build_path) if step.build_path and os.path.exists(step.build_path) else None
+        recorder.update(step.version_build, step.ota_update_id, step.status, image_bytes)
+        for stage, seconds in step.timings.items():
+            recorder.sample(stage, seconds, step.version_build)
+        if image_bytes is not None:
+            recorder.sample('image_bytes', image_bytes, step.version_build)
+
+    def _variant(self, version_build):
+        return BuildVariant(version=f'{self.project.version_major}.{self.project.version_minor}.{version_build}')
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Roll out new versions to the device')
+    parser.add_argument('--resume', action='store_true', help='Resume the last run of the thing if it did not complete')
+    args = parser.parse_args()
     task = OtaCanary(OtaProject())
-    task.start()
+    try:
+        task.start(resume=args.resume)
+    except Exception as e:
+        logger.error(f'Canary run failed: {e}')
+        return 1
+    return 0 if task.completed else 1
+
 
-if __name__ == 'main':
-    main()
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+import os
+import gzip
+import queue
+import codecs
+import shutil
+from pathlib import Path
+from threading import Thread
+from runotabinary.logger import logger
+
+READ_CHUNK_SIZE = 64 * 1024
+WRITE_BUFFER_SIZE = 1024 * 1024
+# Chunks waiting for the writer, at most READ_CHUNK_SIZE each. Once full the reader
+# blocks, and so does the device on its output, rather than memory growing without bound
+QUEUE_MAX_CHUNKS = 1024
+
+
+class LineDecoder:
+    """
+    Turn raw output chunks into text lines for the consumers which need text.
+    Undecodable bytes are replaced instead of dropping the whole line.
+    """
+
+    def __init__(self):
+        self.consumers = []
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._pending = ''
+
+    def feed(self, data):
+        if not self.consumers:
+            return
+        text = self._pending + self._decoder.decode(data)
+        lines = text.split('\n')
+        self._pending = lines.pop()
+        for line in lines:
+            self._dispatch(line + '\n')
+
+    def finish(self):
+        if not self.consumers:
+            return
+        text = self._pending + self._decoder.decode(b'', final=True)
+        self._pending = ''
+        if text:
+            self._dispatch(text)
+
+    def _dispatch(self, line):
+        for consumer in self.consumers:
+            try:
+                consumer(line)
+            except Exception as e:
+                logger.error(f"Output consumer {consumer} failed: {e}")
+
+
+class LogWriter:
+    """
+    Write raw device output to a log file from a background thread.
+
+    The writer keeps a large write buffer, flushes whenever it has caught up with the
+    reader, and rotates the file once it reaches max_bytes, keeping backup_count rotated
+    files which are gzip compressed if compress is set. Text consumers are fed from the
+    same thread so that they never slow down the reader either, ahead of the file I/O so
+    that the time they see a line at is not delayed by a write or a rotation. The flush
+    consumers, e.g. a LogIndexer, are called every time the file is flushed, and the
+    rotate consumers right before the file is rotated. The files named after the log
+    with one of companion_suffixes, e.g. its index, are rotated along with it.
+    """
+
+    def __init__(self, path, max_bytes=0, backup_count=0, compress=False, buffer_size=WRITE_BUFFER_SIZE,
+                 max_queued=QUEUE_MAX_CHUNKS):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self.buffer_size = buffer_size
+        self.decoder = LineDecoder()
+        self.flush_consumers = []
+        self.rotate_consumers = []
+        self.companion_suffixes = []
+        self.bytes_written = 0
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._file = open(self.path, 'ab', buffering=self.buffer_size)
+        self._size = self._file.tell()
+        self._thread = Thread(target=self._run, name=f'log-writer:{self.path.name}', daemon=True)
+        self._thread.start()
+
+    def add_line_consumer(self, consumer):
+        """
+        Call consumer with every decoded line of output.
+        """
+        self.decoder.consumers.append(consumer)
+
+    def write(self, data):
+        self._queue.put(data)
+
+    def flush(self):
+        """
+        Block until everything written so far is on disk and seen by the consumers.
+        """
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            try:
+                if data is None:
+                    self.decoder.finish()
+                    self._file.close()
+                    return
+                self.decoder.feed(data)
+                self._write(data)
+                if self._queue.empty():
+                    self._file.flush()
+                    for consumer in self.flush_consumers:
+                        consumer()
+            except Exception as e:
+                logger.error(f"Unable to write device output to {self.path}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _write(self, data):
+        if self.max_bytes and self._size and self._size + len(data) > self.max_bytes:
+            self._rotate()
+        self._file.write(data)
+        self._size += len(data)
+        self.bytes_written += len(data)
+
+    def _rotated_path(self, index):
+        suffix = '.gz' if self.compress else ''
+        return Path(f'{self.path}.{index}{suffix}')
+
+    def _move(self, source, target):
+        """
+        Move source and its companions to target, deleting them if target is None.
+        """
+        for suffix in [''] + self.companion_suffixes:
+            path = Path(f'{source}{suffix}')
+            if not path.exists():
+                continue
+            if target is None:
+                path.unlink()
+            else:
+                path.replace(Path(f'{target}{suffix}'))
+
+    def _rotate(self):
+        self._file.close()
+        for consumer in self.rotate_consumers:
+            consumer()
+        if self.backup_count:
+            self._move(self._rotated_path(self.backup_count), None)
+            for index in range(self.backup_count - 1, 0, -1):
+                self._move(self._rotated_path(index), self._rotated_path(index + 1))
+            if self.compress:
+                with open(self.path, 'rb') as source, gzip.open(self._rotated_path(1), 'wb') as target:
+                    shutil.copyfileobj(source, target)
+                self.path.unlink()
+                # Only the companions are left to move
+                self._move(self.path, self._rotated_path(1))
+            else:
+                self._move(self.path, self._rotated_path(1))
+        else:
+            self._move(self.path, None)
+        self._file = open(self.path, 'ab', buffering=self.buffer_size)
+        self._size = 0
+
+
+def pump(fd, writer, chunk_size=READ_CHUNK_SIZE):
+    """
+    Read the output of a process in large chunks and hand them to the writer until EOF.
+    Reading from a pty master fails with EIO once the child closed it, which is its EOF.
+    :return: Number of bytes read
+    """
+    total = 0
+    while True:
+        try:
+            data = os.read(fd, chunk_size)
+        except OSError:
+            break
+        if not data:
+            break
+        writer.write(data)
+        total += len(data)
+    return total
@@ -0,0 +1,101 @@
+# Minimal CBOR (RFC 8949) encoding of the maps exchanged over the MQTT file stream topics
+# of AWS IoT: integers, byte and text strings, arrays, maps, booleans, null and floats.
+# Indefinite lengths and tags are not supported.
+import struct
+
+UNSIGNED, NEGATIVE, BYTES, TEXT, ARRAY, MAP, SIMPLE = 0, 1, 2, 3, 4, 5, 7
+FALSE, TRUE, NULL = 0xf4, 0xf5, 0xf6
+
+
+def _head(major, value):
+    if value < 24:
+        return bytes([major << 5 | value])
+    for info, size in ((24, 'B'), (25, '>H'), (26, '>I'), (27, '>Q')):
+        if value < 1 << (8 * struct.calcsize(size)):
+            return bytes([major << 5 | info]) + struct.pack(size, value)
+    raise ValueError(f'{value} does not fit in 64 bits')
+
+
+def encode(value):
+    """
+    :return: CBOR bytes of value
+    """
+    if value is None:
+        return bytes([NULL])
+    if isinstance(value, bool):
+        return bytes([TRUE if value else FALSE])
+    if isinstance(value, int):
+        return _head(UNSIGNED, value) if value >= 0 else _head(NEGATIVE, -1 - value)
+    if isinstance(value, float):
+        return bytes([SIMPLE << 5 | 27]) + struct.pack('>d', value)
+    if isinstance(value, (bytes, bytearray)):
+        return _head(BYTES, len(value)) + bytes(value)
+    if isinstance(value, str):
+        data = value.encode()
+        return _head(TEXT, len(data)) + data
+    if isinstance(value, (list, tuple)):
+        return _head(ARRAY, len(value)) + b''.join(encode(item) for item in value)
+    if isinstance(value, dict):
+        return _head(MAP, len(value)) + b''.join(encode(key) + encode(item) for key, item in value.items())
+    raise TypeError(f'Unable to encode {type(value).__name__} as CBOR')
+
+
+def _argument(data, offset, info):
+    if info < 24:
+        return info, offset
+    sizes = {24: 'B', 25: '>H', 26: '>I', 27: '>Q'}
+    if info not in sizes:
+        raise ValueError(f'Unsupported CBOR length encoding {info}')
+    size = struct.calcsize(sizes[info])
+    if offset + size > len(data):
+        raise ValueError('Truncated CBOR')
+    return struct.unpack_from(sizes[info], data, offset)[0], offset + size
+
+
+def _decode(data, offset):
+    if offset >= len(data):
+        raise ValueError('Truncated CBOR')
+    major, info = data[offset] >> 5, data[offset] & 0x1f
+    offset += 1
+    if major == SIMPLE:
+        simple = {FALSE & 0x1f: False, TRUE & 0x1f: True, NULL & 0x1f: None}
+        if info in simple:
+            return simple[info], offset
+        formats = {25: '>e', 26: '>f', 27: '>d'}
+        if info not in formats or offset + struct.calcsize(formats[info]) > len(data):
+            raise ValueError(f'Unsupported CBOR simple value {info}')
+        return struct.unpack_from(formats[info], data, offset)[0], offset + struct.calcsize(formats[info])
+    value, offset = _argument(data, offset, info)
+    if major == UNSIGNED:
+        return value, offset
+    if major == NEGATIVE:
+        return -1 - value, offset
+    if major in (BYTES, TEXT):
+        if offset + value > len(data):
+            raise ValueError('Truncated CBOR')
+        chunk = bytes(data[offset:offset + value])
+        return (chunk if major == BYTES else chunk.decode()), offset + value
+    if major == ARRAY:
+        items = []
+        for _ in range(value):
+            item, offset = _decode(data, offset)
+            items.append(item)
+        return items, offset
+    if major == MAP:
+        items = {}
+        for _ in range(value):
+            key, offset = _decode(data, offset)
+            items[key], offset = _decode(data, offset)
+        return items, offset
+    raise ValueError(f'Unsupported CBOR major type {major}')
+
+
+def decode(data):
+    """
+    :return: The value encoded in data
+    :raises ValueError: If data is not a single well formed CBOR value
+    """
+    value, offset = _decode(data, 0)
+    if offset != len(data):
+        raise ValueError('Trailing bytes after the CBOR value')
+    return value
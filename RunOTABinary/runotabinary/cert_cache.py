@@ -0,0 +1,112 @@
+import json
+import time
+import hashlib
+import threading
+from pathlib import Path
+from datetime import datetime
+from runotabinary.logger import logger
+
+
+def certificate_not_after(certificate):
+    """
+    End of the validity period of a PEM certificate as a unix timestamp, None if it cannot be read.
+    """
+    try:
+        from OpenSSL import crypto
+        not_after = crypto.load_certificate(crypto.FILETYPE_PEM, certificate.encode()).get_notAfter()
+        return (datetime.strptime(not_after.decode(), '%Y%m%d%H%M%SZ') - datetime(1970, 1, 1)).total_seconds()
+    except Exception as e:
+        logger.debug(f"Unable to read the validity of the certificate: {e}")
+        return None
+
+
+class CertificateCache:
+    """
+    On-disk cache of certificates keyed by ARN.
+
+    An entry is fresh for ttl seconds after it was fetched and never used past the end
+    of the certificate validity period. When fetching fails, e.g. offline, a stale entry
+    that is still valid is reused.
+    """
+
+    def __init__(self, directory, ttl):
+        self.directory = Path(directory)
+        self.ttl = ttl
+        self._memory = {}
+        self._lock = threading.Lock()
+
+    def _path(self, arn):
+        return self.directory / f'{hashlib.sha256(arn.encode()).hexdigest()}.json'
+
+    def load(self, arn):
+        """
+        :return: The cache entry of arn or None
+        """
+        if arn in self._memory:
+            return self._memory[arn]
+        path = self._path(arn)
+        if not path.exists():
+            return None
+        try:
+            entry = json.loads(path.read_text())
+        except ValueError:
+            logger.warning(f"Ignoring corrupted certificate cache entry {path}")
+            return None
+        self._memory[arn] = entry
+        return entry
+
+    def store(self, arn, certificate):
+        entry = {
+            'arn': arn,
+            'certificate': certificate,
+            'fetched_at': time.time(),
+            'not_after': certificate_not_after(certificate),
+        }
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._path(arn)
+        tmp_path = path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(entry))
+        tmp_path.replace(path)
+        self._memory[arn] = entry
+        return entry
+
+    @staticmethod
+    def is_valid(entry, now=None):
+        now = now or time.time()
+        return entry['not_after'] is None or now < entry['not_after']
+
+    def is_fresh(self, entry, now=None):
+        now = now or time.time()
+        return now - entry['fetched_at'] < self.ttl and self.is_valid(entry, now)
+
+    def get(self, arn, fetch):
+        """
+        Certificate of arn from the cache, fetched with fetch(arn) when missing or stale.
+        """
+        with self._lock:
+            entry = self.load(arn)
+            if entry is not None and self.is_fresh(entry):
+                return entry['certificate']
+            try:
+                certificate = fetch(arn)
+            except Exception as e:
+                if entry is not None and self.is_valid(entry):
+                    logger.warning(f"Unable to fetch certificate {arn}, reusing the cached one. Err: {e}")
+                    return entry['certificate']
+                raise
+            return self.store(arn, certificate)['certificate']
+
+
+_shared_caches = {}
+_shared_lock = threading.Lock()
+
+
+def shared_cache(directory, ttl):
+    """
+    Cache of the process for directory, so that every build shares its in-memory entries.
+    """
+    key = (str(directory), ttl)
+    with _shared_lock:
+        if key not in _shared_caches:
+            _shared_caches[key] = CertificateCache(directory, ttl)
+        return _shared_caches[key]
@@ -0,0 +1,133 @@
+# Persistent progress of the canary runs, so that a run interrupted by a crash or a host
+# restart resumes where it stopped instead of starting over.
+import time
+import sqlite3
+import threading
+from uuid import uuid4
+from pathlib import Path
+from runotabinary.logger import logger
+
+# Stages a step of a run goes through, in order
+STAGES = ('built', 'uploaded', 'created', 'finished')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    thing_name TEXT NOT NULL,
+    base_version_build INTEGER NOT NULL,
+    iterations INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    initial_image TEXT,
+    initial_sha256 TEXT,
+    device_image TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS steps (
+    run_id TEXT NOT NULL REFERENCES runs(run_id),
+    version_build INTEGER NOT NULL,
+    update_counter INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    build_path TEXT,
+    build_sha256 TEXT,
+    file_name TEXT,
+    s3_key TEXT,
+    s3_version TEXT,
+    ota_update_id TEXT,
+    job_status TEXT,
+    summary TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (run_id, version_build)
+);
+"""
+
+# Runs in these states are never resumed
+CLOSED_RUN_STATUSES = ('completed', 'abandoned')
+
+
+class CheckpointStore:
+    """
+    SQLite store of the canary runs and of the last stage completed by every step of a run.
+
+    A step is one version of the canary: once built it records the artifact path and
+    hash, once uploaded the S3 key and version, once created the OTA update ID, and
+    once finished the state of its job. Writes are committed one by one, so that the
+    store is up to date whenever the process stops. The store can be shared by threads.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            return self._db.execute(sql, parameters).fetchall()
+
+    def open_run(self, thing_name, base_version_build, iterations, resume=True):
+        """
+        Resume the last run of the thing which did not complete, or start a new one.
+        :param resume: False to abandon the unfinished runs of the thing and start a new one
+        :return: (run as a dict, True if the run is resumed)
+        """
+        placeholders = ', '.join('?' * len(CLOSED_RUN_STATUSES))
+        rows = self._execute(f'SELECT * FROM runs WHERE thing_name = ? AND status NOT IN ({placeholders}) '
+                             'ORDER BY created_at DESC', (thing_name,) + CLOSED_RUN_STATUSES)
+        if rows and resume:
+            logger.info(f'Resuming canary run {rows[0]["run_id"]} of {thing_name}')
+            self.set_run(rows[0]['run_id'], status='running')
+            return dict(rows[0], status='running'), True
+        for row in rows:
+            self.set_run(row['run_id'], status='abandoned')
+
+        now = time.time()
+        run_id = uuid4().hex
+        self._execute('INSERT INTO runs (run_id, thing_name, base_version_build, iterations, status, created_at, updated_at) '
+                      'VALUES (?, ?, ?, ?, ?, ?, ?)', (run_id, thing_name, base_version_build, iterations, 'running', now, now))
+        logger.info(f'Starting canary run {run_id} of {thing_name}')
+        return dict(self._execute('SELECT * FROM runs WHERE run_id = ?', (run_id,))[0]), False
+
+    def set_run(self, run_id, **fields):
+        """
+        Update fields of a run, e.g. status, initial_image and device_image.
+        """
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        self._execute(f'UPDATE runs SET {assignments}, updated_at = ? WHERE run_id = ?',
+                      tuple(fields.values()) + (time.time(), run_id))
+
+    def run(self, run_id):
+        rows = self._execute('SELECT * FROM runs WHERE run_id = ?', (run_id,))
+        return dict(rows[0]) if rows else None
+
+    def steps(self, run_id):
+        """
+        :return: Map of the version of every step of the run to its row as a dict
+        """
+        rows = self._execute('SELECT * FROM steps WHERE run_id = ? ORDER BY version_build', (run_id,))
+        return {row['version_build']: dict(row) for row in rows}
+
+    def record(self, run_id, version_build, update_counter, stage, **fields):
+        """
+        Record that the step of version_build completed stage, along with the fields it produced.
+        """
+        if stage not in STAGES:
+            raise ValueError(f'Unknown stage {stage}, expected one of {STAGES}')
+        names = ['run_id', 'version_build', 'update_counter', 'stage', 'updated_at'] + list(fields)
+        values = [run_id, version_build, update_counter, stage, time.time()] + list(fields.values())
+        updates = ', '.join(f'{name} = excluded.{name}' for name in names[2:])
+        self._execute(f'INSERT INTO steps ({", ".join(names)}) VALUES ({", ".join("?" * len(names))}) '
+                      f'ON CONFLICT (run_id, version_build) DO UPDATE SET {updates}', values)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,9 +1,21 @@
 from pprint import pformat
 from pathlib import Path
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, field, replace
 
 from runotabinary.logger import logger
 
+@dataclass
+class DeviceIdentity:
+    """
+    Identity of a single device (thing) taking part in a fleet canary
+    """
+
+    thing_name: str
+    thing_arn: str
+    client_cert_path: str
+    client_private_key_path: str
+
+
 @dataclass
 class OtaProject:
     """
@@ -20,9 +32,76 @@ class OtaProject:
     signer_platform: str = "AmazonFreeRTOS-Default"
     signer_certificate_file_name: str = "ecdsa-sha256-signer.crt.pem"
     signer_oid: str = "sig-sha256-ecdsa"
+    certificate_cache_dir: Path = Path.home() / ".cache" / "runota" / "certificates"
+    certificate_cache_ttl_sec: int = 24 * 60 * 60
     ota_timeout_sec: int = 600
+    # Canary: number of updates rolled out and how many images are built and uploaded ahead
+    canary_iterations: int = 3
+    canary_lookahead: int = 1
+    # Build the initial image and every version of the canary concurrently before the rollouts
+    canary_parallel_builds: bool = False
+    # Build the image once with a placeholder version and patch the version into copies of it
+    canary_version_stamping: bool = False
+    # Progress of the canary runs, so that an interrupted run can be resumed with --resume, empty to disable
+    canary_checkpoint_path: Path = Path.home() / ".cache" / "runota" / "canary.db"
+    # Timings and outcomes of every canary and benchmark run, see run_history, empty to disable
+    run_history_path: Path = Path.home() / ".cache" / "runota" / "history.db"
+    # Index the device log by time, job ID and level as it is written, see log_index
+    device_log_index: bool = True
     thing_name: str = "'SETUP:thing_name for update'"
     thing_arn: str = "'SETUP:required for update'"
+    s3_content_prefix: str = "firmware"
+    # OTA updates are created as <prefix><uuid>, the garbage collector only deletes those
+    ota_update_id_prefix: str = "runota-"
+    gc_rate_per_sec: float = 5.0
+    gc_max_workers: int = 4
+    gc_min_age_sec: int = 3600
+    # Job completion pushed over the AWS IoT Jobs MQTT topics, polling is then only a fallback
+    jobs_observer: bool = False
+    # Client ID of the observer connection, shared by every thing of the process,
+    # runota-jobs-observer-<pid> when empty. The thing policies must allow it
+    jobs_observer_client_id: str = ""
+    jobs_observer_port: int = 8883
+    jobs_observer_tls: bool = True
+    jobs_fallback_poll_sec: float = 30.0
+    # MQTT endpoint the interrupts connect to with the client ID of the thing
+    interrupt_port: int = 8883
+    interrupt_tls: bool = True
+    # CA certificate the jobs observer and the interrupts check the MQTT endpoint with,
+    # the system CAs when empty
+    mqtt_ca_path: str = ""
+    # Interrupts fired during every canary update, see fault_injection.parse_trigger,
+    # e.g. ["progress:25", "progress:75", "time:2:5:3", "job:IN_PROGRESS"]
+    fault_plan: list = field(default_factory=list)
+    # Takeover connections are replaced before the broker drops them for not connecting
+    fault_warm_max_age_sec: float = 5.0
+    aws_max_pool_connections: int = 32
+    aws_max_attempts: int = 5
+    aws_retry_mode: str = "standard"
+    # Calls per second of the AWS APIs, merged into throttle.DEFAULT_RATES, 0 to not limit an API
+    aws_call_rates: dict = field(default_factory=dict)
+    aws_retry_base_delay_sec: float = 0.1
+    aws_retry_max_delay_sec: float = 20.0
+    # Run against the local stand-in of S3, IoT and ACM kept in this directory instead of
+    # AWS, see local_cloud. Empty to use AWS
+    local_cloud_dir: str = ""
+    # Seconds the calls to the local cloud take, by 'service.operation', 'service' or '*',
+    # e.g. {"iot.create_ota_update": 0.5, "s3": 0.05, "streams": 0.01}
+    local_cloud_latency_sec: dict = field(default_factory=dict)
+    # Seconds between the creation of an update and the publication of its job
+    local_cloud_create_delay_sec: float = 0.0
+    # Serve the jobs and streams to the device over MQTT, on a free port when 0
+    local_cloud_mqtt: bool = False
+    local_cloud_mqtt_port: int = 0
+    # Serve them over TLS, with a certificate issued by the CA kept in <local_cloud_dir>/credentials/ca.crt
+    local_cloud_mqtt_tls: bool = False
+    s3_multipart_threshold: int = 8 * 1024 * 1024
+    s3_multipart_chunksize: int = 8 * 1024 * 1024
+    s3_max_concurrency: int = 4
+    # Retention of the firmware builds in the bucket, the newest ones across the content prefix
+    # are kept, see s3_lifecycle.py. 0 disables a limit
+    s3_keep_last_versions: int = 5
+    s3_max_age_days: float = 0
 
     # Source configuration
     repository_root: Path = Path("'SETUP:repository_root'")
@@ -32,14 +111,42 @@ class OtaProject:
     client_cert_path: str = "'SETUP:required for build'"
     client_private_key_path: str = "'SETUP:required for build'"
     aws_iot_endpoint: str = "'SETUP:required for build'"
+    # Concurrent variant builds, and ccache/sccache as compiler launcher when installed
+    build_max_workers: int = 4
+    compiler_cache: bool = True
+    # Artifacts kept in build/runota_artifacts, the least recently used are evicted. 0 keeps them all
+    build_cache_max_artifacts: int = 50
 
 
     # Monitor configuration
     print_monitor: bool = False
 
+    # Tracing: spans are exported to these files when set, see tracing.py
+    trace_jsonl_path: str = ""
+    trace_chrome_path: str = ""
+
+    # Fleet configuration: one device process is run per identity listed here
+    fleet_devices: list = field(default_factory=list)
+    fleet_work_root: Path = Path("fleet")
+    # Updates created at once, the jobs of every device are then followed by a single tracker
+    fleet_max_workers: int = 8
+
     def pretty(self):
         return f"OTA Project dataclass:\n{pformat(asdict(self), width=150)}"
 
+    def for_device(self, identity):
+        """
+        Copy of this project bound to the thing described by identity
+        """
+        return replace(
+            self,
+            thing_name=identity.thing_name,
+            thing_arn=identity.thing_arn,
+            client_cert_path=identity.client_cert_path,
+            client_private_key_path=identity.client_private_key_path,
+            fleet_devices=[],
+        )
+
     def check_setup(self):
         # TODO [C] may want to phrase it as "REQUIRED" instead of "SETUP"
         if "SETUP" in self.pretty():
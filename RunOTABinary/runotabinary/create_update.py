@@ -1,20 +1,57 @@
-import boto3
 import os
-import time
 import sys
+import hashlib
+from runotabinary import aws_clients, tracing
 from runotabinary.configs.config_project import OtaProject
+from runotabinary.garbage_collector import GarbageCollector
 from runotabinary.logger import logger
-from collections import namedtuple
+from runotabinary.tracker import OtaUpdateTracker, JobStatus
+from runotabinary.jobs_mqtt import shared_observer
 from uuid import uuid4
 
 
 class CreateUpdate:
-    def __init__(self, fileNameInUpload = None, fileToUpload = None, ota_project = OtaProject()):
-        self._awsIotClient = boto3.client('iot')
-        self.project = ota_project
-        self._s3Bucket = AWSS3Bucket(self.project.s3_bucket_name)
+    def __init__(self, fileNameInUpload = None, fileToUpload = None, ota_project = None, tracker = None):
+        self.project = ota_project if ota_project is not None else OtaProject()
+        aws_clients.configure_from_project(self.project)
+        self._awsIotClient = aws_clients.get_client('iot')
+        self._s3Bucket = AWSS3Bucket(
+            self.project.s3_bucket_name,
+            content_prefix=self.project.s3_content_prefix,
+            multipart_threshold=self.project.s3_multipart_threshold,
+            multipart_chunksize=self.project.s3_multipart_chunksize,
+            max_concurrency=self.project.s3_max_concurrency
+        )
         self.filename = fileNameInUpload
         self.filepath = fileToUpload
+        self._tracker = tracker
+        # A tracker passed in is shared with other tasks and closed by its owner
+        self._owns_tracker = tracker is None
+
+    @property
+    def tracker(self):
+        """
+        Tracker following the OTA updates of this task, shared trackers can be passed in
+        the constructor to follow the updates of many tasks with the same threads.
+        The tracker created by the task is stopped by close().
+        """
+        if self._tracker is None:
+            self._tracker = update_tracker(self.project, self._awsIotClient)
+        return self._tracker
+
+    def close(self):
+        """
+        Stop the tracker of the task unless it was passed in.
+        """
+        if self._owns_tracker and self._tracker is not None:
+            self._tracker.close()
+            self._tracker = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def setParams(self, fileNameInUpload, fileToUpload):
         self.filename = fileNameInUpload
@@ -23,23 +60,12 @@ class CreateUpdate:
     def clear_pending_jobs(self):
         '''
         For current thing, check if there is any pending jobs.
-        Remove all pending jobs.
+        Remove all pending jobs, every page of them and concurrently.
         '''
-        try:
-            response_queued = {}
-            response_inprogress = {}
-            response_queued = self._awsIotClient.list_job_executions_for_thing(thingName=self.project.thing_name,
-                                                                        status='QUEUED')
-            response_inprogress = self._awsIotClient.list_job_executions_for_thing(thingName=self.project.thing_name,
-                                                                                    status='IN_PROGRESS')
-
-        except Exception as e:
-            logger.warning(f"aws iot list_job_executions_for_thing failed. Err: {e}")
-
-        pending_jobs = response_queued["executionSummaries"] + response_inprogress["executionSummaries"]
-        for job in pending_jobs:
-            logger.debug(f'Clear pending job: {job["jobId"]}')
-            self.cancel_job(job["jobId"].split("AFR_OTA-")[1])
+        stats = GarbageCollector(self.project).clear_pending_jobs()
+        if stats.found:
+            logger.debug(f'Cleared pending jobs: {stats.as_dict()}')
+        return stats
 
     def cancel_job(self, jobId):
         """
@@ -66,14 +92,28 @@ class CreateUpdate:
             logger.error("Unable to delete ota update with ID: " + otaUpdateId)
             logger.error(f"Response: {response}, Exception: {e}")
     
+    def get_ota_update_status(self, otaUpdateId):
+        """
+        Status of an OTA update, None if it cannot be found.
+        """
+        try:
+            return self._awsIotClient.get_ota_update(otaUpdateId=otaUpdateId)['otaUpdateInfo'].get('otaUpdateStatus')
+        except Exception as e:
+            logger.warning(f"Unable to get OTA update {otaUpdateId}: {e}")
+            return None
+
     def upload_firmware_to_s3_bucket(self, localPathToFirmware, firmwareFileName):
         """
         Upload a firmware image to the unsigned S3 bucket associated with this OTA agent.
         :param localPathToFirmware(str): The path on the machine this script is running of the firmware image.
-        :param firmwareFileName(str): The name of the firmware, this is used as the key in the S3 bucket.
+        :param firmwareFileName(str): The name of the firmware, stored in the metadata of the S3 object.
+        :return: The S3 key and version id holding the firmware
         """
         logger.info('Uploading firmware to S3')
-        self._s3Bucket.upload_file(localPathToFirmware, firmwareFileName)
+        with tracing.span('upload', file=firmwareFileName, bytes=os.path.getsize(localPathToFirmware)) as upload_span:
+            key, version = self._s3Bucket.upload_file(localPathToFirmware, firmwareFileName)
+            upload_span.set(key=key, s3_version=version)
+        return key, version
     
     def create_update(self, protocols, deployment_files, role_arn=None, url_expired=3600):
         """
@@ -92,50 +132,47 @@ class CreateUpdate:
         AWS_CREATE_OTA_UPDATE_JOB_TIMEOUT = 60
         create_ota_response = {}
         
-        create_ota_response = self._awsIotClient.create_ota_update(
-            otaUpdateId=str(uuid4()),
-            targets=[
-                self.project.thing_arn
-            ],
-            targetSelection='SNAPSHOT',
-            roleArn=self.project.ota_update_role_arn,
-            files=deployment_files,
-            protocols=protocols,
-            awsJobPresignedUrlConfig={
-                'expiresInSec': url_expired
-            }
-        )
-
-        # Confirm that the OTA update job is ready.
-        timeout_end = time.perf_counter() + AWS_CREATE_OTA_UPDATE_JOB_TIMEOUT
-        ota_create_in_progress = True
-        ota_update_info = None
-        while ota_create_in_progress and time.perf_counter() < timeout_end:
-            time.sleep(1)
-            otaGetStatusResponse = {}
-            otaGetStatusResponse = self._awsIotClient.get_ota_update(
-                otaUpdateId = create_ota_response.get('otaUpdateId'))
-            ota_update_info = otaGetStatusResponse.get('otaUpdateInfo')
-
-            if ota_update_info.get('otaUpdateStatus') in ('CREATE_COMPLETE', 'CREATE_FAILED'):
-                ota_create_in_progress = False
-
-        if ota_create_in_progress == True:
-            logger.error(f"Error: OTA update creation timed out for OTA update ID {ota_update_info.get('otaUpdateId')}")
-            return None
+        with tracing.span('update.create', thing=self.project.thing_name, file=self.filename) as create_span:
+            create_ota_response = self._awsIotClient.create_ota_update(
+                otaUpdateId=f'{self.project.ota_update_id_prefix}{uuid4()}',
+                targets=[
+                    self.project.thing_arn
+                ],
+                targetSelection='SNAPSHOT',
+                roleArn=self.project.ota_update_role_arn,
+                files=deployment_files,
+                protocols=protocols,
+                awsJobPresignedUrlConfig={
+                    'expiresInSec': url_expired
+                }
+            )
 
-        # Check for errors and show us what those errors might be.
-        if ota_update_info.get('otaUpdateStatus') != 'CREATE_COMPLETE':
-            logger.error(f"OTA update creation failed for OTA update ID {ota_update_info.get('otaUpdateId')}")
-            if ('errorInfo' in ota_update_info):
-                logger.error(f"Code: {ota_update_info.get('errorInfo').get('code')}")
-                logger.error(f"Details: {ota_update_info.get('errorInfo').get('message')}")
-        else:
-            logger.info(f"Created OTA Update ID {ota_update_info.get('otaUpdateId')} (AWS IoT job ID = {ota_update_info.get('awsIotJobId')}).")
+            # Confirm that the OTA update job is ready.
+            ota_update_id = create_ota_response.get('otaUpdateId')
+            create_span.set(ota_update_id=ota_update_id)
+            try:
+                # Signing the image and creating the stream and the job happen in the cloud meanwhile
+                with tracing.span('update.wait_created', ota_update_id=ota_update_id):
+                    ota_update_info = self.tracker.track_creation(ota_update_id, AWS_CREATE_OTA_UPDATE_JOB_TIMEOUT).result()
+            except TimeoutError:
+                logger.error(f"Error: OTA update creation timed out for OTA update ID {ota_update_id}")
+                create_span.set(status='TIMEOUT')
+                return None
+
+            create_span.set(status=ota_update_info.get('otaUpdateStatus'), job_id=ota_update_info.get('awsIotJobId'))
+
+            # Check for errors and show us what those errors might be.
+            if ota_update_info.get('otaUpdateStatus') != 'CREATE_COMPLETE':
+                logger.error(f"OTA update creation failed for OTA update ID {ota_update_info.get('otaUpdateId')}")
+                if ('errorInfo' in ota_update_info):
+                    logger.error(f"Code: {ota_update_info.get('errorInfo').get('code')}")
+                    logger.error(f"Details: {ota_update_info.get('errorInfo').get('message')}")
+            else:
+                logger.info(f"Created OTA Update ID {ota_update_info.get('otaUpdateId')} (AWS IoT job ID = {ota_update_info.get('awsIotJobId')}).")
 
-        return ota_update_info.get('otaUpdateId')
+            return ota_update_info.get('otaUpdateId')
 
-    def create_ota_update(self, urlExpired=3600):
+    def create_ota_update(self, urlExpired=3600, s3Object=None):
         """Create an OTA update in AWS IoT by using the otaConfig.
         We follow the path of:
             1. Upload unsigned image to the unsigned s3 bucket.
@@ -147,12 +184,15 @@ class CreateUpdate:
         Returns AWS IoT Ota Update ID
         Args:
             otaConfig - 'ota_config' from board.json
+            s3Object - (key, version id) of the image when it was already uploaded
         """
         # Upload to the s3 bucket.
-        self.upload_firmware_to_s3_bucket(
-            self.filepath,
-            self.filename
-        )
+        if s3Object is None:
+            s3Object = self.upload_firmware_to_s3_bucket(
+                self.filepath,
+                self.filename
+            )
+        s3_key, s3_version = s3Object
 
         signingProfile = f'{self.project.thing_name[-8:]}_linux'
         otaUpdateId = self.create_update(
@@ -165,8 +205,8 @@ class CreateUpdate:
                     'fileLocation': {
                         's3Location': {
                             'bucket': self.project.s3_bucket_name,
-                            'key': self.filename,
-                            'version': self._s3Bucket.get_s3_object(self.filename).version_id
+                            'key': s3_key,
+                            'version': s3_version
                         }
                     },
                     'codeSigning': {
@@ -191,7 +231,6 @@ class CreateUpdate:
         :param jobId(str): The AWS IoT Job ID to get the status of.
         :return: The job status and the reason for the status in a namedtuple.
         """
-        JobStatus = namedtuple('JobStatus', 'status reason')
         try:
             response = {}
             response = self._awsIotClient.describe_job_execution(jobId=jobId, thingName=self.project.thing_name)
@@ -205,73 +244,203 @@ class CreateUpdate:
             logger.debug(executionResponse)
         return job_status
 
-    def get_ota_update_result(self, ota_update_id, timeout, sleep_time=5):
+    def track_ota_update(self, ota_update_id, timeout, callback=None):
         '''
-        Non blocking call to get ota update status. Function return upon job completion.
+        Non blocking call to follow an ota update until its job finishes.
+        :param ota_update_id: AWS OTA update id
+        :param timeout: Time after which the job fails
+        :param callback: Optional callable invoked with the future once the job finishes
+        :return: Future resolving to a TrackedResult
+        '''
+        if self.project.jobs_observer:
+            shared_observer(self.project).watch(self.project.thing_name)
+        return self.tracker.track_job(ota_update_id, self.project.thing_name, timeout, callback)
+
+    def get_ota_update_result(self, ota_update_id, timeout):
+        '''
+        Blocking call to get ota update status. Function return upon job completion.
         :param ota_update_id: AWS OTA job id
         :param timeout: Time after which the job fails
         :return: Status os the update once it is finished
         '''
-        seconds = 0
-        summary = None
-
-        # Get the AWS Iot Job ID
-        response = {}
-        response = self._awsIotClient.get_ota_update(otaUpdateId=ota_update_id)
-        job_id = response['otaUpdateInfo']['awsIotJobId']
-
-        finished_job_statuses = {'CANCELED', 'SUCCEEDED', 'FAILED', 'REJECTED', 'REMOVED'}
-        start = time.perf_counter()
-        summary = None
-        while True:
-            job_status = self.get_job_status(job_id)
-            if job_status.status in finished_job_statuses:
-                # logger.error(f"Version received from the cloud is : {self.get_version_number(job_id)}")
-                break
-            else:
-                time.sleep(sleep_time)
-
-            end = time.perf_counter()
-            if end - start > timeout:
-                logger.error(f"Timeout on OTA Update's job. (Timeout setting: {timeout})")
-                logger.info(f'start: {start}, end: {end}')
-                self.cancel_job(job_id)
-                summary = 'Timeout on OTA Update\'s job.'
-                break
+        with tracing.span('update.rollout', ota_update_id=ota_update_id, thing=self.project.thing_name) as rollout_span:
+            with tracing.span('update.wait_job', ota_update_id=ota_update_id):
+                result = self.track_ota_update(ota_update_id, timeout).result()
+            rollout_span.set(job_id=result.job_id, status=result.status.status)
+            return self.finish_ota_update(result)
 
-        self.delete_ota_update(ota_update_id)
-        return job_status, summary
+    def finish_ota_update(self, result):
+        '''
+        Cancel the job of an update which did not succeed and delete the update, once it is tracked to its end.
+        :param result: TrackedResult of the future returned by track_ota_update
+        :return: Status of the update and its summary
+        '''
+        if result.summary and result.job_id:
+            self.cancel_job(result.job_id.split("AFR_OTA-")[-1])
+
+        self.delete_ota_update(result.ota_update_id)
+        return result.status, result.summary
+
+
+def update_tracker(project, iot_client=None):
+    """
+    Tracker of OTA updates set up for the project. With jobs_observer the job completion
+    is pushed over MQTT and polling the jobs is only a slow fallback. The tracker can be
+    shared by many CreateUpdate tasks, its creator closes it.
+    """
+    if iot_client is None:
+        aws_clients.configure_from_project(project)
+        iot_client = aws_clients.get_client('iot')
+    if project.jobs_observer:
+        tracker = OtaUpdateTracker(iot_client, job_interval=project.jobs_fallback_poll_sec)
+        tracker.attach_observer(shared_observer(project))
+        return tracker
+    return OtaUpdateTracker(iot_client)
+
+
+def file_digest(file_path, chunk_size=1024 * 1024):
+    """
+    SHA-256 of a file, read in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
 class AWSS3Bucket:
-    """ AWS S3 Versioned Bucket."""
-    def __init__(self, name):
-        self._s3_client = boto3.resource('s3')
+    """ AWS S3 Versioned Bucket.
+
+    Files are stored content addressed under <content_prefix>/<sha256>, so uploading
+    bytes the bucket already holds costs a single HEAD request. Files below the multipart
+    threshold are sent with a single PUT, larger ones with the managed multipart transfer.
+    """
+    def __init__(self, name, content_prefix='firmware', multipart_threshold=8 * 1024 * 1024,
+                 multipart_chunksize=8 * 1024 * 1024, max_concurrency=4):
         self.s3_name = name
-        self.s3_bucket = self._s3_client.Bucket(self.s3_name)
-        self.__create_bucket()
-        self.s3_keys = []
+        aws_clients.once(('s3_bucket', self.s3_name), self.__create_bucket)
+        # (key, version id) of the versions this process uploaded
+        self.s3_versions = []
+        self.content_prefix = content_prefix
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunksize = multipart_chunksize
+        self.max_concurrency = max_concurrency
+        # sha256 -> (key, version id) of the objects uploaded or found by this process
+        self._uploaded = {}
+
+    @property
+    def _s3_client(self):
+        return aws_clients.get_client('s3')
+
+    @property
+    def _transfer_client(self):
+        return aws_clients.get_transfer_client('s3')
+
+    @property
+    def s3_bucket(self):
+        return aws_clients.get_resource('s3').Bucket(self.s3_name)
 
     def __create_bucket(self):
-        response = None
+        """
+        Create the bucket if needed and make sure versioning is enabled.
+        Checked once per bucket for the life of the process.
+        """
         try:
-            response = self._s3_client.meta.client.head_bucket(Bucket = self.s3_name)
+            self._s3_client.head_bucket(Bucket = self.s3_name)
         except Exception:
-            self.s3_bucket = self._s3_client.create_bucket(
+            self._s3_client.create_bucket(
                 Bucket = self.s3_name,
                 CreateBucketConfiguration = {
-                    'LocationConstraint': boto3.session.Session().region_name
+                    'LocationConstraint': aws_clients.get_session().region_name
                 }
             )
-            self._s3_client.BucketVersioning(self.s3_name).enable()
+        versioning = self._s3_client.get_bucket_versioning(Bucket = self.s3_name)
+        if versioning.get('Status') != 'Enabled':
+            self._s3_client.put_bucket_versioning(
+                Bucket = self.s3_name, VersioningConfiguration = {'Status': 'Enabled'})
+        return True
+
+    def content_key(self, digest):
+        return f'{self.content_prefix}/{digest}'
+
+    def find_object(self, digest):
+        """
+        Find the object holding the content with the given digest.
+        :return: (key, version id) of the object or None if the bucket does not hold it
+        """
+        if digest in self._uploaded:
+            return self._uploaded[digest]
+        import botocore.exceptions
+        key = self.content_key(digest)
+        try:
+            response = self._s3_client.head_object(Bucket=self.s3_name, Key=key)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        if response.get('Metadata', {}).get('sha256') != digest:
+            return None
+        self._uploaded[digest] = (key, response.get('VersionId'))
+        return self._uploaded[digest]
 
     def upload_file(self, file_path, file_name):
-        self.s3_keys.append(file_name)
-        self._s3_client.Bucket(self.s3_name).upload_file(file_path, file_name)
+        """
+        Upload a file unless the bucket already holds the same bytes.
+        :param file_path: Local path of the file
+        :param file_name: Name of the file, kept in the object metadata
+        :return: (key, version id) of the object holding the file
+        """
+        digest = file_digest(file_path)
+        found = self.find_object(digest)
+        if found is not None:
+            logger.info(f'{file_name} already uploaded as {found[0]} version {found[1]}, skipping upload')
+            return found
+
+        key = self.content_key(digest)
+        metadata = {'sha256': digest, 'file-name': os.path.basename(file_name)}
+        if os.path.getsize(file_path) < self.multipart_threshold:
+            with open(file_path, 'rb') as f:
+                version = self._s3_client.put_object(Bucket=self.s3_name, Key=key, Body=f, Metadata=metadata).get('VersionId')
+        else:
+            version = self._multipart_upload(file_path, key, metadata)
+
+        self.s3_versions.append((key, version))
+        self._uploaded[digest] = (key, version)
+        return self._uploaded[digest]
+
+    def _multipart_upload(self, file_path, key, metadata):
+        """
+        Upload a file through the managed transfer, which streams the parts from the file
+        max_concurrency at a time, retrying them with botocore, see aws_clients.get_transfer_client().
+        The transfer does not return the version it created, it is taken from the response
+        of the call completing the upload.
+        :return: Version id of the object
+        """
+        versions = []
+
+        def completed(parsed, **kwargs):
+            if parsed.get('Key') == key:
+                versions.append(parsed.get('VersionId'))
+        events = self._transfer_client.meta.events
+        handler_id = f'runota-upload-{uuid4()}'
+        events.register('after-call.s3.CompleteMultipartUpload', completed, unique_id=handler_id)
+        try:
+            self._transfer_client.upload_file(file_path, self.s3_name, key, ExtraArgs={'Metadata': metadata},
+                                        Config=self.transfer_config())
+        finally:
+            events.unregister('after-call.s3.CompleteMultipartUpload', unique_id=handler_id)
+        return versions[-1] if versions else None
+
+    def transfer_config(self):
+        from boto3.s3.transfer import TransferConfig
+        return TransferConfig(multipart_threshold=self.multipart_threshold, multipart_chunksize=self.multipart_chunksize,
+                              max_concurrency=self.max_concurrency)
 
     def download_file(self, key, file_path):
+        import botocore.exceptions
         try:
-            self._s3_client.Bucket(self.s3_name).download_file(key, file_path)
+            self._transfer_client.download_file(self.s3_name, key, file_path)
         except botocore.exceptions.ClientError as e:
             if e.response['Error']['Code'] == "404":
                 logger.error("The object does not exist.")
@@ -279,16 +448,16 @@ class AWSS3Bucket:
                 raise
 
     def get_s3_object(self, key):
-        return self._s3_client.Object(self.s3_name, key)
+        return aws_clients.get_resource('s3').Object(self.s3_name, key)
 
     def cleanup(self):
-        try:
-            self._s3_client.meta.client.head_bucket(Bucket = self.s3_name)
-        except:
-            # Bucket doesn't exist nothing to clean.
-            return
-        for key in self.s3_keys:
-            self._s3_client.Object(self.s3_name, key).delete()
+        """
+        Forget the objects uploaded or found by this process. The objects are content
+        addressed and other processes find them by digest and roll them out, so they are
+        not deleted here: the retention policy of s3_lifecycle expires the old builds.
+        """
+        self.s3_versions = []
+        self._uploaded = {}
 
     def __enter__(self):
         return self
@@ -300,9 +469,9 @@ def main():
     #filename = 'ota_demo_core_mqtt2'
     #filepath = '/home/ubuntu/dev/csdk/aws-iot-device-sdk-embedded-C/build/bin/ota_demo_core_mqtt'
     #task = CreateUpdate(filename,filepath) 
-    task = CreateUpdate(sys.argv[1], sys.argv[2], OtaProject())
-    ota_update_id = task.create_ota_update()
-    task.get_ota_update_result(ota_update_id, 600)
+    with CreateUpdate(sys.argv[1], sys.argv[2], OtaProject()) as task:
+        ota_update_id = task.create_ota_update()
+        task.get_ota_update_result(ota_update_id, 600)
     
 
 if __name__ == "__main__":
@@ -0,0 +1,484 @@
+# In-process stand-ins for the S3, IoT and ACM clients, for offline runs and benchmarks.
+# Objects and job documents are kept on disk under the backend root so that a stub device
+# running in another process can pick up its jobs and report their status.
+import os
+import json
+import time
+import shutil
+import threading
+from types import SimpleNamespace
+from pathlib import Path
+from datetime import datetime, timezone
+from runotabinary import aws_clients
+from runotabinary.logger import logger
+
+FAKE_SIGNER_CERTIFICATE = (
+    '-----BEGIN CERTIFICATE-----\n'
+    'RnVuT1RBIG9mZmxpbmUgc2lnbmVyIGNlcnRpZmljYXRl\n'
+    '-----END CERTIFICATE-----\n'
+)
+
+
+def _client_error(code, operation):
+    import botocore.exceptions
+    return botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+def _page(items, maxResults=None, nextToken=None, page_size=50):
+    """
+    One page of items, with the token of the next page as the AWS list calls return them.
+    """
+    start = int(nextToken or 0)
+    end = start + min(maxResults or page_size, page_size)
+    return items[start:end], (str(end) if end < len(items) else None)
+
+
+def latency(latencies, service, operation):
+    """
+    Seconds a call takes by latencies, which maps 'service.operation', 'service' or '*' to seconds.
+    """
+    return latencies.get(f'{service}.{operation}', latencies.get(service, latencies.get('*', 0.0)))
+
+
+def write_json(path, value):
+    """
+    Atomically replace path with the JSON of value.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    tmp_path.write_text(json.dumps(value))
+    tmp_path.replace(path)
+
+
+class FakeEvents:
+    """
+    The part of the botocore event system of a client its callers use: handlers are
+    registered by unique id and called with the keyword arguments of emit().
+    """
+
+    def __init__(self):
+        self._handlers = {}
+        self._lock = threading.Lock()
+
+    def register(self, event_name, handler, unique_id=None):
+        with self._lock:
+            self._handlers[(event_name, unique_id or id(handler))] = handler
+
+    def unregister(self, event_name, handler=None, unique_id=None):
+        with self._lock:
+            self._handlers.pop((event_name, unique_id or id(handler)), None)
+
+    def emit(self, event_name, **kwargs):
+        with self._lock:
+            handlers = [handler for (name, _), handler in self._handlers.items() if name == event_name]
+        for handler in handlers:
+            handler(event_name=event_name, **kwargs)
+
+
+class FakeS3Client:
+    """
+    Versioned buckets whose object bodies are stored as files under root. Listing the
+    versions returns pages of at most page_size versions.
+    """
+
+    def __init__(self, root, page_size=1000):
+        self.root = Path(root)
+        self.page_size = page_size
+        # Keys whose deletion is refused, as by a bucket policy
+        self.denied_keys = set()
+        self._buckets = {}
+        self._uploads = {}
+        self._versions = 0
+        self._lock = threading.Lock()
+        self.meta = SimpleNamespace(events=FakeEvents())
+
+    def _bucket(self, Bucket, operation):
+        if Bucket not in self._buckets:
+            raise _client_error('NoSuchBucket', operation)
+        return self._buckets[Bucket]
+
+    def _store(self, Bucket, Key, body, Metadata):
+        with self._lock:
+            objects = self._bucket(Bucket, 'PutObject')['objects']
+            self._versions += 1
+            version = f'{self._versions:08d}'
+            path = self.root / Bucket / f'{version}.bin'
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(body)
+            objects.setdefault(Key, []).append({'VersionId': version, 'Path': path, 'Metadata': dict(Metadata or {}),
+                                                'LastModified': datetime.now(timezone.utc)})
+        return {'VersionId': version, 'ETag': f'"{version}"'}
+
+    def object_path(self, Bucket, Key, VersionId=None):
+        """
+        File holding the body of an object version, the latest one by default.
+        """
+        versions = self._bucket(Bucket, 'GetObject')['objects'].get(Key)
+        if not versions:
+            raise _client_error('NoSuchKey', 'GetObject')
+        for version in reversed(versions):
+            if VersionId is None or version['VersionId'] == VersionId:
+                return version['Path']
+        raise _client_error('NoSuchVersion', 'GetObject')
+
+    def head_bucket(self, Bucket):
+        self._bucket(Bucket, 'HeadBucket')
+        return {}
+
+    def create_bucket(self, Bucket, CreateBucketConfiguration=None):
+        with self._lock:
+            self._buckets.setdefault(Bucket, {'objects': {}, 'versioning': None})
+        return {'Location': f'/{Bucket}'}
+
+    def get_bucket_versioning(self, Bucket):
+        status = self._bucket(Bucket, 'GetBucketVersioning')['versioning']
+        return {'Status': status} if status else {}
+
+    def put_bucket_versioning(self, Bucket, VersioningConfiguration):
+        self._bucket(Bucket, 'PutBucketVersioning')['versioning'] = VersioningConfiguration['Status']
+        return {}
+
+    def head_object(self, Bucket, Key):
+        versions = self._bucket(Bucket, 'HeadObject')['objects'].get(Key)
+        if not versions:
+            raise _client_error('404', 'HeadObject')
+        latest = versions[-1]
+        return {'VersionId': latest['VersionId'], 'Metadata': latest['Metadata'],
+                'ContentLength': latest['Path'].stat().st_size}
+
+    def put_object(self, Bucket, Key, Body, Metadata=None):
+        body = Body.read() if hasattr(Body, 'read') else Body
+        return self._store(Bucket, Key, body, Metadata)
+
+    def create_multipart_upload(self, Bucket, Key, Metadata=None):
+        with self._lock:
+            upload_id = f'upload-{len(self._uploads) + 1}'
+            self._uploads[upload_id] = {'parts': {}, 'Metadata': Metadata}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self._uploads[UploadId]['parts'][PartNumber] = Body.read() if hasattr(Body, 'read') else Body
+        return {'ETag': f'"{UploadId}-{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        upload = self._uploads.pop(UploadId)
+        body = b''.join(upload['parts'][part['PartNumber']] for part in MultipartUpload['Parts'])
+        return self._store(Bucket, Key, body, upload['Metadata'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._uploads.pop(UploadId, None)
+        return {}
+
+    def delete_object(self, Bucket, Key, VersionId=None):
+        with self._lock:
+            objects = self._bucket(Bucket, 'DeleteObject')['objects']
+            versions = objects.get(Key, [])
+            for version in [v for v in versions if VersionId is None or v['VersionId'] == VersionId]:
+                versions.remove(version)
+                version['Path'].unlink()
+            if not versions:
+                objects.pop(Key, None)
+        return {}
+
+    def list_object_versions(self, Bucket, Prefix='', KeyMarker=None, VersionIdMarker=None, MaxKeys=1000):
+        with self._lock:
+            objects = self._bucket(Bucket, 'ListObjectVersions')['objects']
+            # Keys in order, the versions of every key newest first
+            versions = [(key, version) for key in sorted(objects) if key.startswith(Prefix)
+                        for version in reversed(objects[key])]
+        start = 0
+        if KeyMarker is not None:
+            # The listing resumes after the position of the marker, even if its version was deleted
+            # since. Version IDs grow with time, the versions of a key are listed newest first
+            start = next((index for index, (key, version) in enumerate(versions)
+                          if key > KeyMarker or (key == KeyMarker and VersionIdMarker is not None
+                                                 and version['VersionId'] < VersionIdMarker)), len(versions))
+        page = versions[start:start + min(MaxKeys, self.page_size)]
+        response = {
+            'Versions': [{'Key': key, 'VersionId': version['VersionId'], 'IsLatest': version is objects[key][-1],
+                          'LastModified': version['LastModified'], 'Size': version['Path'].stat().st_size}
+                         for key, version in page],
+            'IsTruncated': start + len(page) < len(versions),
+        }
+        if response['IsTruncated']:
+            response['NextKeyMarker'], response['NextVersionIdMarker'] = page[-1][0], page[-1][1]['VersionId']
+        return response
+
+    def delete_objects(self, Bucket, Delete):
+        if len(Delete['Objects']) > 1000:
+            raise _client_error('MalformedXML', 'DeleteObjects')
+        deleted = []
+        errors = []
+        for entry in Delete['Objects']:
+            if entry['Key'] in self.denied_keys:
+                errors.append({'Key': entry['Key'], 'VersionId': entry.get('VersionId'), 'Code': 'AccessDenied'})
+                continue
+            self.delete_object(Bucket, entry['Key'], entry.get('VersionId'))
+            deleted.append(entry)
+        response = {'Errors': errors} if errors else {}
+        if not Delete.get('Quiet'):
+            response['Deleted'] = deleted
+        return response
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Callback=None, Config=None):
+        """
+        Like the managed upload of boto3: a single PUT below the multipart threshold of
+        Config, otherwise a multipart upload in parts of its chunk size.
+        """
+        metadata = (ExtraArgs or {}).get('Metadata')
+        threshold = Config.multipart_threshold if Config is not None else 8 * 1024 * 1024
+        chunksize = Config.multipart_chunksize if Config is not None else 8 * 1024 * 1024
+        with open(Filename, 'rb') as f:
+            if os.path.getsize(Filename) < threshold:
+                self.put_object(Bucket=Bucket, Key=Key, Body=f, Metadata=metadata)
+                return
+            upload_id = self.create_multipart_upload(Bucket=Bucket, Key=Key, Metadata=metadata)['UploadId']
+            parts = []
+            for part_number, body in enumerate(iter(lambda: f.read(chunksize), b''), start=1):
+                response = self.upload_part(Bucket=Bucket, Key=Key, UploadId=upload_id, PartNumber=part_number, Body=body)
+                parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        response = self.complete_multipart_upload(Bucket=Bucket, Key=Key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+        self.meta.events.emit('after-call.s3.CompleteMultipartUpload', parsed=dict(response, Bucket=Bucket, Key=Key))
+
+    def download_file(self, Bucket, Key, Filename):
+        shutil.copyfile(str(self.object_path(Bucket, Key)), Filename)
+
+
+class FakeIotClient:
+    """
+    OTA updates and their jobs. A job document is written under jobs/<thing>/<job id>.json
+    once the update is created, after create_delay seconds, and the device reports the
+    status of its execution in <job id>.status next to it. Every update gets a stream,
+    and the list calls return pages of at most page_size items.
+
+    Listeners added with add_listener() are called with the thing name and job ID when a
+    job is published or canceled.
+    """
+
+    def __init__(self, root, s3_client, create_delay=0.0, page_size=50):
+        self.root = Path(root)
+        self.s3_client = s3_client
+        self.create_delay = create_delay
+        self.page_size = page_size
+        self._updates = {}
+        self._streams = {}
+        self._canceled = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def _notify(self, thing_name, job_id):
+        for listener in self._listeners:
+            try:
+                listener(thing_name, job_id)
+            except Exception as e:
+                logger.error(f'Listener of the job {job_id} failed: {e}')
+
+    def jobs_dir(self, thing_name):
+        path = self.root / thing_name
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    @staticmethod
+    def thing_name(target):
+        return target.rsplit('/', 1)[-1]
+
+    def _publish(self, ota_update_id):
+        update = self._updates.get(ota_update_id)
+        if update is None:
+            return
+        job_id = update['job_id']
+        for target in update['targets']:
+            files = []
+            for entry in update['files']:
+                location = entry['fileLocation']['s3Location']
+                path = self.s3_client.object_path(location['bucket'], location['key'], location.get('version'))
+                files.append({'fileName': entry['fileName'], 'filePath': str(path), 'fileSize': path.stat().st_size})
+            write_json(self.jobs_dir(self.thing_name(target)) / f'{job_id}.json', {'jobId': job_id, 'files': files})
+        # The job is only visible once its documents are written
+        update['status'] = 'CREATE_COMPLETE'
+        for target in update['targets']:
+            self._notify(self.thing_name(target), job_id)
+
+    def create_ota_update(self, otaUpdateId, targets, files, **kwargs):
+        with self._lock:
+            self._updates[otaUpdateId] = {
+                'status': 'CREATE_PENDING',
+                'job_id': f'AFR_OTA-{otaUpdateId}',
+                'targets': list(targets),
+                'files': files,
+                'created': datetime.now(timezone.utc),
+            }
+            self._streams[f'AFR_OTA-{otaUpdateId}'] = otaUpdateId
+        if self.create_delay:
+            timer = threading.Timer(self.create_delay, self._publish, args=(otaUpdateId,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._publish(otaUpdateId)
+        return {'otaUpdateId': otaUpdateId, 'otaUpdateStatus': 'CREATE_PENDING'}
+
+    def get_ota_update(self, otaUpdateId):
+        update = self._updates.get(otaUpdateId)
+        if update is None:
+            raise _client_error('ResourceNotFoundException', 'GetOTAUpdate')
+        info = {'otaUpdateId': otaUpdateId, 'otaUpdateStatus': update['status']}
+        if update['status'] == 'CREATE_COMPLETE':
+            info['awsIotJobId'] = update['job_id']
+        return {'otaUpdateInfo': info}
+
+    def list_ota_updates(self, maxResults=None, nextToken=None, otaUpdateStatus=None):
+        with self._lock:
+            updates = [{'otaUpdateId': ota_update_id, 'otaUpdateStatus': update['status'], 'creationDate': update['created']}
+                       for ota_update_id, update in self._updates.items()
+                       if otaUpdateStatus is None or update['status'] == otaUpdateStatus]
+        page, token = _page(updates, maxResults, nextToken, self.page_size)
+        return dict({'otaUpdates': page}, **({'nextToken': token} if token else {}))
+
+    def delete_ota_update(self, otaUpdateId, deleteStream=False, forceDeleteAWSJob=False):
+        with self._lock:
+            update = self._updates.pop(otaUpdateId, None)
+            if update is None:
+                raise _client_error('ResourceNotFoundException', 'DeleteOTAUpdate')
+            if deleteStream:
+                self._streams.pop(update['job_id'], None)
+        return {}
+
+    def list_streams(self, maxResults=None, nextToken=None):
+        with self._lock:
+            streams = [{'streamId': stream_id, 'description': f'Stream of {ota_update_id}'}
+                       for stream_id, ota_update_id in self._streams.items()]
+        page, token = _page(streams, maxResults, nextToken, self.page_size)
+        return dict({'streams': page}, **({'nextToken': token} if token else {}))
+
+    def delete_stream(self, streamId):
+        with self._lock:
+            if self._streams.pop(streamId, None) is None:
+                raise _client_error('ResourceNotFoundException', 'DeleteStream')
+        return {}
+
+    def _status(self, thing_name, job_id):
+        if job_id in self._canceled:
+            return {'status': 'CANCELED', 'statusDetails': {'detailsMap': {'reason': self._canceled[job_id]}}}
+        path = self.jobs_dir(thing_name) / f'{job_id}.status'
+        if not path.exists():
+            return {'status': 'QUEUED', 'statusDetails': {}}
+        status = json.loads(path.read_text())
+        return {'status': status['status'], 'statusDetails': {'detailsMap': {'reason': status.get('reason', '')}}}
+
+    def report(self, thing_name, job_id, status, reason=''):
+        """
+        Set the status of the execution of a job, as the device does.
+        """
+        write_json(self.jobs_dir(thing_name) / f'{job_id}.status', {'status': status, 'reason': reason})
+
+    def job_document(self, thing_name, job_id):
+        """
+        :return: The document of the job of the thing, None if there is none
+        """
+        try:
+            return json.loads((self.jobs_dir(thing_name) / f'{job_id}.json').read_text())
+        except (OSError, ValueError):
+            return None
+
+    def pending_jobs(self, thing_name):
+        """
+        :return: List of (job ID, status) of the executions of the thing which are queued or in progress
+        """
+        pending = []
+        for document in sorted(self.jobs_dir(thing_name).glob('*.json'), key=lambda path: path.stat().st_mtime):
+            status = self._status(thing_name, document.stem)['status']
+            if status in ('QUEUED', 'IN_PROGRESS'):
+                pending.append((document.stem, status))
+        return pending
+
+    def describe_job_execution(self, jobId, thingName):
+        if not (self.jobs_dir(thingName) / f'{jobId}.json').exists() and jobId not in self._canceled:
+            raise _client_error('ResourceNotFoundException', 'DescribeJobExecution')
+        execution = self._status(thingName, jobId)
+        execution.update(jobId=jobId, thingArn=thingName)
+        return {'execution': execution}
+
+    def list_job_executions_for_thing(self, thingName, status=None, maxResults=None, nextToken=None):
+        summaries = []
+        for document in sorted(self.jobs_dir(thingName).glob('*.json')):
+            execution = self._status(thingName, document.stem)
+            if status is None or execution['status'] == status:
+                queued_at = datetime.fromtimestamp(document.stat().st_mtime, timezone.utc)
+                summaries.append({'jobId': document.stem,
+                                  'jobExecutionSummary': {'status': execution['status'], 'queuedAt': queued_at}})
+        page, token = _page(summaries, maxResults, nextToken, self.page_size)
+        return dict({'executionSummaries': page}, **({'nextToken': token} if token else {}))
+
+    def cancel_job(self, jobId, comment='', force=False):
+        with self._lock:
+            self._canceled[jobId] = comment
+        for document in self.root.glob(f'*/{jobId}.json'):
+            document.unlink()
+            self._notify(document.parent.name, jobId)
+        return {'jobId': jobId}
+
+
+class FakeAcmClient:
+    def __init__(self, certificate=FAKE_SIGNER_CERTIFICATE):
+        self.certificate = certificate
+
+    def get_certificate(self, CertificateArn):
+        return {'Certificate': self.certificate}
+
+
+class SlowClient:
+    """
+    Proxy of a fake client whose calls first wait for their latency, see latency().
+    """
+
+    def __init__(self, service, client, latencies):
+        self._service = service
+        self._client = client
+        self._latencies = latencies
+
+    @property
+    def wrapped(self):
+        return self._client
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        delay = latency(self._latencies, self._service, name)
+        if name.startswith('_') or not callable(attribute) or not delay:
+            return attribute
+
+        def slow_call(*args, **kwargs):
+            time.sleep(delay)
+            return attribute(*args, **kwargs)
+        return slow_call
+
+
+class FakeAwsBackend:
+    """
+    The fake clients of a run, registered in the aws_clients registry by install().
+    :param latencies: Seconds the calls take, see latency(), e.g. {'iot.create_ota_update': 0.5, 's3': 0.02}
+    """
+
+    def __init__(self, root, create_delay=0.0, latencies=None):
+        self.root = Path(root)
+        self.latencies = dict(latencies or {})
+        self.s3 = FakeS3Client(self.root / 's3')
+        self.iot = FakeIotClient(self.root / 'jobs', self.s3, create_delay=create_delay)
+        self.acm = FakeAcmClient()
+
+    def install(self):
+        for service, client in (('s3', self.s3), ('iot', self.iot), ('acm', self.acm)):
+            aws_clients.register_client(service, SlowClient(service, client, self.latencies) if self.latencies else client)
+        logger.info(f'Using the offline AWS backend in {self.root}')
+        return self
+
+    def uninstall(self):
+        aws_clients.reset()
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.uninstall()
@@ -0,0 +1,337 @@
+# Interrupt the MQTT connection of the device at precise points of an update: a time after
+# the update started, a share of the image downloaded, a job status or an event of the OTA
+# agent. A takeover connection is kept open and handshaked ahead of time, so that an
+# interrupt is a single write, and the latency of every injection is measured.
+import re
+import time
+import threading
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from runotabinary.interrupt_mqtt import InterruptMQTTConnection
+from runotabinary.logger import logger
+from runotabinary.ota_log_parser import OtaLogParser
+from runotabinary.stats import summarize
+
+# Printed by the OTA agent of the CSDK after every block
+BLOCKS_REMAINING_PATTERN = re.compile(r'Number of blocks remaining: (\d+)')
+# Timer threads sleep until this close to a deadline, then spin
+SPIN_SEC = 0.002
+
+
+@dataclass(frozen=True)
+class TimeTrigger:
+    """
+    Seconds after the start of the update, then every every_sec seconds, count times in total.
+    """
+
+    offset_sec: float
+    every_sec: float = 0.0
+    count: int = 1
+
+    def deadlines(self):
+        return [self.offset_sec + index * self.every_sec for index in range(self.count if self.every_sec else 1)]
+
+
+@dataclass(frozen=True)
+class ProgressTrigger:
+    """
+    Once percent of the image has been downloaded by the device.
+    """
+
+    percent: float
+
+
+@dataclass(frozen=True)
+class JobStateTrigger:
+    """
+    When the job execution of the update reaches status, as pushed by the JobsObserver.
+    """
+
+    status: str
+
+
+@dataclass(frozen=True)
+class EventTrigger:
+    """
+    When the device prints an event of the OTA agent, see ota_log_parser.DEFAULT_PATTERNS.
+    """
+
+    event: str
+
+
+def parse_trigger(text):
+    """
+    Trigger described by text: time:2.5, time:1:0.5:4 (offset, every, count),
+    progress:50, job:IN_PROGRESS or event:verified.
+    """
+    kind, _, value = text.partition(':')
+    if kind == 'time':
+        values = value.split(':')
+        return TimeTrigger(float(values[0]), float(values[1]) if len(values) > 1 else 0.0,
+                           int(values[2]) if len(values) > 2 else 1)
+    if kind == 'progress':
+        return ProgressTrigger(float(value))
+    if kind == 'job':
+        return JobStateTrigger(value)
+    if kind == 'event':
+        return EventTrigger(value)
+    raise ValueError(f'Unknown trigger {text}, expected time:, progress:, job: or event:')
+
+
+@dataclass
+class Injection:
+    """
+    One interrupt: perf_counter() times at which its trigger fired, the CONNECT was sent
+    and the broker acknowledged it. cold is set when no warm connection was ready.
+    """
+
+    trigger: str
+    triggered_at: float
+    sent_at: float = None
+    acked_at: float = None
+    cold: bool = False
+    error: str = None
+
+    @property
+    def send_ms(self):
+        return None if self.sent_at is None else (self.sent_at - self.triggered_at) * 1000
+
+    @property
+    def ack_ms(self):
+        return None if self.acked_at is None else (self.acked_at - self.triggered_at) * 1000
+
+    def as_dict(self):
+        return {'trigger': self.trigger, 'send_ms': self.send_ms and round(self.send_ms, 3),
+                'ack_ms': self.ack_ms and round(self.ack_ms, 3), 'cold': self.cold, 'error': self.error}
+
+
+class FaultInjector:
+    """
+    Fire interrupts from triggers, over takeover connections made by connection_factory,
+    see InterruptMQTTConnection.takeover_connection.
+
+    A keeper thread holds one connection open and replaces it once it is older than
+    warm_max_age_sec, before the broker drops it for not connecting, and right after it
+    was used, so that the triggers of an update can fire one after the other.
+
+    Feed the device output to feed() and the job statuses to on_job_status(), and call
+    start_update() when an update is created: the time triggers count from then, and the
+    other triggers fire once per update.
+    """
+
+    def __init__(self, connection_factory, triggers, warm_max_age_sec=5.0, ack_timeout_sec=10.0):
+        self.connection_factory = connection_factory
+        self.triggers = list(triggers)
+        self.warm_max_age_sec = warm_max_age_sec
+        self.ack_timeout_sec = ack_timeout_sec
+        self.injections = []
+        self.parser = OtaLogParser()
+        self._lock = threading.Lock()
+        self._warm_ready = threading.Condition(self._lock)
+        self._warm = None
+        self._stop = threading.Event()
+        self._keeper = None
+        self._workers = ThreadPoolExecutor(max_workers=2, thread_name_prefix='fault-worker')
+        self._update = 0
+        self._fired = set()
+        self._file_size = None
+        self._received = 0
+        self._blocks = 0
+
+    @classmethod
+    def from_project(cls, project, triggers=None):
+        interrupter = InterruptMQTTConnection(project)
+        plan = triggers if triggers is not None else [parse_trigger(text) for text in project.fault_plan]
+        return cls(interrupter.takeover_connection, plan, warm_max_age_sec=project.fault_warm_max_age_sec)
+
+    def start(self):
+        self._keeper = threading.Thread(target=self._keep_warm, name='fault-keeper', daemon=True)
+        self._keeper.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        with self._lock:
+            self._warm_ready.notify_all()
+        if self._keeper is not None:
+            self._keeper.join()
+        self._workers.shutdown(wait=True)
+        with self._lock:
+            warm, self._warm = self._warm, None
+        if warm is not None:
+            warm.close()
+
+    def ready(self, timeout=None):
+        """
+        Wait until a warm connection is open.
+        :return: True if one is
+        """
+        with self._lock:
+            return self._warm_ready.wait_for(lambda: self._warm is not None or self._stop.is_set(), timeout) \
+                and self._warm is not None
+
+    def _keep_warm(self):
+        while not self._stop.is_set():
+            with self._lock:
+                warm = self._warm
+                if warm is not None and time.monotonic() - warm.opened_at < self.warm_max_age_sec:
+                    self._warm_ready.wait(self.warm_max_age_sec - (time.monotonic() - warm.opened_at))
+                    continue
+                self._warm = None
+            if warm is not None:
+                warm.close()
+            try:
+                connection = self.connection_factory().open()
+            except OSError as e:
+                logger.warning(f'Unable to open a takeover connection: {e}')
+                self._stop.wait(1)
+                continue
+            with self._lock:
+                self._warm = connection
+                self._warm_ready.notify_all()
+
+    def start_update(self, file_size=None):
+        """
+        Start the triggers for a new update.
+        :param file_size: Size of the image, for the progress triggers
+        """
+        with self._lock:
+            self._update += 1
+            self._fired = set()
+            self._file_size = file_size
+            self._received, self._blocks = 0, 0
+            update = self._update
+        start = time.perf_counter()
+        deadlines = sorted((start + offset, offset) for trigger in self.triggers if isinstance(trigger, TimeTrigger)
+                           for offset in trigger.deadlines())
+        if deadlines:
+            threading.Thread(target=self._run_timers, args=(update, deadlines), name='fault-timer', daemon=True).start()
+
+    def _run_timers(self, update, deadlines):
+        for deadline, offset in deadlines:
+            while not self._stop.is_set():
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                if remaining > SPIN_SEC:
+                    self._stop.wait(remaining - SPIN_SEC)
+            if self._stop.is_set() or update != self._update:
+                return
+            self.fire(f'time:{offset:g}')
+
+    def _once(self, trigger):
+        with self._lock:
+            if trigger in self._fired:
+                return False
+            self._fired.add(trigger)
+            return True
+
+    def feed(self, line):
+        """
+        Line consumer of the device output.
+        """
+        event = self.parser.parse(line)
+        if event is None:
+            match = BLOCKS_REMAINING_PATTERN.search(line)
+            if match and self._file_size is None and self._blocks:
+                # Without the size of the image, the progress is that of the blocks
+                self._progress(100 * self._blocks / (self._blocks + int(match.group(1))))
+            return
+        for trigger in self.triggers:
+            if isinstance(trigger, EventTrigger) and trigger.event == event.name and self._once(trigger):
+                self.fire(f'event:{event.name}')
+        if event.name == 'job_document':
+            self._received, self._blocks = 0, 0
+        elif event.name == 'block_received' and event.fields.get('size'):
+            self._received += int(event.fields['size'])
+            self._blocks += 1
+            if self._file_size:
+                self._progress(100 * self._received / self._file_size)
+
+    def _progress(self, percent):
+        for trigger in self.triggers:
+            if isinstance(trigger, ProgressTrigger) and percent >= trigger.percent and self._once(trigger):
+                self.fire(f'progress:{trigger.percent:g}')
+
+    def on_job_status(self, thing_name, job_id, status, reason=''):
+        """
+        JobsObserver listener.
+        """
+        for trigger in self.triggers:
+            if isinstance(trigger, JobStateTrigger) and trigger.status == status and self._once(trigger):
+                self.fire(f'job:{status}')
+
+    def fire(self, description='manual'):
+        """
+        Interrupt the device now, on the warm connection if one is ready. Otherwise the
+        connection is opened by a worker thread, so that the caller, e.g. the thread
+        writing the device log, is never held up by the handshakes.
+        :return: The Injection, completed as the broker acknowledges it
+        """
+        injection = Injection(description, time.perf_counter())
+        with self._lock:
+            connection, self._warm = self._warm, None
+            self._warm_ready.notify_all()
+            self.injections.append(injection)
+        if connection is None:
+            injection.cold = True
+            self._workers.submit(self._fire_cold, injection)
+            return injection
+        try:
+            injection.sent_at = connection.fire()
+        except OSError as e:
+            self._failed(injection, e)
+            connection.close()
+            return injection
+        self._workers.submit(self._wait_ack, connection, injection)
+        return injection
+
+    def _failed(self, injection, error):
+        injection.error = str(error)
+        logger.error(f'Interrupt {injection.trigger} failed: {error}')
+
+    def _fire_cold(self, injection):
+        try:
+            connection = self.connection_factory().open()
+        except OSError as e:
+            self._failed(injection, e)
+            return
+        try:
+            injection.sent_at = connection.fire()
+        except OSError as e:
+            self._failed(injection, e)
+            connection.close()
+            return
+        self._wait_ack(connection, injection)
+
+    def _wait_ack(self, connection, injection):
+        try:
+            injection.acked_at = connection.wait_ack(self.ack_timeout_sec)
+            if injection.acked_at is None:
+                injection.error = 'refused'
+        except OSError as e:
+            injection.error = str(e)
+        finally:
+            connection.close()
+        logger.info(f'Interrupt {injection.trigger}: sent {injection.send_ms:.3f} ms and acknowledged '
+                    f'{injection.ack_ms or 0:.3f} ms after its trigger{" (cold)" if injection.cold else ""}')
+
+    def report(self):
+        """
+        :return: Dict with the injections and the distribution of their latencies in ms
+        """
+        return {
+            'injections': [injection.as_dict() for injection in self.injections],
+            'send_ms': summarize([injection.send_ms for injection in self.injections]),
+            'ack_ms': summarize([injection.ack_ms for injection in self.injections]),
+        }
+
+
+def format_report(injections):
+    lines = [f"{'trigger':<22}{'send ms':>10}{'ack ms':>10}  notes"]
+    for injection in injections:
+        send = '-' if injection.send_ms is None else f'{injection.send_ms:.3f}'
+        ack = '-' if injection.ack_ms is None else f'{injection.ack_ms:.3f}'
+        notes = ' '.join(note for note in ('cold' if injection.cold else '', injection.error or '') if note)
+        lines.append(f'{injection.trigger:<22}{send:>10}{ack:>10}  {notes}')
+    return '\n'.join(lines)
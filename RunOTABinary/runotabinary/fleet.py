@@ -0,0 +1,285 @@
+import sys
+import json
+import time
+import shutil
+import argparse
+from os.path import basename
+from pathlib import Path
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from runotabinary.configs.config_project import OtaProject, DeviceIdentity
+from runotabinary.logger import logger
+from runotabinary.build_binary import BuildBinary, BuildVariant
+from runotabinary.run_binary import RunBinary
+from runotabinary.create_update import CreateUpdate, update_tracker
+from runotabinary.ota_log_parser import OtaLogParser
+from runotabinary import tracing
+
+
+@dataclass
+class DeviceResult:
+    """
+    Outcome of every update attempted against a single device of the fleet
+    """
+
+    thing_name: str
+    work_dir: Path
+    log_file: Path
+    updates: list = field(default_factory=list)
+    device_metrics: list = field(default_factory=list)
+    error: str = ''
+
+    @property
+    def passed(self):
+        return not self.error and all(u['status'] == 'SUCCEEDED' for u in self.updates)
+
+
+@dataclass
+class DeviceSlot:
+    """
+    Everything the fleet keeps per device: its project, working dir and monitor thread
+    """
+
+    identity: object
+    project: OtaProject
+    result: DeviceResult
+    image_name: str = ''
+    executable: Path = None
+    run_task: object = None
+    log_parser: OtaLogParser = field(default_factory=OtaLogParser)
+    update_counter: int = 1
+
+
+@dataclass
+class DeviceUpdate:
+    """
+    OTA update of one device in flight: created by a pool worker, then followed by the shared tracker
+    """
+
+    slot: DeviceSlot
+    version_build: int
+    trace_span: object
+    start: float
+    task: object = None
+    ota_update_id: str = None
+    rollout: object = None
+
+
+class OtaFleetCanary:
+    """
+    Canary running one device process per thing identity.
+
+    The identity of a device is compiled in its image, so the images of an iteration
+    are built as one variant per device, concurrently and each in its own build dir, see
+    BuildBinary.build_variants. The OTA updates of an iteration are then created and
+    tracked for all devices at once so an iteration lasts as long as its slowest device:
+    the updates are created by a pool of max_workers, their jobs are then followed by a
+    single tracker shared by every device and no worker waits for a job.
+    """
+
+    def __init__(self, ota_project, devices=None, work_root=None, max_workers=None,
+                 build_factory=BuildBinary, update_factory=CreateUpdate, run_factory=RunBinary,
+                 tracker_factory=update_tracker):
+        self.project = ota_project
+        self.devices = devices if devices is not None else ota_project.fleet_devices
+        self.work_root = Path(work_root or ota_project.fleet_work_root)
+        self.max_workers = max_workers or ota_project.fleet_max_workers
+        self.build_factory = build_factory
+        self.update_factory = update_factory
+        self.run_factory = run_factory
+        self.tracker_factory = tracker_factory
+        self.tracker = None
+        self.slots = []
+        self.trace_span = None
+        self.build_task = None
+
+    def prepare_device(self, identity):
+        """
+        Create the working dir of a device and the project bound to its identity.
+        """
+        work_dir = self.work_root / identity.thing_name
+        work_dir.mkdir(parents=True, exist_ok=True)
+        (work_dir / 'staged').mkdir(exist_ok=True)
+        result = DeviceResult(identity.thing_name, work_dir, work_dir / 'logfile.txt')
+        slot = DeviceSlot(identity, self.project.for_device(identity), result)
+        slot.log_parser.trace_attributes = {'thing': identity.thing_name}
+        return slot
+
+    def device_variant(self, slot, version_build):
+        project = slot.project
+        return BuildVariant(
+            version=f'{project.version_major}.{project.version_minor}.{version_build}',
+            thing_name=project.thing_name,
+            client_cert_path=project.client_cert_path,
+            client_private_key_path=project.client_private_key_path,
+        )
+
+    def build_images(self, slots, version_build):
+        """
+        Build the images of the devices at the given build version concurrently and stage
+        a copy of every image in the working dir of its device.
+        :return: List of the path of the staged image of every slot, None where the build failed
+        """
+        if self.build_task is None:
+            self.build_task = self.build_factory(self.project)
+        variants = [self.device_variant(slot, version_build) for slot in slots]
+        paths = self.build_task.build_variants(variants, max_workers=self.project.build_max_workers)
+
+        images = []
+        for slot, variant in zip(slots, variants):
+            build_path = paths.get(variant)
+            if not build_path:
+                slot.result.error = f'Build of version {version_build} failed'
+                logger.error(f'{slot.project.thing_name}: {slot.result.error}')
+                images.append(None)
+                continue
+            slot.project.version_build = version_build
+            slot.image_name = basename(build_path)
+            staged = slot.result.work_dir / 'staged' / f'{slot.image_name}_{version_build}'
+            shutil.copy2(build_path, staged)
+            images.append(staged)
+        return images
+
+    def start_device(self, slot, image):
+        """
+        Copy the initial image into the device working dir and start the device process.
+        """
+        slot.executable = slot.result.work_dir / slot.image_name
+        shutil.copy2(image, slot.executable)
+        slot.run_task = self.run_factory(str(slot.executable), str(slot.result.log_file),
+                                         index_log=slot.project.device_log_index)
+        slot.run_task.add_line_consumer(slot.log_parser.feed)
+        slot.run_task.start()
+        logger.info(f'{slot.project.thing_name}: device started in {slot.result.work_dir}')
+
+    def create_update(self, update, image):
+        """
+        Create the OTA update of one device, tracked by the tracker of the fleet.
+        Runs in the worker pool, one call per device.
+        """
+        slot = update.slot
+        slot.update_counter += 1
+        file_to_upload = f'{slot.executable.name}_{slot.update_counter}'
+        with tracing.span('fleet.create', parent=update.trace_span, thing=slot.project.thing_name):
+            update.task = self.update_factory(file_to_upload, str(image), slot.project, tracker=self.tracker)
+            update.task.clear_pending_jobs()
+            created_at = slot.log_parser.clock()
+            update.ota_update_id = update.task.create_ota_update()
+            slot.log_parser.mark_update_created(created_at)
+        update.rollout = update.task.track_ota_update(update.ota_update_id, slot.project.ota_timeout_sec)
+
+    def finish_update(self, update, status, summary):
+        slot = update.slot
+        if update.task is not None:
+            update.task.close()
+        update.trace_span.set(status=status)
+        update.trace_span.end()
+        slot.result.updates.append({
+            'version': f'{slot.project.version_major}.{slot.project.version_minor}.{update.version_build}',
+            'status': status,
+            'summary': summary,
+            'duration_sec': round(time.perf_counter() - update.start, 3),
+        })
+        logger.info(f'{slot.project.thing_name}: update to build {update.version_build} {status}')
+
+    def update_devices(self, pool, images, version_build):
+        """
+        Roll out a build version to devices and wait for all of their jobs to finish.
+        :param pool: Worker pool creating the updates
+        :param images: List of (slot, staged image)
+        """
+        updates = []
+        for slot, image in images:
+            update = DeviceUpdate(slot, version_build, start=time.perf_counter(), trace_span=tracing.start_span(
+                'fleet.update', parent=self.trace_span, thing=slot.project.thing_name, version_build=version_build))
+            updates.append((update, pool.submit(self.create_update, update, image)))
+
+        for update, created in updates:
+            try:
+                created.result()
+                update_status, summary = update.task.finish_ota_update(update.rollout.result())
+                status = update_status.status
+            except Exception as e:
+                logger.error(f'{update.slot.project.thing_name}: update failed. Err: {e}')
+                status, summary = 'ERROR', str(e)
+            self.finish_update(update, status, summary)
+
+    def start(self, iterations=3):
+        """
+        Run the fleet canary.
+        :param iterations: Number of updates to roll out to every device
+        :return: DeviceResult of every device keyed by thing name
+        """
+        tracing.configure_from_project(self.project)
+        try:
+            with tracing.span('fleet', devices=len(self.devices)) as self.trace_span:
+                return self._start(iterations)
+        finally:
+            tracing.flush()
+
+    def _start(self, iterations):
+        self.slots = [self.prepare_device(identity) for identity in self.devices]
+        version_build = self.project.version_build
+
+        for slot, image in zip(self.slots, self.build_images(self.slots, version_build)):
+            if image is not None:
+                self.start_device(slot, image)
+
+        self.tracker = self.tracker_factory(self.project)
+        with self.tracker, ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for counter in range(iterations):
+                version_build += 1
+                active = [slot for slot in self.slots if slot.run_task is not None and slot.result.passed]
+                if not active:
+                    break
+
+                images = zip(active, self.build_images(active, version_build))
+                self.update_devices(pool, [(slot, image) for slot, image in images if image is not None], version_build)
+
+        self.project.version_build = version_build
+        for slot in self.slots:
+            if slot.run_task is not None:
+                slot.run_task.close()
+            slot.result.device_metrics = slot.log_parser.summary()
+
+        return {slot.result.thing_name: slot.result for slot in self.slots}
+
+
+def parse_device(text):
+    """
+    DeviceIdentity described by text: thing_name,thing_arn,client_cert_path,client_private_key_path
+    """
+    fields = text.split(',')
+    if len(fields) != 4:
+        raise argparse.ArgumentTypeError(f'Expected thing_name,thing_arn,cert_path,key_path, got {text}')
+    return DeviceIdentity(*fields)
+
+
+def load_devices(path):
+    """
+    Devices listed in a JSON file, as a list of objects with the fields of DeviceIdentity.
+    """
+    return [DeviceIdentity(**device) for device in json.loads(Path(path).read_text())]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Roll out new versions to every device of the fleet concurrently')
+    parser.add_argument('--device', type=parse_device, action='append', default=[], metavar='THING,ARN,CERT,KEY',
+                        help='Device to update, may be repeated. Added to fleet_devices of the project')
+    parser.add_argument('--devices', type=load_devices, default=[], metavar='JSON',
+                        help='JSON file listing the devices as objects with the fields of DeviceIdentity')
+    parser.add_argument('--iterations', type=int, default=None, help='Updates rolled out to every device')
+    args = parser.parse_args(argv)
+
+    project = OtaProject()
+    devices = list(project.fleet_devices) + args.devices + args.device
+    if not devices:
+        parser.error('No device to update, set fleet_devices or pass --device or --devices')
+    results = OtaFleetCanary(project, devices=devices).start(args.iterations or project.canary_iterations)
+    for thing_name, result in results.items():
+        logger.info(f'{thing_name}: {"PASS" if result.passed else "FAIL"} {result.updates} {result.error}')
+    return 0 if all(result.passed for result in results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
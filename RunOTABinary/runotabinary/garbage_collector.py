@@ -0,0 +1,234 @@
+# Clean up what the OTA updates of this tool leave behind in AWS IoT: the pending job
+# executions of the thing, the OTA updates and their streams.
+import sys
+import json
+import time
+import argparse
+from datetime import datetime, timezone
+from dataclasses import dataclass, asdict
+from concurrent.futures import ThreadPoolExecutor
+from runotabinary import aws_clients, tracing
+from runotabinary.throttle import TokenBucket
+from runotabinary.configs.config_project import OtaProject
+from runotabinary.logger import logger
+
+OTA_JOB_PREFIX = 'AFR_OTA-'
+PENDING_JOB_STATUSES = ('QUEUED', 'IN_PROGRESS')
+# OTA updates still being created cannot be deleted yet
+BUSY_OTA_UPDATE_STATUSES = ('CREATE_PENDING', 'CREATE_IN_PROGRESS', 'DELETE_IN_PROGRESS')
+CANCEL_COMMENT = 'OTA integration testing cancellation of incomplete job.'
+
+
+def pages(call, items_key, **kwargs):
+    """
+    Iterate over the items of every page of an AWS list call, following nextToken.
+    """
+    while True:
+        response = call(**kwargs)
+        for item in response.get(items_key, []):
+            yield item
+        token = response.get('nextToken')
+        if not token:
+            return
+        kwargs['nextToken'] = token
+
+
+def age_sec(timestamp, now=None):
+    """
+    Age of a datetime or epoch timestamp returned by AWS, 0 when it is missing.
+    """
+    if timestamp is None:
+        return 0.0
+    if isinstance(timestamp, datetime):
+        timestamp = timestamp.timestamp() if timestamp.tzinfo else timestamp.replace(tzinfo=timezone.utc).timestamp()
+    return (now or time.time()) - timestamp
+
+
+@dataclass
+class CollectionStats:
+    """
+    Counters of the collection of one kind of resource.
+    """
+
+    kind: str
+    found: int = 0
+    deleted: int = 0
+    skipped: int = 0
+    failed: int = 0
+    seconds: float = 0.0
+
+    def as_dict(self):
+        stats = asdict(self)
+        stats['seconds'] = round(self.seconds, 3)
+        return stats
+
+
+class GarbageCollector:
+    """
+    Cancel the pending OTA jobs of the thing, and delete the OTA updates and streams created
+    by this tool, i.e. whose ID starts with the ota_update_id_prefix of the project.
+
+    Every list call is paged through. Cancels and deletes run on max_workers threads, all
+    of them sharing a rate limit of rate_per_sec calls. Failures are counted, not raised.
+    """
+
+    def __init__(self, ota_project, rate_per_sec=None, max_workers=None, min_age_sec=None):
+        self.project = ota_project
+        aws_clients.configure_from_project(self.project)
+        self.limiter = TokenBucket(rate_per_sec if rate_per_sec is not None else self.project.gc_rate_per_sec,
+                                   burst=max_workers or self.project.gc_max_workers)
+        self.max_workers = max_workers or self.project.gc_max_workers
+        self.min_age_sec = min_age_sec if min_age_sec is not None else self.project.gc_min_age_sec
+
+    @property
+    def _iot(self):
+        return aws_clients.get_client('iot')
+
+    @property
+    def prefix(self):
+        return self.project.ota_update_id_prefix
+
+    def pending_jobs(self, min_age_sec=0):
+        """
+        IDs of the OTA jobs queued or in progress on the thing, None if they cannot be listed.
+        """
+        job_ids = []
+        try:
+            for status in PENDING_JOB_STATUSES:
+                for execution in pages(self._iot.list_job_executions_for_thing, 'executionSummaries',
+                                       thingName=self.project.thing_name, status=status, maxResults=100):
+                    queued_at = execution.get('jobExecutionSummary', {}).get('queuedAt')
+                    if execution['jobId'].startswith(OTA_JOB_PREFIX) and age_sec(queued_at) >= min_age_sec:
+                        job_ids.append(execution['jobId'])
+        except Exception as e:
+            logger.warning(f"aws iot list_job_executions_for_thing failed. Err: {e}")
+            return None
+        return list(dict.fromkeys(job_ids))
+
+    def _own_ota_updates(self):
+        return [update for update in pages(self._iot.list_ota_updates, 'otaUpdates', maxResults=250)
+                if update['otaUpdateId'].startswith(self.prefix)]
+
+    def ota_updates(self, min_age_sec=0):
+        """
+        :return: (IDs of the OTA updates of this tool which can be deleted, number of those being created or deleted)
+        """
+        ota_update_ids = []
+        busy = 0
+        for update in self._own_ota_updates():
+            if age_sec(update.get('creationDate')) < min_age_sec:
+                continue
+            if update.get('otaUpdateStatus') in BUSY_OTA_UPDATE_STATUSES:
+                busy += 1
+            else:
+                ota_update_ids.append(update['otaUpdateId'])
+        return ota_update_ids, busy
+
+    def streams(self):
+        """
+        IDs of the streams of this tool whose OTA update no longer exists.
+        """
+        alive = {f'{OTA_JOB_PREFIX}{update["otaUpdateId"]}' for update in self._own_ota_updates()}
+        return [stream['streamId'] for stream in pages(self._iot.list_streams, 'streams', maxResults=250)
+                if stream['streamId'].startswith(f'{OTA_JOB_PREFIX}{self.prefix}') and stream['streamId'] not in alive]
+
+    def _run(self, kind, items, call):
+        """
+        Call call with every item, concurrently and under the rate limit.
+        """
+        stats = CollectionStats(kind, found=len(items))
+        start = time.monotonic()
+
+        def collect(item):
+            self.limiter.acquire()
+            try:
+                call(item)
+                return True
+            except Exception as e:
+                logger.error(f"Unable to delete {kind} {item}: {e}")
+                return False
+
+        with tracing.span(f'gc.{kind}', found=len(items)) as gc_span:
+            if items:
+                with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f'gc-{kind}') as pool:
+                    results = list(pool.map(collect, items))
+                stats.deleted = sum(results)
+                stats.failed = len(results) - stats.deleted
+            gc_span.set(deleted=stats.deleted, failed=stats.failed)
+        stats.seconds = time.monotonic() - start
+        return stats
+
+    def cancel_jobs(self, job_ids):
+        return self._run('jobs', job_ids, lambda job_id: self._iot.cancel_job(
+            jobId=job_id, comment=CANCEL_COMMENT, force=True))
+
+    def delete_ota_updates(self, ota_update_ids):
+        return self._run('ota_updates', ota_update_ids, lambda ota_update_id: self._iot.delete_ota_update(
+            otaUpdateId=ota_update_id, deleteStream=True, forceDeleteAWSJob=True))
+
+    def delete_streams(self, stream_ids):
+        return self._run('streams', stream_ids, lambda stream_id: self._iot.delete_stream(streamId=stream_id))
+
+    def clear_pending_jobs(self):
+        """
+        Cancel every pending OTA job of the thing, whatever its age.
+        """
+        job_ids = self.pending_jobs()
+        stats = self.cancel_jobs(job_ids or [])
+        if job_ids is None:
+            stats.failed += 1
+        return stats
+
+    def collect(self):
+        """
+        Cancel the pending jobs, then delete the OTA updates along with their jobs and
+        streams, then the streams left behind by updates which no longer exist. Only jobs
+        and updates older than min_age_sec are touched, so that the updates of a canary
+        still running are left alone.
+        :return: List of CollectionStats, one per kind of resource
+        """
+        with tracing.span('gc', thing=self.project.thing_name, prefix=self.prefix):
+            job_ids = self.pending_jobs(self.min_age_sec)
+            jobs = self.cancel_jobs(job_ids or [])
+            if job_ids is None:
+                jobs.failed += 1
+
+            ota_update_ids, busy = self.ota_updates(self.min_age_sec)
+            updates = self.delete_ota_updates(ota_update_ids)
+            updates.skipped = busy
+            updates.found += busy
+
+            # Streams of the updates left, e.g. the young ones, stay with them
+            streams = self.delete_streams(self.streams())
+        report = [jobs, updates, streams]
+        for stats in report:
+            logger.info(f'GC {stats.kind}: {stats.as_dict()}')
+        return report
+
+
+def format_report(report):
+    lines = [f'{"kind":<12} {"found":>6} {"deleted":>8} {"skipped":>8} {"failed":>7} {"seconds":>8}']
+    for stats in report:
+        lines.append(f'{stats.kind:<12} {stats.found:>6} {stats.deleted:>8} {stats.skipped:>8} {stats.failed:>7} {stats.seconds:>8.3f}')
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Delete the OTA jobs, updates and streams left behind by the canaries')
+    parser.add_argument('--min-age-sec', type=float, default=None, help='Only touch resources older than this')
+    parser.add_argument('--rate', type=float, default=None, help='Maximum number of cancel and delete calls per second')
+    parser.add_argument('--workers', type=int, default=None, help='Number of concurrent cancel and delete calls')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args(argv)
+
+    collector = GarbageCollector(OtaProject(), rate_per_sec=args.rate, max_workers=args.workers, min_age_sec=args.min_age_sec)
+    report = collector.collect()
+    if args.json:
+        print(json.dumps([stats.as_dict() for stats in report], indent=2))
+    else:
+        print(format_report(report))
+    return 1 if any(stats.failed for stats in report) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,77 @@
+import ssl
+import sys
 import time
-import paho.mqtt.client as mqtt
+import socket
+import argparse
 from runotabinary.configs.config_project import OtaProject
 from runotabinary.logger import logger
-from pathlib import Path
+from runotabinary.mqtt_packets import CONNACK, DISCONNECT, connect_packet, packet
+
+
+class TakeoverConnection:
+    """
+    Connection to the broker of the device, opened ahead of time, which takes over the
+    session of the device: the broker drops the connection of a client when another one
+    connects with its client ID.
+
+    open() does the slow part, the TCP and TLS handshakes, and fire() only writes the
+    CONNECT packet, so that the interrupt lands within a millisecond of the call.
+    """
+
+    def __init__(self, endpoint, port, client_id, ssl_context=None, timeout=10):
+        self.endpoint = endpoint
+        self.port = port
+        self.client_id = client_id
+        self.ssl_context = ssl_context
+        self.timeout = timeout
+        self.opened_at = None
+        self._packet = connect_packet(client_id)
+        self._socket = None
+
+    def open(self):
+        sock = socket.create_connection((self.endpoint, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.ssl_context is not None:
+            sock = self.ssl_context.wrap_socket(sock, server_hostname=self.endpoint)
+        self._socket = sock
+        self.opened_at = time.monotonic()
+        return self
+
+    def fire(self):
+        """
+        Send the CONNECT packet.
+        :return: perf_counter() once it is sent
+        """
+        self._socket.sendall(self._packet)
+        return time.perf_counter()
+
+    def wait_ack(self, timeout=None):
+        """
+        Wait for the CONNACK of the broker, which has then dropped the device.
+        :return: perf_counter() at the CONNACK, None if the connection was refused
+        """
+        self._socket.settimeout(timeout if timeout is not None else self.timeout)
+        data = b''
+        while len(data) < 4:
+            chunk = self._socket.recv(4 - len(data))
+            if not chunk:
+                raise ConnectionError('Broker closed the connection')
+            data += chunk
+        acked_at = time.perf_counter()
+        if data[0] >> 4 != CONNACK or data[3] != 0:
+            logger.error(f'Connection of {self.client_id} refused, return code {data[3]}')
+            return None
+        return acked_at
+
+    def close(self):
+        if self._socket is None:
+            return
+        try:
+            self._socket.sendall(packet(DISCONNECT, 0, b''))
+        except OSError:
+            pass
+        self._socket.close()
+        self._socket = None
 
 
 class InterruptMQTTConnection:
@@ -10,64 +79,69 @@ class InterruptMQTTConnection:
     def __init__(self, otaProject):
         self.project = otaProject
         self.connected_to_iot = False
+        self._ssl_context = None
 
-    def get_thing_certificate(self):
-        cert = open(self.project.client_cert_path, 'r')
-        return cert.read() 
+    def ssl_context(self):
+        """
+        TLS context with the credentials of the thing, built once.
+        """
+        if self._ssl_context is None and self.project.interrupt_tls:
+            context = ssl.create_default_context(cafile=self.project.mqtt_ca_path or None)
+            context.load_cert_chain(certfile=self.project.client_cert_path, keyfile=self.project.client_private_key_path)
+            self._ssl_context = context
+        return self._ssl_context
 
-    def get_thing_private_key(self):
-        cert = open(self.project.client_private_key_path, 'r')
-        return cert.read()
+    def takeover_connection(self):
+        """
+        Unopened TakeoverConnection of the device of the project.
+        """
+        return TakeoverConnection(self.project.aws_iot_endpoint, self.project.interrupt_port,
+                                  self.project.thing_name, self.ssl_context())
 
-    def interrupt_mqtt_connection(self):
+    def interrupt_mqtt_connection(self, timeout=10):
         """
         Create a dummy device copy to connect to IoT which will disconnect the
         actual device. Used for interrupting device connection to cloud.
         :return: If the operation is successful it returns PASS else FAIL
         """
-        def on_connect(client, userdata, flags, rc):
-            """ Callback function to notify that the connection is successful
-            """
-            logger.info("Connected to IoT core. Device should now disconnect then reconnect.")
-            self.connected_to_iot = True
-            mqtt_client.disconnect()
-            mqtt_client.loop_stop()
-
-        # Create temporary files to store the certificates. This is a limitation of the
-        # python ssl module since we cannot pass the certificates directly.
-
-        certfile = Path("tmp_cert.pem")
-        keyfile = Path("tmp_key.pem")
-        certfile.write_text(self.get_thing_certificate())
-        keyfile.write_text(self.get_thing_private_key())
-
-        # Initialize the paho mqtt client
-        mqtt_client = mqtt.Client(client_id=self.project.thing_name)
-        mqtt_client.tls_set(certfile=certfile, keyfile=keyfile)
-        mqtt_client.on_connect = on_connect
-        mqtt_client.connect(self.project.aws_iot_endpoint, 8883, 60)
-        mqtt_client.loop_start()
-
-        # Wait up to 10 second until we connect to the IoT core
-        timeout = time.perf_counter() + 10
-        while self.connected_to_iot != True and time.perf_counter() < timeout:
-            time.sleep(1)
-
-        # Delete the temporary credential files.
-        certfile.unlink()
-        keyfile.unlink()
+        connection = self.takeover_connection()
+        try:
+            connection.open()
+            connection.fire()
+            self.connected_to_iot = connection.wait_ack(timeout) is not None
+        except OSError as e:
+            logger.error(f"Unable to connect to {self.project.aws_iot_endpoint}: {e}")
+            self.connected_to_iot = False
+        finally:
+            connection.close()
 
         # Notify the connection status
         if self.connected_to_iot:
+            logger.info("Connected to IoT core. Device should now disconnect then reconnect.")
             self.connected_to_iot = False
             return 1
         else:
             return 2
 
-def main():
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Interrupt the MQTT connection of the device')
+    parser.add_argument('--at', type=float, action='append',
+                        help='Seconds from now at which to interrupt, may be repeated. Once right away by default')
+    args = parser.parse_args(argv)
+
     task = InterruptMQTTConnection(OtaProject())
-    task.interrupt_mqtt_connection() 
-    
+    if not args.at:
+        return 0 if task.interrupt_mqtt_connection() == 1 else 1
+
+    from runotabinary.fault_injection import FaultInjector, TimeTrigger, format_report
+    injector = FaultInjector(task.takeover_connection, [TimeTrigger(offset) for offset in args.at]).start()
+    injector.start_update()
+    time.sleep(max(args.at) + 1)
+    injector.stop()
+    print(format_report(injector.injections))
+    return 0 if all(injection.acked_at for injection in injector.injections) else 1
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
@@ -0,0 +1,165 @@
+import os
+import json
+import threading
+from runotabinary.logger import logger
+
+NOTIFY_TOPIC = '$aws/things/{thing}/jobs/notify'
+UPDATE_ACCEPTED_TOPIC = '$aws/things/{thing}/jobs/+/update/accepted'
+
+
+class JobsObserver:
+    """
+    Follow the job executions of things through the AWS IoT Jobs MQTT topics.
+
+    A single persistent connection subscribes, per watched thing, to the jobs/notify topic
+    and to the update/accepted topic of its job executions. Listeners are called with
+    (thing_name, job_id, status, reason) as soon as the device reports a new status. When a
+    job leaves the pending list of jobs/notify without its final status having been seen,
+    listeners are called with a None status so that they check the job right away.
+    """
+
+    def __init__(self, endpoint, port=8883, client_id='runota-jobs-observer', certfile=None, keyfile=None,
+                 use_tls=True, keepalive=60, ca_certs=None):
+        self.endpoint = endpoint
+        self.port = port
+        self.client_id = client_id
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.use_tls = use_tls
+        self.keepalive = keepalive
+        self.ca_certs = ca_certs
+        self._listeners = []
+        self._things = set()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._connected = threading.Event()
+        self._client = None
+
+    @classmethod
+    def from_project(cls, project):
+        return cls(
+            project.aws_iot_endpoint,
+            port=project.jobs_observer_port,
+            client_id=project.jobs_observer_client_id or f'runota-jobs-observer-{os.getpid()}',
+            certfile=project.client_cert_path,
+            keyfile=project.client_private_key_path,
+            use_tls=project.jobs_observer_tls,
+            ca_certs=project.mqtt_ca_path or None,
+        )
+
+    @property
+    def connected(self):
+        return self._connected.is_set()
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def start(self, timeout=10):
+        """
+        Connect to the broker and wait up to timeout seconds for the connection.
+        :return: True if connected
+        """
+        import paho.mqtt.client as mqtt
+
+        self._client = mqtt.Client(client_id=self.client_id)
+        if self.use_tls:
+            self._client.tls_set(ca_certs=self.ca_certs, certfile=self.certfile, keyfile=self.keyfile)
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_message = self._on_message
+        self._client.connect_async(self.endpoint, self.port, self.keepalive)
+        self._client.loop_start()
+        if not self._connected.wait(timeout):
+            logger.warning(f"Jobs observer could not connect to {self.endpoint}:{self.port}")
+        return self.connected
+
+    def stop(self):
+        if self._client is not None:
+            self._client.disconnect()
+            self._client.loop_stop()
+            self._client = None
+        self._connected.clear()
+
+    def watch(self, thing_name):
+        """
+        Subscribe to the job topics of a thing.
+        """
+        with self._lock:
+            if thing_name in self._things:
+                return
+            self._things.add(thing_name)
+        if self.connected:
+            self._subscribe(thing_name)
+
+    def _subscribe(self, thing_name):
+        self._client.subscribe([
+            (NOTIFY_TOPIC.format(thing=thing_name), 1),
+            (UPDATE_ACCEPTED_TOPIC.format(thing=thing_name), 1),
+        ])
+        logger.debug(f"Watching the jobs of {thing_name}")
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            logger.error(f"Jobs observer connection refused, rc={rc}")
+            return
+        self._connected.set()
+        with self._lock:
+            things = list(self._things)
+        # Subscriptions do not survive a reconnection with a clean session
+        for thing_name in things:
+            self._subscribe(thing_name)
+
+    def _on_disconnect(self, client, userdata, rc):
+        self._connected.clear()
+        if rc != 0:
+            logger.warning(f"Jobs observer disconnected unexpectedly, rc={rc}")
+
+    def _on_message(self, client, userdata, message):
+        try:
+            payload = json.loads(message.payload.decode() or '{}')
+        except ValueError:
+            logger.warning(f"Ignoring malformed message on {message.topic}")
+            return
+        levels = message.topic.split('/')
+        if len(levels) < 4:
+            return
+        thing_name = levels[2]
+        if levels[-2:] == ['update', 'accepted']:
+            state = payload.get('executionState', {})
+            reason = state.get('statusDetails', {}).get('reason', '')
+            self._notify(thing_name, levels[4], state.get('status'), reason)
+        elif levels[-1] == 'notify':
+            jobs = payload.get('jobs', {})
+            pending = {job['jobId'] for summaries in jobs.values() for job in summaries}
+            with self._lock:
+                finished = self._pending.get(thing_name, set()) - pending
+                self._pending[thing_name] = pending
+            for job_id in finished:
+                self._notify(thing_name, job_id, None, '')
+
+    def _notify(self, thing_name, job_id, status, reason):
+        logger.debug(f"Jobs observer: {thing_name} {job_id} {status}")
+        for listener in self._listeners:
+            try:
+                listener(thing_name, job_id, status, reason)
+            except Exception as e:
+                logger.error(f"Jobs observer listener failed: {e}")
+
+
+_shared_observers = {}
+_shared_lock = threading.Lock()
+
+
+def shared_observer(project):
+    """
+    The connected observer of the process for the endpoint, port and client ID of project.
+    A single connection serves every thing of the process, e.g. the devices of a fleet,
+    with the credentials of the project which opened it.
+    """
+    observer = JobsObserver.from_project(project)
+    key = (observer.endpoint, observer.port, observer.client_id)
+    with _shared_lock:
+        if key not in _shared_observers:
+            observer.start()
+            _shared_observers[key] = observer
+        return _shared_observers[key]
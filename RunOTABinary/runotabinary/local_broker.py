@@ -0,0 +1,220 @@
+import socket
+import struct
+import threading
+import socketserver
+from runotabinary.logger import logger
+from runotabinary.mqtt_packets import (CONNECT, CONNACK, PUBLISH, PUBACK, SUBSCRIBE, SUBACK, UNSUBSCRIBE,
+                                       UNSUBACK, PINGREQ, PINGRESP, DISCONNECT, encode_string, packet)
+
+def topic_matches(topic_filter, topic):
+    """
+    MQTT topic filter matching with the + and # wildcards.
+    """
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for index, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class _Session(socketserver.BaseRequestHandler):
+    """
+    One connected client: reads its packets and answers them.
+    """
+
+    def setup(self):
+        self.subscriptions = []
+        self.client_id = None
+        self.send_lock = threading.Lock()
+
+    def send(self, data):
+        with self.send_lock:
+            self.request.sendall(data)
+
+    def _read_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError('Client closed the connection')
+            data += chunk
+        return data
+
+    def _read_packet(self):
+        header = self._read_exact(1)[0]
+        multiplier, length = 1, 0
+        while True:
+            byte = self._read_exact(1)[0]
+            length += (byte & 0x7f) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header >> 4, header & 0x0f, self._read_exact(length) if length else b''
+
+    def handle(self):
+        broker = self.server.broker
+        try:
+            if self.server.ssl_context is not None:
+                self.request.do_handshake()
+            while True:
+                packet_type, flags, body = self._read_packet()
+                if packet_type == CONNECT:
+                    protocol_length = struct.unpack('!H', body[:2])[0]
+                    offset = 2 + protocol_length + 4
+                    client_id_length = struct.unpack('!H', body[offset:offset + 2])[0]
+                    self.client_id = body[offset + 2:offset + 2 + client_id_length].decode()
+                    broker._add_session(self)
+                    self.send(packet(CONNACK, 0, b'\x00\x00'))
+                elif packet_type == PUBLISH:
+                    qos = (flags >> 1) & 0x03
+                    topic_length = struct.unpack('!H', body[:2])[0]
+                    topic = body[2:2 + topic_length].decode()
+                    offset = 2 + topic_length
+                    if qos:
+                        packet_id = body[offset:offset + 2]
+                        offset += 2
+                        self.send(packet(PUBACK, 0, packet_id))
+                    broker.publish(topic, body[offset:], sender=self)
+                elif packet_type == SUBSCRIBE:
+                    packet_id, offset, granted = body[:2], 2, bytearray()
+                    while offset < len(body):
+                        filter_length = struct.unpack('!H', body[offset:offset + 2])[0]
+                        self.subscriptions.append(body[offset + 2:offset + 2 + filter_length].decode())
+                        offset += 2 + filter_length + 1
+                        granted.append(0)
+                    self.send(packet(SUBACK, 0, packet_id + bytes(granted)))
+                elif packet_type == UNSUBSCRIBE:
+                    packet_id, offset = body[:2], 2
+                    while offset < len(body):
+                        filter_length = struct.unpack('!H', body[offset:offset + 2])[0]
+                        topic_filter = body[offset + 2:offset + 2 + filter_length].decode()
+                        if topic_filter in self.subscriptions:
+                            self.subscriptions.remove(topic_filter)
+                        offset += 2 + filter_length
+                    self.send(packet(UNSUBACK, 0, packet_id))
+                elif packet_type == PINGREQ:
+                    self.send(packet(PINGRESP, 0, b''))
+                elif packet_type == DISCONNECT:
+                    return
+        except (ConnectionError, OSError):
+            return
+        finally:
+            broker._remove_session(self)
+
+    def deliver(self, topic, payload):
+        for topic_filter in self.subscriptions:
+            if topic_matches(topic_filter, topic):
+                self.send(packet(PUBLISH, 0, encode_string(topic) + payload))
+                return
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    ssl_context = None
+
+    def get_request(self):
+        sock, address = super().get_request()
+        if self.ssl_context is not None:
+            # The handshake runs on the thread of the session, not on the one accepting connections
+            sock = self.ssl_context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+        return sock, address
+
+
+class LocalMqttBroker:
+    """
+    Minimal MQTT 3.1.1 broker for local runs and tests, without authentication. The
+    connections are over TLS when an ssl_context of the server side is given.
+
+    Messages are delivered at QoS 0. Hooks registered with on_publish see every message
+    published by the clients, and publish() injects messages from the broker side.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, ssl_context=None):
+        self._server = _Server((host, port), _Session)
+        self._server.broker = self
+        self._server.ssl_context = ssl_context
+        self._sessions = []
+        self._hooks = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='local-mqtt-broker', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        with self._lock:
+            sessions = list(self._sessions)
+        for session in sessions:
+            try:
+                session.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def on_publish(self, hook):
+        """
+        Call hook(topic, payload, client_id) for every message published by a client.
+        """
+        self._hooks.append(hook)
+
+    def disconnect(self, client_id):
+        """
+        Drop the connection of a client, as the cloud does when another client connects with its id.
+        """
+        with self._lock:
+            sessions = [session for session in self._sessions if session.client_id == client_id]
+        for session in sessions:
+            session.request.shutdown(socket.SHUT_RDWR)
+
+    def publish(self, topic, payload, sender=None):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        with self._lock:
+            sessions = list(self._sessions)
+        for session in sessions:
+            try:
+                session.deliver(topic, payload)
+            except OSError as e:
+                logger.debug(f"Unable to deliver {topic} to {session.client_id}: {e}")
+        if sender is not None:
+            for hook in self._hooks:
+                hook(topic, payload, sender.client_id)
+
+    def _add_session(self, session):
+        # Like AWS IoT, a new connection with the id of a connected client takes over
+        with self._lock:
+            previous = [other for other in self._sessions if other.client_id == session.client_id]
+            self._sessions.append(session)
+        for other in previous:
+            try:
+                other.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _remove_session(self, session):
+        with self._lock:
+            if session in self._sessions:
+                self._sessions.remove(session)
@@ -0,0 +1,408 @@
+# Local stand-in of the OTA cloud, selected by local_cloud_dir in the project: the fake S3,
+# IoT and ACM clients of fake_aws, slowed down by the configured latencies, and an MQTT
+# endpoint serving the AWS IoT Jobs and MQTT file stream topics to a device. CreateUpdate,
+# AWSS3Bucket and BuildBinary then run the whole update loop without network access.
+import ssl
+import json
+import time
+import base64
+import datetime
+import threading
+from pathlib import Path
+from runotabinary import aws_clients, cbor
+from runotabinary.fake_aws import FakeAwsBackend, latency
+from runotabinary.local_broker import LocalMqttBroker
+from runotabinary.logger import logger
+
+THING_TOPIC = '$aws/things/{thing}/'
+# Payload formats of the MQTT file stream topics
+STREAM_FORMATS = ('json', 'cbor')
+# Statuses of the job executions still pending on the device
+PENDING_STATUSES = ('QUEUED', 'IN_PROGRESS')
+
+
+class LocalCredentials:
+    """
+    Keys and certificates of the local cloud, created once under directory and reused: a CA,
+    the TLS certificate of the broker for 127.0.0.1 and localhost issued by it, and the code
+    signing certificate of the dummy signer, which signs the images like AWS Signer would.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.ca_path = self.directory / 'ca.crt'
+        self.server_cert_path = self.directory / 'server.crt'
+        self.server_key_path = self.directory / 'server.key'
+        self.signer_cert_path = self.directory / 'signer.crt'
+        self.signer_key_path = self.directory / 'signer.key'
+        self._signatures = {}
+        self._signer_key = None
+        self._lock = threading.Lock()
+
+    def create(self):
+        """
+        Create the keys and certificates missing from the directory.
+        :return: self
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        ca_key_path = self.directory / 'ca.key'
+        if not self.ca_path.exists() or not ca_key_path.exists():
+            self._issue('runota local CA', ca_key_path, self.ca_path, None, ca=True)
+        ca = (self._load_key(ca_key_path), self._load_certificate(self.ca_path))
+        if not self.server_cert_path.exists() or not self.server_key_path.exists():
+            self._issue('127.0.0.1', self.server_key_path, self.server_cert_path, ca, hosts=('127.0.0.1', 'localhost'))
+        if not self.signer_cert_path.exists() or not self.signer_key_path.exists():
+            self._issue('runota local signer', self.signer_key_path, self.signer_cert_path, ca)
+        return self
+
+    @staticmethod
+    def _load_key(path):
+        from cryptography.hazmat.primitives import serialization
+
+        return serialization.load_pem_private_key(path.read_bytes(), password=None)
+
+    @staticmethod
+    def _load_certificate(path):
+        from cryptography import x509
+
+        return x509.load_pem_x509_certificate(path.read_bytes())
+
+    @staticmethod
+    def _issue(common_name, key_path, cert_path, issuer, ca=False, hosts=()):
+        """
+        Write a P-256 key and its certificate, self-signed when issuer is None, else
+        signed by the (key, certificate) of the issuer.
+        """
+        import ipaddress
+        from cryptography import x509
+        from cryptography.x509.oid import NameOID
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec
+
+        key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+        issuer_key, issuer_name = (key, name) if issuer is None else (issuer[0], issuer[1].subject)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        builder = (x509.CertificateBuilder()
+                   .subject_name(name)
+                   .issuer_name(issuer_name)
+                   .public_key(key.public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now - datetime.timedelta(days=1))
+                   .not_valid_after(now + datetime.timedelta(days=3650))
+                   .add_extension(x509.BasicConstraints(ca=ca, path_length=None), critical=True))
+        if hosts:
+            names = []
+            for host in hosts:
+                try:
+                    names.append(x509.IPAddress(ipaddress.ip_address(host)))
+                except ValueError:
+                    names.append(x509.DNSName(host))
+            builder = builder.add_extension(x509.SubjectAlternativeName(names), critical=False)
+        certificate = builder.sign(issuer_key, hashes.SHA256())
+        key_path.write_bytes(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                               serialization.NoEncryption()))
+        key_path.chmod(0o600)
+        cert_path.write_bytes(certificate.public_bytes(serialization.Encoding.PEM))
+
+    @property
+    def signer_certificate(self):
+        return self.signer_cert_path.read_text()
+
+    def server_context(self):
+        """
+        TLS context of the broker, without client authentication like the rest of the local cloud.
+        """
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile=str(self.server_cert_path), keyfile=str(self.server_key_path))
+        return context
+
+    def sign(self, path):
+        """
+        :return: The base64 DER ECDSA-SHA256 signature of the file at path by the signer key,
+                 as given in the sig-sha256-ecdsa field of the job document
+        """
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import ec
+
+        stat = Path(path).stat()
+        cache_key = (str(path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            if cache_key in self._signatures:
+                return self._signatures[cache_key]
+            if self._signer_key is None:
+                self._signer_key = self._load_key(self.signer_key_path)
+            key = self._signer_key
+        signature = base64.b64encode(key.sign(Path(path).read_bytes(), ec.ECDSA(hashes.SHA256()))).decode()
+        with self._lock:
+            self._signatures[cache_key] = signature
+        return signature
+
+
+class LocalOtaService:
+    """
+    AWS IoT Jobs and MQTT file streams of the fake IoT client, served on a LocalMqttBroker.
+
+    A device gets its next job on jobs/$next/get and jobs/notify-next, with an AFR OTA job
+    document whose stream is the job ID, and reports its status on jobs/<job id>/update.
+    The status is written where the fake IoT client reads it, and acknowledged on
+    update/accepted and jobs/notify, which the JobsObserver follows. The image is read
+    from the S3 object in the blocks requested on streams/<stream id>/get/json or get/cbor,
+    and published on data/json or data/cbor. The files of the job document are signed with
+    sign(path), which returns the sig-sha256-ecdsa field, empty without a signer.
+
+    The 'jobs' and 'streams' latencies delay the answers to the device, see fake_aws.latency().
+    """
+
+    def __init__(self, broker, iot, latencies=None, sign=None):
+        self.broker = broker
+        self.iot = iot
+        self.latencies = dict(latencies or {})
+        self.sign = sign
+        self._versions = {}
+        self._lock = threading.Lock()
+        broker.on_publish(self._on_publish)
+        iot.add_listener(self._on_job_changed)
+
+    def _publish(self, thing_name, suffix, value):
+        self.broker.publish(THING_TOPIC.format(thing=thing_name) + suffix, json.dumps(value))
+
+    def _delay(self, service, operation):
+        delay = latency(self.latencies, service, operation)
+        if delay:
+            time.sleep(delay)
+
+    def execution(self, thing_name, job_id, status):
+        """
+        The job execution as the Jobs API returns it, None if the job has no document.
+        """
+        document = self.iot.job_document(thing_name, job_id)
+        if document is None:
+            return None
+        files = [{'filepath': entry['fileName'], 'filesize': entry['fileSize'], 'fileid': index,
+                  'certfile': 'ecdsa-sha256-signer.crt.pem',
+                  'sig-sha256-ecdsa': self.sign(entry['filePath']) if self.sign else ''}
+                 for index, entry in enumerate(document['files'])]
+        with self._lock:
+            version = self._versions.get((thing_name, job_id), 1)
+        return {
+            'jobId': job_id,
+            'thingName': thing_name,
+            'status': status,
+            'versionNumber': version,
+            'executionNumber': 1,
+            'jobDocument': {'afr_ota': {'protocols': ['MQTT'], 'streamname': job_id, 'files': files}},
+        }
+
+    def next_execution(self, thing_name):
+        for job_id, status in self.iot.pending_jobs(thing_name):
+            execution = self.execution(thing_name, job_id, status)
+            if execution is not None:
+                return execution
+        return None
+
+    def _on_job_changed(self, thing_name, job_id):
+        self._notify(thing_name)
+
+    def _notify(self, thing_name):
+        pending = self.iot.pending_jobs(thing_name)
+        jobs = {}
+        for job_id, status in pending:
+            jobs.setdefault(status, []).append({'jobId': job_id, 'executionNumber': 1})
+        now = int(time.time())
+        self._publish(thing_name, 'jobs/notify', {'timestamp': now, 'jobs': jobs})
+        execution = self.next_execution(thing_name)
+        self._publish(thing_name, 'jobs/notify-next', dict({'timestamp': now}, **({'execution': execution} if execution else {})))
+
+    def _on_publish(self, topic, payload, client_id):
+        levels = topic.split('/')
+        if len(levels) < 5 or levels[:2] != ['$aws', 'things']:
+            return
+        thing_name, api = levels[2], levels[3]
+        stream_format = levels[6] if api == 'streams' and levels[5:6] == ['get'] and len(levels) == 7 else None
+        if api == 'streams' and stream_format not in STREAM_FORMATS:
+            return
+        try:
+            if stream_format == 'cbor':
+                request = cbor.decode(payload) if payload else {}
+            else:
+                request = json.loads(payload.decode() or '{}')
+            if not isinstance(request, dict):
+                raise ValueError('not a map')
+        except (ValueError, UnicodeDecodeError):
+            logger.warning(f'Local cloud: ignoring malformed message on {topic}')
+            return
+        try:
+            if api == 'jobs':
+                self._on_jobs_request(thing_name, levels[4:], request)
+            elif api == 'streams':
+                self._on_stream_request(thing_name, levels[4], request, stream_format)
+        except Exception as e:
+            logger.error(f'Local cloud: request on {topic} failed: {e}')
+
+    def _on_jobs_request(self, thing_name, levels, request):
+        token = request.get('clientToken')
+        response = {'timestamp': int(time.time()), **({'clientToken': token} if token else {})}
+        if levels == ['$next', 'get']:
+            self._delay('jobs', 'get_next')
+            execution = self.next_execution(thing_name)
+            self._publish(thing_name, 'jobs/$next/get/accepted', dict(response, **({'execution': execution} if execution else {})))
+        elif levels == ['get']:
+            self._delay('jobs', 'get_pending')
+            pending = self.iot.pending_jobs(thing_name)
+            self._publish(thing_name, 'jobs/get/accepted', dict(
+                response,
+                inProgressJobs=[{'jobId': job_id} for job_id, status in pending if status == 'IN_PROGRESS'],
+                queuedJobs=[{'jobId': job_id} for job_id, status in pending if status == 'QUEUED'],
+            ))
+        elif len(levels) == 2 and levels[1] == 'update':
+            self._delay('jobs', 'update')
+            job_id = levels[0]
+            if self.iot.job_document(thing_name, job_id) is None:
+                self._publish(thing_name, f'jobs/{job_id}/update/rejected',
+                              dict(response, code='ResourceNotFound', message=f'Job {job_id} not found'))
+                return
+            status = request.get('status', 'IN_PROGRESS')
+            details = request.get('statusDetails', {})
+            self.iot.report(thing_name, job_id, status, details.get('reason', ''))
+            with self._lock:
+                version = self._versions.get((thing_name, job_id), 1) + 1
+                self._versions[(thing_name, job_id)] = version
+            self._publish(thing_name, f'jobs/{job_id}/update/accepted', dict(
+                response, executionState={'status': status, 'statusDetails': details, 'versionNumber': version}))
+            if status not in PENDING_STATUSES:
+                self._notify(thing_name)
+
+    @staticmethod
+    def _requested_blocks(request):
+        """
+        Indices of the blocks of a GetStream request: the bits set in the bitmap b, the
+        least significant bit of its first byte being block o, else the n blocks from o.
+        """
+        offset, count = request.get('o', 0), request.get('n', 1)
+        bitmap = request.get('b')
+        if isinstance(bitmap, str):
+            bitmap = base64.b64decode(bitmap)
+        if not bitmap:
+            return list(range(offset, offset + count))
+        blocks = [offset + bit for bit in range(len(bitmap) * 8) if bitmap[bit // 8] & (1 << bit % 8)]
+        return blocks[:count] if 'n' in request else blocks
+
+    def _publish_stream(self, thing_name, stream_id, kind, stream_format, value):
+        topic = THING_TOPIC.format(thing=thing_name) + f'streams/{stream_id}/{kind}/{stream_format}'
+        self.broker.publish(topic, cbor.encode(value) if stream_format == 'cbor' else json.dumps(value))
+
+    def _on_stream_request(self, thing_name, stream_id, request, stream_format='json'):
+        """
+        Publish the blocks of a GetStream request: c client token, f file ID, l block size,
+        o offset of the first block, n number of blocks and b bitmap of the blocks, in
+        stream_format. The payload p of a block is base64 in JSON and a byte string in CBOR.
+        """
+        self._delay('streams', 'get')
+        token = request.get('c', '')
+        document = self.iot.job_document(thing_name, stream_id)
+        file_id = request.get('f', 0)
+        block_size = request.get('l', 0)
+        if document is None or not 0 <= file_id < len(document['files']) or block_size <= 0:
+            self._publish_stream(thing_name, stream_id, 'rejected', stream_format,
+                                 {'c': token, 'o': 'InvalidRequest' if document else 'ResourceNotFound',
+                                  'm': f'No file {file_id} in stream {stream_id}'})
+            return
+        with open(document['files'][file_id]['filePath'], 'rb') as image:
+            for index in self._requested_blocks(request):
+                image.seek(index * block_size)
+                block = image.read(block_size)
+                if not block:
+                    break
+                payload = block if stream_format == 'cbor' else base64.b64encode(block).decode()
+                self._publish_stream(thing_name, stream_id, 'data', stream_format,
+                                     {'c': token, 'f': file_id, 'l': len(block), 'i': index, 'p': payload})
+
+class LocalCloud:
+    """
+    The fake AWS backend with its state under root, and optionally the MQTT endpoint of
+    its jobs and streams on mqtt_port of 127.0.0.1, 0 for a free port, over TLS with
+    mqtt_tls. The images are signed by a dummy signer, whose certificate ACM returns, and
+    the CA of the broker certificate is kept in root/credentials/ca.crt.
+    """
+
+    def __init__(self, root, latencies=None, create_delay=0.0, mqtt=False, mqtt_port=0, mqtt_tls=False):
+        self.root = Path(root)
+        self.backend = FakeAwsBackend(self.root, create_delay=create_delay, latencies=latencies)
+        self.credentials = LocalCredentials(self.root / 'credentials')
+        self.mqtt = mqtt
+        self.mqtt_port = mqtt_port
+        self.mqtt_tls = mqtt_tls
+        self.broker = None
+        self.service = None
+
+    @classmethod
+    def from_project(cls, project):
+        return cls(project.local_cloud_dir, latencies=project.local_cloud_latency_sec,
+                   create_delay=project.local_cloud_create_delay_sec, mqtt=project.local_cloud_mqtt,
+                   mqtt_port=project.local_cloud_mqtt_port, mqtt_tls=project.local_cloud_mqtt_tls)
+
+    def start(self):
+        self.credentials.create()
+        self.backend.acm.certificate = self.credentials.signer_certificate
+        self.backend.install()
+        if self.mqtt:
+            ssl_context = self.credentials.server_context() if self.mqtt_tls else None
+            self.broker = LocalMqttBroker(port=self.mqtt_port, ssl_context=ssl_context).start()
+            self.service = LocalOtaService(self.broker, self.backend.iot, self.backend.latencies,
+                                           sign=self.credentials.sign)
+            logger.info(f'Local cloud serving jobs and streams on MQTT port {self.broker.port}'
+                        f'{" over TLS" if self.mqtt_tls else ""}')
+        return self
+
+    def stop(self):
+        if self.broker is not None:
+            self.broker.stop()
+        self.backend.uninstall()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def project_settings(self):
+        """
+        The fields of a project to change so that it runs against this cloud: its certificate
+        cache, kept apart from the certificates fetched from AWS, and when the MQTT endpoint
+        is served, the endpoint, ports, TLS and CA of the jobs observer and the interrupts.
+        Nothing else of the project is changed.
+        :return: dict of field name to value
+        """
+        settings = {'certificate_cache_dir': self.root / 'certificates'}
+        if self.broker is not None:
+            settings.update(
+                aws_iot_endpoint=self.broker.address[0],
+                jobs_observer_port=self.broker.port,
+                interrupt_port=self.broker.port,
+                jobs_observer_tls=self.mqtt_tls,
+                interrupt_tls=self.mqtt_tls,
+                mqtt_ca_path=str(self.credentials.ca_path) if self.mqtt_tls else '',
+            )
+        return settings
+
+    def configure_project(self, project):
+        """
+        Apply project_settings() to project, logging every field changed.
+        """
+        for name, value in self.project_settings().items():
+            if getattr(project, name) != value:
+                logger.info(f'Local cloud: {name} of the project changed from {getattr(project, name)!r} to {value!r}')
+                setattr(project, name, value)
+
+
+def install_from_project(project):
+    """
+    Start the local cloud of the project once per process and point the project at it,
+    see LocalCloud.project_settings() for the fields changed.
+    :return: The LocalCloud
+    """
+    root = Path(project.local_cloud_dir).resolve()
+    cloud = aws_clients.once(('local_cloud', str(root)), lambda: LocalCloud.from_project(project).start())
+    cloud.configure_project(project)
+    return cloud
@@ -0,0 +1,379 @@
+# Sidecar index of the device log files: byte offsets by time bucket, job ID and log level,
+# kept up to date as the log grows, so that the lines around a job or a time are read
+# straight from a memory map instead of scanning the whole file.
+import os
+import re
+import sys
+import gzip
+import mmap
+import time
+import zlib
+import struct
+import bisect
+import itertools
+import argparse
+from pathlib import Path
+from datetime import datetime
+from runotabinary.logger import logger
+from runotabinary.run_history import parse_time
+
+INDEX_SUFFIX = '.idx'
+MAGIC = b'RUNOTAIX'
+# Magic, bucket seconds, bytes of the log indexed, length and CRC-32 of the head of the log
+HEADER = struct.Struct('<8sdQII')
+# Kind, start and end offsets, time, length of the key which follows
+RECORD = struct.Struct('<BQQdH')
+# Bytes of the head of the log identifying it, to notice that it was rotated or truncated
+HEAD_BYTES = 4096
+
+TIME, LEVEL, JOB = 0, 1, 2
+
+# Levels of the CSDK log lines, e.g. "[ERROR] [OTA] [ota.c:1212] ...". Only the rare levels
+# are indexed: INFO and DEBUG are the bulk of the log, a time range finds them as well.
+# The patterns are not anchored to the start of the line, which would make the scans
+# several times slower.
+LEVEL_PATTERN = rb'\[(ERROR|WARN)\]'
+JOB_PATTERN = rb'AFR_OTA-[\w-]+'
+# Timestamp leading a line. Lines without one get the time at which the indexer saw them.
+TIME_PATTERN = rb'\[?(\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:\.\d+)?)'
+
+
+def index_path(log_path):
+    return Path(f'{log_path}{INDEX_SUFFIX}')
+
+
+def _head_crc(mm, length):
+    return zlib.crc32(mm[:length]) & 0xffffffff
+
+
+def _merge(ranges):
+    """
+    Sort ranges and merge those which touch or overlap.
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class LogIndexer:
+    """
+    Build and extend the index of a log file. Every update() only reads the bytes added
+    since the last one, up to the last complete line, with C speed regex scans over a
+    memory map, and appends their records to the sidecar file. Lines of the same level
+    or job which follow each other are stored as one range.
+
+    Without timestamps in the lines, the time of a line is the time at which update()
+    first saw it, so the index should be kept up to date while the log is written, see
+    RunBinary(index_log=True). A log which was truncated or replaced is indexed again.
+    Attached to a LogWriter, every rotated log keeps its own index, see attach().
+    """
+
+    def __init__(self, log_path, bucket_sec=1.0, clock=time.time, min_interval_sec=0.0,
+                 level_pattern=LEVEL_PATTERN, job_pattern=JOB_PATTERN, time_pattern=TIME_PATTERN):
+        self.log_path = Path(log_path)
+        self.path = index_path(self.log_path)
+        self.bucket_sec = bucket_sec
+        self.clock = clock
+        self.min_interval_sec = min_interval_sec
+        self._level = re.compile(level_pattern)
+        self._job = re.compile(job_pattern)
+        # Searched right after a newline, and matched at the start of the log
+        self._time = re.compile(b'\n' + time_pattern) if time_pattern else None
+        self._first_time = re.compile(time_pattern) if time_pattern else None
+        self._updated_at = None
+        self.indexed_to = 0
+        self._head = (0, 0)
+        self._last_bucket = None
+        self._load_header()
+
+    def _load_header(self):
+        try:
+            with open(self.path, 'rb') as f:
+                magic, bucket_sec, indexed_to, head_len, head_crc = HEADER.unpack(f.read(HEADER.size))
+            if magic == MAGIC and bucket_sec == self.bucket_sec:
+                self.indexed_to, self._head = indexed_to, (head_len, head_crc)
+                return
+        except (OSError, struct.error):
+            pass
+        self._reset()
+
+    def _reset(self):
+        self.indexed_to, self._head, self._last_bucket = 0, (0, 0), None
+        with open(self.path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, self.bucket_sec, 0, 0, 0))
+
+    def attach(self, writer):
+        """
+        Index the log of a LogWriter every time it is flushed. Before a rotation the log
+        is indexed to its last complete line, and the index is rotated along with it.
+        """
+        writer.flush_consumers.append(self.maybe_update)
+        writer.rotate_consumers.append(self.update)
+        writer.companion_suffixes.append(INDEX_SUFFIX)
+
+    def maybe_update(self):
+        """
+        update() unless the last one ran less than min_interval_sec ago.
+        """
+        now = time.monotonic()
+        if self._updated_at is not None and now - self._updated_at < self.min_interval_sec:
+            return 0
+        return self.update()
+
+    def update(self):
+        """
+        Index the complete lines added to the log since the last update.
+        :return: Number of bytes indexed
+        """
+        self._updated_at = time.monotonic()
+        try:
+            size = self.log_path.stat().st_size
+        except OSError:
+            return 0
+        if not self.path.exists():
+            # Rotated along with the log
+            self._reset()
+        elif size < self.indexed_to:
+            logger.info(f'{self.log_path} shrank, indexing it again')
+            self._reset()
+        if size == self.indexed_to or size == 0:
+            return 0
+        with open(self.log_path, 'rb') as f, mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+            head_len, head_crc = self._head
+            if head_len and _head_crc(mm, head_len) != head_crc:
+                logger.info(f'{self.log_path} was replaced, indexing it again')
+                self._reset()
+            start = self.indexed_to
+            end = mm.rfind(b'\n', start, size) + 1
+            if end <= start:
+                return 0
+            records = self._scan(mm, start, end)
+            head_len = min(HEAD_BYTES, end)
+            if head_len != self._head[0]:
+                self._head = (head_len, _head_crc(mm, head_len))
+        with open(self.path, 'r+b') as f:
+            f.seek(0, os.SEEK_END)
+            f.write(b''.join(RECORD.pack(kind, first, last, stamp, len(key)) + key
+                             for kind, first, last, stamp, key in records))
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, self.bucket_sec, end, *self._head))
+        self.indexed_to = end
+        return end - start
+
+    def _bucket(self, stamp):
+        return stamp - stamp % self.bucket_sec if self.bucket_sec else stamp
+
+    def _scan(self, mm, start, end):
+        records = []
+
+        times = []
+        if self._time is not None:
+            matches = self._time.finditer(mm, start - 1, end) if start else self._time.finditer(mm, 0, end)
+            first = None if start else self._first_time.match(mm, 0, end)
+            second = None
+            for match in itertools.chain([first] if first else [], matches):
+                text = match.group(1)
+                # Lines of the same second fall in the same bucket, only the first one is parsed
+                if self.bucket_sec >= 1 and text[:19] == second:
+                    continue
+                second = text[:19]
+                try:
+                    stamp = datetime.fromisoformat(text.decode()).timestamp()
+                except ValueError:
+                    continue
+                times.append((match.start() if match is first else match.start() + 1, stamp))
+        if not times or times[0][0] != start:
+            # Lines before the first timestamp get the time they were seen at
+            times.insert(0, (start, self.clock()))
+        for offset, stamp in times:
+            bucket = self._bucket(stamp)
+            if bucket != self._last_bucket:
+                records.append((TIME, offset, offset, bucket, b''))
+                self._last_bucket = bucket
+
+        for kind, pattern in ((LEVEL, self._level), (JOB, self._job)):
+            ranges = {}
+            for match in pattern.finditer(mm, start, end):
+                key = match.group(1) if kind == LEVEL else match.group(0)
+                line_start = mm.rfind(b'\n', start, match.start()) + 1 or start
+                line_end = mm.find(b'\n', match.end(), end) + 1 or end
+                key_ranges = ranges.setdefault(key, [])
+                if key_ranges and key_ranges[-1][1] >= line_start:
+                    key_ranges[-1][1] = max(key_ranges[-1][1], line_end)
+                else:
+                    key_ranges.append([line_start, line_end])
+            for key, key_ranges in ranges.items():
+                records.extend((kind, first, last, 0.0, key) for first, last in key_ranges)
+        return records
+
+    def follow(self, interval_sec=0.5, should_stop=lambda: False):
+        """
+        Keep the index up to date until should_stop returns True.
+        """
+        while not should_stop():
+            self.update()
+            time.sleep(interval_sec)
+
+
+class LogIndex:
+    """
+    Read only view of a log and its index, answering queries with byte ranges of the
+    log which are read through a memory map. A rotated log which was compressed is
+    read in memory instead.
+    """
+
+    def __init__(self, log_path):
+        self.log_path = Path(log_path)
+        self.path = index_path(self.log_path)
+        self.times = []
+        self.levels = {}
+        self.jobs = {}
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        magic, self.bucket_sec, self.indexed_to, _, _ = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError(f'{self.path} is not a log index')
+        position = HEADER.size
+        while position + RECORD.size <= len(data):
+            kind, start, end, stamp, key_len = RECORD.unpack_from(data, position)
+            position += RECORD.size
+            key = data[position:position + key_len].decode('utf-8', 'replace')
+            position += key_len
+            if kind == TIME:
+                self.times.append((start, stamp))
+            else:
+                (self.levels if kind == LEVEL else self.jobs).setdefault(key, []).append((start, end))
+        self._stamps = [stamp for _, stamp in self.times]
+        if self.log_path.suffix == '.gz':
+            self._file = None
+            with gzip.open(self.log_path, 'rb') as f:
+                self._mm = f.read()
+            return
+        self._file = open(self.log_path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._mm = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ) if size else b''
+
+    def time_range(self, since=None, until=None):
+        """
+        Byte range of the lines logged between since and until, at the bucket resolution.
+        """
+        start, end = 0, self.indexed_to
+        if since is not None:
+            # First bucket which ends after since
+            index = bisect.bisect_right(self._stamps, since - self.bucket_sec)
+            start = self.times[index][0] if index < len(self.times) else self.indexed_to
+        if until is not None:
+            index = bisect.bisect_right(self._stamps, until)
+            end = self.times[index][0] if index < len(self.times) else self.indexed_to
+        return start, max(start, end)
+
+    def around(self, timestamp, before_sec=5.0, after_sec=5.0):
+        return [self.time_range(timestamp - before_sec, timestamp + after_sec)]
+
+    def _within(self, ranges, since=None, until=None):
+        if since is None and until is None:
+            return _merge(ranges)
+        low, high = self.time_range(since, until)
+        return [(max(start, low), min(end, high)) for start, end in _merge(ranges) if start < high and end > low]
+
+    def job(self, job_id, since=None, until=None):
+        """
+        Ranges of the lines naming job_id, which may be the ID of the OTA update or a part of it.
+        """
+        ranges = [r for key, key_ranges in self.jobs.items() if job_id in key for r in key_ranges]
+        return self._within(ranges, since, until)
+
+    def level(self, level, since=None, until=None):
+        return self._within(self.levels.get(level.upper(), []), since, until)
+
+    def with_context(self, ranges, lines=0):
+        """
+        Extend every range by lines lines before and after it.
+        """
+        if not lines:
+            return ranges
+        extended = []
+        for start, end in ranges:
+            for _ in range(lines):
+                if start == 0:
+                    break
+                start = self._mm.rfind(b'\n', 0, start - 1) + 1
+            for _ in range(lines):
+                following = self._mm.find(b'\n', end, self.indexed_to)
+                if following < 0:
+                    break
+                end = following + 1
+            extended.append((start, end))
+        return _merge(extended)
+
+    def read(self, ranges):
+        """
+        :return: Text of the ranges
+        """
+        return [self._mm[start:end].decode('utf-8', 'replace') for start, end in ranges]
+
+    def close(self):
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Index the device log files and read the lines around a job, a time or a level')
+    parser.add_argument('log', help='Log file written by RunBinary')
+    parser.add_argument('--bucket-sec', type=float, default=1.0, help='Time resolution of the index')
+    parser.add_argument('--follow', action='store_true', help='Keep indexing the log as it grows')
+    parser.add_argument('--job', default=None, help='Lines naming this job or OTA update ID')
+    parser.add_argument('--level', default=None, help='Lines of this level, e.g. ERROR')
+    parser.add_argument('--around', default=None, help='Lines logged around this time, e.g. 10m, ISO or epoch')
+    parser.add_argument('--window-sec', type=float, default=5.0, help='Seconds before and after --around')
+    parser.add_argument('--since', default=None, help='Only the lines logged from this time, e.g. 10m, ISO or epoch')
+    parser.add_argument('--until', default=None)
+    parser.add_argument('--context', type=int, default=0, help='Lines printed before and after every match')
+    args = parser.parse_args(argv)
+
+    indexed, index_sec = 0, 0.0
+    # A compressed log was rotated, it is read with the index it was rotated with
+    if not args.log.endswith('.gz'):
+        indexer = LogIndexer(args.log, bucket_sec=args.bucket_sec)
+        if args.follow:
+            try:
+                indexer.follow()
+            except KeyboardInterrupt:
+                return 0
+        start = time.perf_counter()
+        indexed = indexer.update()
+        index_sec = time.perf_counter() - start
+
+    start = time.perf_counter()
+    since, until = parse_time(args.since), parse_time(args.until)
+    with LogIndex(args.log) as log_index:
+        if args.job:
+            ranges = log_index.job(args.job, since, until)
+        elif args.level:
+            ranges = log_index.level(args.level, since, until)
+        elif args.around:
+            ranges = log_index.around(parse_time(args.around), args.window_sec, args.window_sec)
+        else:
+            ranges = [log_index.time_range(since, until)] if since is not None or until is not None else []
+        ranges = log_index.with_context(ranges, args.context)
+        for text in log_index.read(ranges):
+            sys.stdout.write(text)
+    logger.info(f'Indexed {indexed} bytes in {index_sec:.3f}s, found {len(ranges)} ranges '
+                f'in {time.perf_counter() - start:.3f}s')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,42 @@
+# Encoding of the MQTT 3.1.1 control packets, shared by the local broker and the takeover
+# connections which interrupt the device.
+import struct
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+def encode_length(length):
+    """
+    Remaining length of a packet, 7 bits per byte.
+    """
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value):
+    """
+    UTF-8 string or bytes prefixed with its length.
+    """
+    data = value.encode() if isinstance(value, str) else value
+    return struct.pack('!H', len(data)) + data
+
+
+def packet(packet_type, flags, body):
+    """
+    Packet of packet_type with its fixed header.
+    """
+    return bytes([(packet_type << 4) | flags]) + encode_length(len(body)) + body
+
+
+def connect_packet(client_id, keepalive=60):
+    """
+    CONNECT packet of client_id with a clean session.
+    """
+    return packet(CONNECT, 0, encode_string('MQTT') + bytes([4, 0x02]) + struct.pack('!H', keepalive)
+                  + encode_string(client_id))
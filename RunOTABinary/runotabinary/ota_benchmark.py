@@ -0,0 +1,313 @@
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+from pathlib import Path
+from os.path import basename
+from datetime import datetime
+from runotabinary.build_binary import BuildBinary, STATUS, SIGNER_CERTIFICATE_TAG
+from runotabinary.configs.config_project import OtaProject
+from runotabinary.create_update import CreateUpdate
+from runotabinary.fake_aws import FakeAwsBackend, write_json
+from runotabinary.logger import logger
+from runotabinary.ota_log_parser import OtaLogParser
+from runotabinary.run_binary import RunBinary
+from runotabinary.run_history import RunHistory, RunRecorder, device_samples, git_commit
+from runotabinary import stub_device, throttle, tracing
+from runotabinary.stats import summarize
+
+# Stages timed on the host, then the device side stages taken from the device output
+# and from the restarts done by RunBinary
+HOST_STAGES = ('build', 'upload', 'create', 'rollout', 'update')
+DEVICE_STAGES = ('job_document', 'download', 'restart', 'exit_to_run', 'image_to_run')
+
+THING_NAME = 'runota-benchmark-device'
+DEVICE_OUTPUT_TIMEOUT_SEC = 5
+
+CMAKE_LISTS = """cmake_minimum_required(VERSION 3.13)
+project(runota_offline_device NONE)
+
+# A header force-included by the C flags overrides the demo config, as it would for a compiler
+set(OVERLAY "")
+if(CMAKE_C_FLAGS MATCHES "-include ([^ ]+)")
+    set(OVERLAY ${CMAKE_MATCH_1})
+endif()
+
+# Every demo target stamps the version of its demo_config.h into the stub device
+foreach(target ota_demo_core_mqtt ota_demo_core_http)
+    add_custom_target(${target}
+        COMMAND ${CMAKE_COMMAND}
+            -DCONFIG=${CMAKE_SOURCE_DIR}/demos/ota/${target}/demo_config.h
+            -DOVERLAY=${OVERLAY}
+            -DSOURCE=${CMAKE_SOURCE_DIR}/stub_device.py
+            -DOUTPUT=${CMAKE_BINARY_DIR}/bin/${target}
+            -P ${CMAKE_SOURCE_DIR}/stamp.cmake
+        VERBATIM)
+endforeach()
+"""
+
+STAMP_SCRIPT = """file(STRINGS "${CONFIG}" defines REGEX "^#define APP_VERSION_(MAJOR|MINOR|BUILD) ")
+if(OVERLAY)
+    file(STRINGS "${OVERLAY}" overrides REGEX "^#define APP_VERSION_(MAJOR|MINOR|BUILD) ")
+    list(APPEND defines ${overrides})
+endif()
+foreach(define ${defines})
+    string(REGEX REPLACE "^#define APP_VERSION_([A-Z]+) +([0-9]+).*" "\\\\1;\\\\2" pair "${define}")
+    list(GET pair 0 name)
+    list(GET pair 1 value)
+    set(VERSION_${name} ${value})
+endforeach()
+set(APP_VERSION "${VERSION_MAJOR}.${VERSION_MINOR}.${VERSION_BUILD}")
+configure_file("${SOURCE}" "${OUTPUT}" @ONLY)
+"""
+
+DEMO_CONFIG = """#define AWS_IOT_ENDPOINT ""
+#define CLIENT_CERT_PATH ""
+#define CLIENT_PRIVATE_KEY_PATH ""
+#define CLIENT_IDENTIFIER ""
+#define APP_VERSION_MAJOR 0
+#define APP_VERSION_MINOR 9
+#define APP_VERSION_BUILD 0
+"""
+
+
+def scaffold_repository(root, image_bytes=0):
+    """
+    Create a CMake tree laid out like the CSDK whose demo targets build the stub device.
+    :param image_bytes: Padding added to the image so that downloads take several blocks
+    :return: Path of the repository
+    """
+    root = Path(root)
+    source = Path(stub_device.__file__).read_text()
+    padding = ''.join(f'# {"." * 76}\n' for _ in range(image_bytes // 80))
+    (root / 'platform/posix/ota_pal/source').mkdir(parents=True, exist_ok=True)
+    (root / 'CMakeLists.txt').write_text(CMAKE_LISTS)
+    (root / 'stamp.cmake').write_text(STAMP_SCRIPT)
+    stub = root / 'stub_device.py'
+    stub.write_text(f'#!{sys.executable}\n{source}{padding}')
+    stub.chmod(0o755)
+    (root / 'platform/posix/ota_pal/source/ota_pal_posix.c').write_text(f'{SIGNER_CERTIFICATE_TAG} "";\n')
+    for target in ('ota_demo_core_mqtt', 'ota_demo_core_http'):
+        demo = root / 'demos' / 'ota' / target
+        demo.mkdir(parents=True, exist_ok=True)
+        (demo / 'demo_config.h').write_text(DEMO_CONFIG)
+        (demo / 'ota_config.h').write_text('')
+        (demo / f'{target}.c').write_text('')
+    return root
+
+
+def benchmark_project(work_dir, repository):
+    return OtaProject(
+        repository_root=Path(repository),
+        s3_bucket_name='runota-benchmark',
+        ota_update_role_arn='arn:aws:iam::000000000000:role/runota-benchmark',
+        ecdsa_signer_certificate_arn='arn:aws:acm:local:000000000000:certificate/runota-benchmark',
+        certificate_cache_dir=Path(work_dir) / 'certificates',
+        thing_name=THING_NAME,
+        thing_arn=f'arn:aws:iot:local:000000000000:thing/{THING_NAME}',
+        aws_iot_endpoint='localhost',
+        client_cert_path='client.crt',
+        client_private_key_path='client.key',
+        # The offline backend has no quotas
+        aws_call_rates=dict.fromkeys(throttle.DEFAULT_RATES, 0),
+    )
+
+
+def _wait_for(predicate, timeout):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.005)
+
+
+def _timed(samples, fn, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        samples.append(time.perf_counter() - start)
+
+
+def run(work_dir, iterations=5, image_kib=64, block_size=4096, block_delay_sec=0.0, create_delay_sec=0.0, history=None):
+    """
+    Run the build, upload, create, rollout and restart loop of the canary offline: AWS
+    is served by the fake backend and the device is the stub device built by CMake.
+    :param history: RunHistory the samples of the run are recorded into
+    :return: The report of the run
+    """
+    work_dir = Path(work_dir).resolve()
+    settings = {'iterations': iterations, 'image_kib': image_kib, 'block_size': block_size,
+                'block_delay_sec': block_delay_sec, 'create_delay_sec': create_delay_sec}
+    samples = {stage: [] for stage in HOST_STAGES}
+    statuses = []
+    updates_done = []
+    setup_start = time.perf_counter()
+    throttle.reset()
+    repository = scaffold_repository(work_dir / 'repository', image_kib * 1024)
+    project = benchmark_project(work_dir, repository)
+    backend = FakeAwsBackend(work_dir / 'cloud', create_delay=create_delay_sec).install()
+    stop_file = work_dir / 'device.stop'
+    run_task = None
+    update_task = None
+    device_metrics = OtaLogParser()
+    try:
+        build_task = BuildBinary(project)
+        build_task.set_application_version()
+        status, build_path = build_task.build()
+        if status != STATUS.PASS:
+            raise RuntimeError('Initial build of the stub device failed')
+
+        device_dir = work_dir / 'device'
+        device_dir.mkdir(parents=True, exist_ok=True)
+        executable = device_dir / basename(build_path)
+        shutil.copy2(build_path, executable)
+        write_json(device_dir / stub_device.CONFIG_FILE, {
+            'jobs_dir': str(backend.iot.root),
+            'thing_name': project.thing_name,
+            'stop_file': str(stop_file),
+            'block_size': block_size,
+            'block_delay_sec': block_delay_sec,
+        })
+        run_task = RunBinary(str(executable), str(work_dir / 'device.log'))
+        run_task.add_line_consumer(device_metrics.feed)
+        run_task.start()
+        update_task = CreateUpdate(ota_project=project)
+        setup_sec = time.perf_counter() - setup_start
+
+        def build_next():
+            build_task.increase_application_build_version()
+            return build_task.build()
+
+        start = time.perf_counter()
+        for counter in range(2, iterations + 2):
+            update_start = time.perf_counter()
+            status, build_path = _timed(samples['build'], build_next)
+            if status != STATUS.PASS:
+                raise RuntimeError(f'Build of version {project.version_build} failed')
+            file_name = f'{basename(build_path)}_{counter}'
+            s3_object = _timed(samples['upload'], update_task.upload_firmware_to_s3_bucket, build_path, file_name)
+            update_task.setParams(file_name, build_path)
+            created_at = device_metrics.clock()
+            ota_update_id = _timed(samples['create'], update_task.create_ota_update, s3Object=s3_object)
+            device_metrics.mark_update_created(created_at)
+            update_status, _ = _timed(samples['rollout'], update_task.get_ota_update_result,
+                                      ota_update_id, project.ota_timeout_sec)
+            samples['update'].append(time.perf_counter() - update_start)
+            # The job status may arrive before the device output is parsed, the next
+            # update must not start before the self-test of this one is accounted for
+            _wait_for(lambda: device_metrics.snapshot()['self_test_passed'], DEVICE_OUTPUT_TIMEOUT_SEC)
+            statuses.append(update_status.status)
+            updates_done.append((project.version_build, ota_update_id, update_status.status, Path(build_path).stat().st_size))
+            logger.info(f'Benchmark update {counter - 1}/{iterations}: {update_status.status}')
+            if update_status.status != 'SUCCEEDED':
+                break
+        total_sec = time.perf_counter() - start
+    finally:
+        stop_file.touch()
+        if run_task is not None:
+            run_task.close()
+            run_task.join(10)
+        if update_task is not None:
+            update_task.close()
+        backend.uninstall()
+
+    device = device_samples(device_metrics, run_task.restarts if run_task else ())
+    succeeded = statuses.count('SUCCEEDED')
+    if history is not None:
+        recorder = RunRecorder(history, 'benchmark', thing_name=THING_NAME, tool_commit=git_commit(), settings=settings)
+        for stage in HOST_STAGES:
+            recorder.samples(stage, samples[stage])
+        for stage in DEVICE_STAGES:
+            recorder.samples(stage, device[stage])
+        for version_build, ota_update_id, status, image_bytes in updates_done:
+            recorder.update(version_build, ota_update_id, status, image_bytes)
+            recorder.sample('image_bytes', image_bytes, version_build)
+        recorder.finish()
+    return {
+        'benchmark': 'offline-ota',
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'settings': settings,
+        'succeeded': succeeded,
+        'failed': len(statuses) - succeeded,
+        'setup_sec': round(setup_sec, 3),
+        'total_sec': round(total_sec, 3),
+        'updates_per_hour': round(succeeded * 3600 / total_sec, 1) if total_sec else None,
+        'stages': dict(
+            [(stage, summarize(samples[stage])) for stage in HOST_STAGES]
+            + [(stage, summarize(device[stage])) for stage in DEVICE_STAGES]
+        ),
+        'aws_calls': throttle.counters(),
+    }
+
+
+def compare(baseline, report):
+    """
+    Relative change of the p50 and p95 of every stage and of the throughput against a baseline report.
+    :return: List of (metric, baseline value, current value, change in percent)
+    """
+    rows = []
+    for stage, current in report['stages'].items():
+        previous = baseline.get('stages', {}).get(stage, {})
+        for key in ('p50', 'p95'):
+            rows.append((f'{stage}.{key}', previous.get(key), current.get(key)))
+    rows.append(('updates_per_hour', baseline.get('updates_per_hour'), report.get('updates_per_hour')))
+    return [(metric, old, new, round((new - old) / old * 100, 1) if old and new is not None else None)
+            for metric, old, new in rows]
+
+
+def format_report(report):
+    lines = [f"{'stage':<14}{'samples':>8}{'p50 s':>10}{'p95 s':>10}{'max s':>10}"]
+    for stage, stats in report['stages'].items():
+        values = [f"{stats[key]:>10.4f}" if stats[key] is not None else f"{'-':>10}" for key in ('p50', 'p95', 'max')]
+        lines.append(f"{stage:<14}{stats['samples']:>8}{''.join(values)}")
+    lines.append(f"{report['succeeded']} updates in {report['total_sec']} s, {report['updates_per_hour']} updates/hour")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the OTA canary loop offline against a stub device')
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--image-kib', type=int, default=64, help='Size of the stub device image')
+    parser.add_argument('--block-size', type=int, default=4096)
+    parser.add_argument('--block-delay-ms', type=float, default=0.0, help='Simulated time to receive a block')
+    parser.add_argument('--create-delay-ms', type=float, default=0.0, help='Simulated time to create an OTA update')
+    parser.add_argument('--work-dir', default=None, help='Keep the files of the run in this directory')
+    parser.add_argument('--output', default=None, help='Write the JSON report to this file')
+    parser.add_argument('--compare', default=None, help='JSON report of an earlier run to compare against')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    parser.add_argument('--trace', default=None, help='Write the spans of the run to this Chrome trace file')
+    parser.add_argument('--history', default=None,
+                        help='Record the run into this run history database, run_history_path of the project by default')
+    parser.add_argument('--no-history', action='store_true', help='Do not record the run into the run history')
+    args = parser.parse_args()
+
+    if args.trace:
+        tracing.configure(chrome_path=args.trace)
+
+    history_path = None if args.no_history else args.history or OtaProject().run_history_path
+    history = RunHistory(history_path) if history_path else None
+    work_dir = Path(args.work_dir) if args.work_dir else Path(tempfile.mkdtemp(prefix='runota-benchmark-'))
+    try:
+        report = run(work_dir, args.iterations, args.image_kib, args.block_size,
+                     args.block_delay_ms / 1000, args.create_delay_ms / 1000, history)
+    finally:
+        tracing.flush()
+        if history is not None:
+            history.close()
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+    if args.compare:
+        for metric, old, new, change in compare(json.loads(Path(args.compare).read_text()), report):
+            print(f"{metric:<22}{str(old):>12}{str(new):>12}{'' if change is None else f'{change:+.1f}%':>10}")
+    sys.exit(0 if report['failed'] == 0 else 1)
+
+if __name__ == "__main__":
+    main()
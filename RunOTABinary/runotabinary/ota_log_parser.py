@@ -0,0 +1,195 @@
+import re
+import time
+import threading
+from collections import namedtuple
+from runotabinary import tracing
+from runotabinary.stats import percentile
+
+OtaEvent = namedtuple('OtaEvent', 'name timestamp line fields')
+
+# Events of the OTA agent of the CSDK demos, matched in this order against every line.
+# Patterns are searched case-insensitively and may capture named fields.
+DEFAULT_PATTERNS = [
+    ('job_document', r'job document (?:was )?(?:accepted|received)|Received (?:OTA )?job document'),
+    ('block_received', r'Received valid file block: Block index=(?P<index>\d+), Size=(?P<size>\d+)'),
+    ('block_request', r'request(?:ing|ed)? (?:the next )?(?:file )?block|Sending data request'),
+    # Only the block requests the OTA agent sends again, not the MQTT reconnects or their backoff
+    ('retry', r'\[OTA\].*(?:\bretr(?:y|ying|ies)\b|Resending|Re-requesting).*\b(?:block|data request)'),
+    ('final_block', r'Received final block'),
+    ('verified', r'validated the signature|Signature verification (?:passed|succeeded)|Received entire update'),
+    ('activate', r'OtaJobEventActivate|Attempting to activate|Activating the new image'),
+    ('self_test', r'OtaJobEventStartTest|Beginning self[- ]test|In self[- ]test mode'),
+    ('self_test_passed', r'Image version is valid|(?:validation|self[- ]test) (?:succeeded|passed)'),
+    ('failed', r'OtaJobEventFail|Failed to (?:validate|activate)|Signature verification failed'),
+]
+
+# Phases of an update traced as device.<phase> spans, between two events. A None start
+# is the creation of the update.
+PHASES = [
+    ('job_document', None, 'job_document'),
+    ('download', 'job_document', 'verified'),
+    ('activate', 'verified', 'activate'),
+    ('reboot', 'activate', 'self_test'),
+    ('self_test', 'self_test', 'self_test_passed'),
+]
+
+
+class UpdateMetrics:
+    """
+    Device side timings of a single OTA update, from the job document to the self-test.
+    """
+
+    def __init__(self, started_at):
+        self.started_at = started_at
+        self.events = {}
+        self.block_times = []
+        self.block_bytes = 0
+        self.block_latencies = []
+        self.requests = 0
+        self.retries = 0
+        self._pending_request = None
+
+    def add(self, event):
+        self.events.setdefault(event.name, event.timestamp)
+        if event.name == 'block_request':
+            self.requests += 1
+            self._pending_request = event.timestamp
+        elif event.name == 'block_received':
+            self.block_times.append(event.timestamp)
+            self.block_bytes += int(event.fields.get('size') or 0)
+            if self._pending_request is not None:
+                self.block_latencies.append(event.timestamp - self._pending_request)
+                self._pending_request = None
+        elif event.name == 'retry':
+            self.retries += 1
+
+    def phases(self):
+        """
+        :return: List of (phase, start, end) of the phases seen, in monotonic seconds
+        """
+        phases = []
+        for phase, start, end in PHASES:
+            start_time = self.started_at if start is None else self.events.get(start)
+            if start_time is not None and end in self.events:
+                phases.append((phase, start_time, self.events[end]))
+        return phases
+
+    def _between(self, start, end):
+        if start in self.events and end in self.events:
+            return round(self.events[end] - self.events[start], 3)
+        return None
+
+    def as_dict(self):
+        intervals = [b - a for a, b in zip(self.block_times, self.block_times[1:])]
+        transfer_sec = self.block_times[-1] - self.block_times[0] if len(self.block_times) > 1 else None
+        job_document = self.events.get('job_document')
+        return {
+            'time_to_job_document_sec': round(job_document - self.started_at, 3) if job_document else None,
+            'blocks': len(self.block_times),
+            'block_bytes': self.block_bytes,
+            'block_requests': self.requests,
+            'retries': self.retries,
+            'transfer_sec': round(transfer_sec, 3) if transfer_sec else None,
+            'blocks_per_sec': round((len(self.block_times) - 1) / transfer_sec, 2) if transfer_sec else None,
+            'bytes_per_sec': round(self.block_bytes / transfer_sec, 1) if transfer_sec else None,
+            'block_interval_p50_sec': percentile(intervals, 50),
+            'block_interval_p95_sec': percentile(intervals, 95),
+            'block_latency_p50_sec': percentile(self.block_latencies, 50),
+            'block_latency_p95_sec': percentile(self.block_latencies, 95),
+            'job_document_to_first_block_sec': self._between('job_document', 'block_received'),
+            'verification_to_self_test_sec': self._between('verified', 'self_test'),
+            'self_test_passed': 'self_test_passed' in self.events,
+            'failed': 'failed' in self.events,
+        }
+
+
+class OtaLogParser:
+    """
+    Streaming parser of the OTA agent output captured by RunBinary.
+
+    Attach it with RunBinary.add_line_consumer(parser.feed). Every recognized line becomes
+    an OtaEvent stamped with a monotonic clock, and the events are folded into the
+    UpdateMetrics of the current update. A job document seen after a self-test starts the
+    metrics of the next update. snapshot() can be called at any time from another thread.
+
+    Once an update passes its self-test or fails, its phases are traced as device.<phase>
+    spans carrying trace_attributes, e.g. the thing name.
+    """
+
+    def __init__(self, patterns=None, clock=time.monotonic, keep_events=10000, trace_attributes=None):
+        self.clock = clock
+        self.keep_events = keep_events
+        self.trace_attributes = trace_attributes or {}
+        self._patterns = [(name, re.compile(pattern, re.IGNORECASE)) for name, pattern in (patterns or DEFAULT_PATTERNS)]
+        self._lock = threading.Lock()
+        self.events = []
+        self.updates = [UpdateMetrics(self.clock())]
+
+    def mark_update_created(self, timestamp=None):
+        """
+        Start the metrics of a new update, e.g. right after its OTA update was created,
+        so that the time to job document is measured from there. Pass the time the creation
+        was requested as timestamp so that a job document seen before this call is kept
+        with its update.
+        """
+        with self._lock:
+            timestamp = timestamp if timestamp is not None else self.clock()
+            current = self.updates[-1]
+            job_document = current.events.get('job_document')
+            if current.events and (job_document is None or job_document < timestamp):
+                self.updates.append(UpdateMetrics(timestamp))
+            else:
+                current.started_at = timestamp
+
+    def parse(self, line, timestamp=None):
+        """
+        :return: The OtaEvent recognized in line, None if the line is not an OTA event
+        """
+        for name, pattern in self._patterns:
+            match = pattern.search(line)
+            if match:
+                timestamp = timestamp if timestamp is not None else self.clock()
+                return OtaEvent(name, timestamp, line.rstrip('\n'), match.groupdict())
+        return None
+
+    def feed(self, line, timestamp=None):
+        event = self.parse(line, timestamp)
+        if event is None:
+            return None
+        with self._lock:
+            current = self.updates[-1]
+            if event.name == 'job_document' and ('self_test' in current.events or 'failed' in current.events):
+                current = UpdateMetrics(event.timestamp)
+                self.updates.append(current)
+            current.add(event)
+            self.events.append(event)
+            if len(self.events) > self.keep_events:
+                del self.events[:len(self.events) - self.keep_events]
+        if event.name in ('self_test_passed', 'failed') and tracing.enabled():
+            self.trace(current)
+        return event
+
+    def trace(self, update):
+        for phase, start, end in update.phases():
+            tracing.record(f'device.{phase}', start, end, **self.trace_attributes)
+
+    def snapshot(self):
+        """
+        Metrics of the update in progress.
+        """
+        with self._lock:
+            return self.updates[-1].as_dict()
+
+    def summary(self):
+        """
+        Metrics of every update seen during the run.
+        """
+        with self._lock:
+            return [update.as_dict() for update in self.updates if update.events]
+
+    def format_summary(self):
+        lines = []
+        for index, update in enumerate(self.summary(), 1):
+            values = ', '.join(f'{key}={value}' for key, value in update.items() if value is not None)
+            lines.append(f'Update {index}: {values}')
+        return '\n'.join(lines) if lines else 'No OTA activity seen in the device output'
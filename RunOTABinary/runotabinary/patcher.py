@@ -0,0 +1,158 @@
+import os
+import re
+import shutil
+import tempfile
+from pathlib import Path
+from runotabinary.logger import logger
+
+
+def patch_lines(lines, prefixToValue, tagToLine=None):
+    """
+    Apply macro and tagged line replacements to the lines of a source file in one pass.
+
+    A macro is replaced by '<macro> <value>' on its first occurrence, later occurrences
+    are dropped. When the first occurrence is inside a block comment the definition is
+    written right after the comment ends. Macros with a None value are left untouched.
+    Lines containing a tag of tagToLine are replaced by the line given for that tag.
+    :param lines: Lines of the file, with their line endings
+    :return: The patched lines
+    """
+    tagToLine = tagToLine or {}
+    macros_regex = re.compile("|".join(re.escape(macro) for macro in prefixToValue)) if prefixToValue else None
+    is_comment = False
+    buffer = []
+    ignore_list = []
+    patched = []
+    for line in lines:
+        for tag, tag_line in tagToLine.items():
+            if tag in line:
+                line = tag_line
+        if "/*" in line:
+            is_comment = True
+        if "*/" in line:
+            is_comment = False
+        match = macros_regex.search(line) if macros_regex else None
+        if match:
+            matched_macro = match.group()
+            if prefixToValue[matched_macro] is not None:
+                prefixToValue_line = '{} {}\n'.format(matched_macro, prefixToValue[matched_macro])
+                if matched_macro in ignore_list:
+                    line = None
+                else:
+                    ignore_list.append(matched_macro)
+                    if is_comment:
+                        buffer.append(prefixToValue_line)
+                    else:
+                        line = prefixToValue_line
+        if line is not None:
+            patched.append(line)
+        if not is_comment and buffer:
+            patched.extend(buffer)
+            buffer = []
+    return patched
+
+
+def guard_lines(lines, macros):
+    """
+    Wrap the first definition of every macro in '#ifndef <name>' / '#endif', so that a
+    definition given on the command line or in a forced include takes precedence.
+    Definitions which are already guarded are left as they are.
+    :param macros: Macros as they appear in the source, e.g. '#define APP_VERSION_BUILD'
+    :return: The patched lines
+    """
+    names = {macro: macro.split()[-1] for macro in macros}
+    is_comment = False
+    guarded = set()
+    patched = []
+    for line in lines:
+        if "/*" in line:
+            is_comment = True
+        if "*/" in line:
+            is_comment = False
+        stripped = line.strip()
+        if stripped.startswith('#ifndef '):
+            guarded.add(stripped.split()[1])
+        macro = next((macro for macro in names if stripped.split()[:2] == macro.split()), None)
+        if is_comment or macro is None or names[macro] in guarded:
+            patched.append(line)
+            continue
+        guarded.add(names[macro])
+        patched.extend([f'#ifndef {names[macro]}\n', line if line.endswith('\n') else line + '\n', '#endif\n'])
+    return patched
+
+
+def write_if_changed(path, text):
+    """
+    Atomically replace the content of path with text through a temporary file and a rename.
+    The file, and so its mtime, is left alone when the content is byte-identical.
+    :return: True if the file was written
+    """
+    path = Path(path)
+    data = text.encode('utf-8')
+    if path.exists() and path.read_bytes() == data:
+        return False
+
+    fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), prefix=f'.{path.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(data)
+        if path.exists():
+            shutil.copymode(str(path), tmp_path)
+        os.replace(tmp_path, str(path))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return True
+
+
+class SourcePatcher:
+    """
+    Collect edits of source files and apply them with a single read and at most one write per file.
+    """
+
+    def __init__(self):
+        self._macros = {}
+        self._lines = {}
+        self._guards = {}
+
+    def set_macros(self, path, prefixToValue):
+        """
+        Queue the replacement of macros of a file, see patch_lines.
+        """
+        self._macros.setdefault(Path(path), {}).update(prefixToValue)
+
+    def set_line(self, path, tag, line):
+        """
+        Queue the replacement of the line of a file containing tag.
+        """
+        self._lines.setdefault(Path(path), {})[tag] = line
+
+    def guard_macros(self, path, macros):
+        """
+        Queue the guarding of macro definitions of a file, see guard_lines.
+        """
+        self._guards.setdefault(Path(path), []).extend(macros)
+
+    @property
+    def pending(self):
+        return bool(self._macros or self._lines or self._guards)
+
+    def apply(self):
+        """
+        Apply every queued edit.
+        :return: List of the files whose content changed
+        """
+        changed = []
+        for path in list(dict.fromkeys(list(self._macros) + list(self._lines) + list(self._guards))):
+            with open(path, 'r', encoding='utf-8', newline='') as source:
+                lines = source.read().splitlines(keepends=True)
+            patched = patch_lines(lines, self._macros.get(path, {}), self._lines.get(path, {}))
+            if path in self._guards:
+                patched = guard_lines(patched, self._guards[path])
+            if write_if_changed(path, "".join(patched)):
+                logger.debug(f'Patched {path}')
+                changed.append(path)
+        self._macros = {}
+        self._lines = {}
+        self._guards = {}
+        return changed
@@ -0,0 +1,153 @@
+import time
+import queue
+import threading
+from dataclasses import dataclass, asdict
+from runotabinary.logger import logger
+
+_DONE = object()
+_POLL_SEC = 0.05
+
+
+@dataclass
+class StageStats:
+    """
+    Counters of a pipeline stage. idle_sec is the time spent waiting for input,
+    blocked_sec the time spent waiting for room in the queue of the next stage.
+    """
+
+    name: str
+    items: int = 0
+    busy_sec: float = 0.0
+    idle_sec: float = 0.0
+    blocked_sec: float = 0.0
+    max_queue_depth: int = 0
+    queue_depth_sum: int = 0
+
+    @property
+    def mean_queue_depth(self):
+        return self.queue_depth_sum / self.items if self.items else 0.0
+
+    def as_dict(self):
+        stats = asdict(self)
+        stats.pop('queue_depth_sum')
+        stats['mean_queue_depth'] = round(self.mean_queue_depth, 2)
+        for key in ('busy_sec', 'idle_sec', 'blocked_sec'):
+            stats[key] = round(stats[key], 3)
+        return stats
+
+
+class Pipeline:
+    """
+    Run items through a chain of stages, one thread per stage.
+
+    Each stage hands its output to the next one through a queue holding at most
+    lookahead items, so that early stages work ahead of the later ones without running
+    away. Every stage processes its items one at a time and in order. A stage raising
+    an exception, or a call to stop(), stops the whole pipeline; items already in
+    flight are dropped.
+    """
+
+    def __init__(self, stages, lookahead=1):
+        self.stages = stages
+        self.lookahead = max(1, lookahead)
+        self.stats = {name: StageStats(name) for name, _ in stages}
+        self.error = None
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    @property
+    def stopped(self):
+        return self._stop.is_set()
+
+    def _get(self, source, stats):
+        start = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                try:
+                    return source.get(timeout=_POLL_SEC)
+                except queue.Empty:
+                    continue
+            return _DONE
+        finally:
+            stats.idle_sec += time.perf_counter() - start
+
+    def _put(self, target, item, stats):
+        start = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                try:
+                    target.put(item, timeout=_POLL_SEC)
+                    return
+                except queue.Full:
+                    continue
+        finally:
+            stats.blocked_sec += time.perf_counter() - start
+
+    def _run_stage(self, name, fn, source, target):
+        stats = self.stats[name]
+        try:
+            while not self._stop.is_set():
+                item = self._get(source, stats)
+                if item is _DONE:
+                    break
+                stats.max_queue_depth = max(stats.max_queue_depth, source.qsize() + 1)
+                stats.queue_depth_sum += source.qsize() + 1
+                start = time.perf_counter()
+                result = fn(item)
+                stats.busy_sec += time.perf_counter() - start
+                stats.items += 1
+                if target.maxsize:
+                    self._put(target, result, stats)
+                else:
+                    target.put(result)
+        except Exception as e:
+            logger.error(f"Pipeline stage {name} failed: {e}")
+            self.error = e
+            self._stop.set()
+        finally:
+            while True:
+                try:
+                    target.put(_DONE, timeout=_POLL_SEC)
+                    break
+                except queue.Full:
+                    # The next stage stopped reading, drop what it left behind
+                    if self._stop.is_set():
+                        try:
+                            target.get_nowait()
+                        except queue.Empty:
+                            pass
+
+    def run(self, items):
+        """
+        :return: Outputs of the last stage, in order
+        """
+        source = queue.Queue()
+        for item in items:
+            source.put(item)
+        source.put(_DONE)
+
+        threads = []
+        for index, (name, fn) in enumerate(self.stages):
+            # The output of the last stage is collected here and never dropped
+            last = index == len(self.stages) - 1
+            target = queue.Queue() if last else queue.Queue(maxsize=self.lookahead)
+            threads.append(threading.Thread(target=self._run_stage, args=(name, fn, source, target),
+                                            name=f'pipeline-{name}', daemon=True))
+            source = target
+        for thread in threads:
+            thread.start()
+
+        results = []
+        while True:
+            item = source.get()
+            if item is _DONE:
+                break
+            results.append(item)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def report(self):
+        return [self.stats[name].as_dict() for name, _ in self.stages]
@@ -1,15 +1,45 @@
 import os
+import re
 import sys
+import time
 import signal
 import traceback
 import subprocess
 from pathlib import Path
 from datetime import datetime
 from threading import Thread
+from runotabinary import tracing
+from runotabinary.capture import LogWriter, pump
+from runotabinary.log_index import LogIndexer
 from runotabinary.logger import logger, setup_logger
+from runotabinary.supervisor import ImageWatcher, make_executable
+
+# Most often the log index is brought up to date while the device prints
+LOG_INDEX_INTERVAL_SEC = 0.25
+
 
 class RunBinary(Thread):
-    def __init__(self, filename, logfilename=None):
+    """
+    Run the device binary and restart it with the downloaded image after every update.
+
+    In the default 'chunk' capture mode the output is read in large chunks and written
+    raw by a background LogWriter, with optional size based rotation and compression,
+    so that reading never slows the device down. Text is only decoded for the line
+    consumers. The 'line' mode keeps the former line by line logging.
+
+    The working directory of the binary is watched for the images written by the OTA
+    downloads (inotify, polling where it is not available). Once the device exits it is
+    restarted on the image which landed, made executable in-process. The image named
+    <binary>_<file_version> is preferred but an image of any other <binary>_<version> is
+    accepted. When no image lands within restart_timeout, the device is restarted on its
+    current image, as it would reboot. The latency of every restart is kept in restarts.
+
+    With index_log, the log is indexed by time, job ID and level as it is written, see
+    log_index.
+    """
+    def __init__(self, filename, logfilename=None, capture='chunk', use_pty=False,
+                 max_log_bytes=0, log_backup_count=0, compress_logs=False, restart_timeout=60, use_inotify=True,
+                 index_log=False):
         Thread.__init__(self)
 
         self.print_monitor = False # Set this to true to get output on CLI
@@ -19,6 +49,10 @@ class RunBinary(Thread):
         self.initial_exe = filename
         self.run_indefinitely = True # Set this to false for 1 run
         self.file_version = 2
+        self.restart_timeout = restart_timeout
+        self.use_inotify = use_inotify
+        self.watcher = None
+        self.restarts = []
         if logfilename:
             self.log_output = logfilename
         else:
@@ -26,7 +60,26 @@ class RunBinary(Thread):
 
         self.clear_file(self.log_output)
         logger.info(f'Logging the run to {self.log_output}')
-        self.mlog = setup_logger(name='monitor', file=True, log_file=self.log_output, format='raw', terminator='')
+        self.capture = capture
+        self.use_pty = use_pty
+        self.line_consumers = []
+        if self.capture == 'line':
+            # One monitor logger per log file so that concurrent devices do not share handlers
+            self.mlog = setup_logger(name=f'monitor:{self.log_output}', file=True, log_file=self.log_output, format='raw', terminator='')
+            self.writer = None
+        else:
+            self.writer = LogWriter(self.log_output, max_log_bytes, log_backup_count, compress_logs)
+            self.writer.decoder.consumers = self.line_consumers
+        self.indexer = None
+        if index_log and self.writer is not None:
+            self.indexer = LogIndexer(self.log_output, min_interval_sec=LOG_INDEX_INTERVAL_SEC)
+            self.indexer.attach(self.writer)
+
+    def add_line_consumer(self, consumer):
+        """
+        Call consumer with every line printed by the device.
+        """
+        self.line_consumers.append(consumer)
 
     def clear_file(self, filename):
         """
@@ -44,6 +97,8 @@ class RunBinary(Thread):
                 if self.print_monitor:
                         logger.info(line)
                 self.mlog.info(line)
+                for consumer in self.line_consumers:
+                    consumer(line)
                 if self._exit_run:
                     return
             except UnicodeDecodeError:
@@ -53,15 +108,50 @@ class RunBinary(Thread):
                 self._stop_read = True
                 return
 
+    def _capture_simulator_output(self):
+        """
+        Start the binary and pump its output to the log writer until it closes its output.
+        """
+        if self.use_pty:
+            import pty
+            master, slave = pty.openpty()
+            proc = subprocess.Popen(self.executable, stdout=slave, stderr=slave, cwd=self.executable.parent)
+            os.close(slave)
+            try:
+                pump(master, self.writer)
+            finally:
+                os.close(master)
+        else:
+            proc = subprocess.Popen(self.executable, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=self.executable.parent)
+            with proc.stdout:
+                pump(proc.stdout.fileno(), self.writer)
+        return proc
+
     def run(self):
+        if self.writer is not None and self.print_monitor:
+            self.add_line_consumer(lambda line: logger.info(line))
+        restart_span = None
+        restart = None
         try:
+            if self.run_indefinitely:
+                self.watcher = ImageWatcher(self.executable.parent, self.executable.name, self.use_inotify).start()
             while self._stop_read == False:
                 logger.info(f'Running binary: {self.executable}')
+                if restart is not None:
+                    self._record_restart(restart, restart_span)
+                    restart = None
+                run_span = tracing.start_span('device.run', executable=str(self.executable))
 
-                proc = subprocess.Popen(self.executable, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=self.executable.parent)
-                with proc.stdout:
-                    self._read_simulator_output(proc.stdout)
+                if self.capture == 'line':
+                    proc = subprocess.Popen(self.executable, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=self.executable.parent)
+                    with proc.stdout:
+                        self._read_simulator_output(proc.stdout)
+                else:
+                    proc = self._capture_simulator_output()
                 exit_status = proc.wait()
+                exited_at = time.monotonic()
+                run_span.set(exit_code=exit_status)
+                run_span.end()
                 if exit_status in [0, -13]:
                     logger.info(f'Application terminated with Exit code:{exit_status}')
                 else:
@@ -69,20 +159,62 @@ class RunBinary(Thread):
                     self.close()
                     raise RuntimeError(f'Application stopped with Exit code:{exit_status}')
                 
-                if self.run_indefinitely:
-                    self.executable = Path(f'{self.initial_exe}_{self.file_version}')
-                    self.file_version += 1
-                    cmd = f'sudo chmod 777 {self.executable}'.split()
-                    result = subprocess.run(cmd, cwd=self.executable.parent, capture_output=True)
-                    print(result.stdout)
+                if self.run_indefinitely and not self._stop_read:
+                    # From the exit of the device until it runs the new image
+                    restart_span = tracing.start_span('device.restart')
+                    restart = self._next_image(exited_at)
+                    if restart is None and not self._stop_read:
+                        logger.warning(f'Restarting on the current image {self.executable}')
+                        restart = {'image': str(self.executable), 'exited_at': exited_at, 'landed_at': exited_at}
         except Exception as err:  # pylint: disable=broad-except
             logger.error("Unexpected exception: " + str(err))
             traceback.print_exc()
             sys.exit(1)
-    
+        finally:
+            if self.watcher is not None:
+                self.watcher.stop()
+            if self.writer is not None:
+                self.writer.close()
+            if self.indexer is not None:
+                self.indexer.update()
+
+    def _next_image(self, exited_at):
+        """
+        Wait for the image downloaded by the device and make it the next executable.
+        :return: The restart being done, None if no image landed
+        """
+        expected = f'{Path(self.initial_exe).name}_{self.file_version}'
+        landed = self.watcher.wait_for_image(expected, self.restart_timeout, should_stop=lambda: self._stop_read)
+        if landed is None:
+            if not self._stop_read:
+                logger.error(f'No new image landed in {self.watcher.directory} within {self.restart_timeout}s')
+            return None
+        image, landed_at = landed
+        if image.name != expected:
+            logger.warning(f'Expected image {expected}, restarting on {image.name}')
+        make_executable(image)
+        match = re.search(r'_(\d+)$', image.name)
+        self.file_version = int(match.group(1)) + 1 if match else self.file_version + 1
+        self.executable = image
+        return {'image': str(image), 'exited_at': exited_at, 'landed_at': landed_at}
+
+    def _record_restart(self, restart, restart_span):
+        started_at = time.monotonic()
+        record = {
+            'image': restart['image'],
+            'exit_to_start_sec': round(started_at - restart['exited_at'], 6),
+            'landed_to_start_sec': round(started_at - restart['landed_at'], 6),
+        }
+        self.restarts.append(record)
+        restart_span.set(**record)
+        restart_span.end()
+        logger.debug(f'Restarted on {record["image"]} {record["exit_to_start_sec"]}s after the device exit')
+
     def close(self):
         self._exit_run = True
         self._stop_read = True
+        if self.watcher is not None:
+            self.watcher.wake()
 
 def main():
     # Capture SIGINT (usually Ctrl+C is pressed) and SIGTERM, and exit gracefully.
@@ -0,0 +1,397 @@
+# Results database of the canary and benchmark runs: stage durations, job outcomes, image
+# sizes and device side timings, with percentile reports over time and a regression check
+# between two time windows or commits.
+import re
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+import subprocess
+from uuid import uuid4
+from pathlib import Path
+from datetime import datetime
+from runotabinary.configs.config_project import OtaProject
+from runotabinary.logger import logger
+from runotabinary.stats import summarize, percentile, mann_whitney_u
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    thing_name TEXT,
+    tool_commit TEXT,
+    repository_commit TEXT,
+    settings TEXT,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    succeeded INTEGER,
+    failed INTEGER
+);
+CREATE TABLE IF NOT EXISTS samples (
+    run_id TEXT NOT NULL REFERENCES runs(run_id),
+    metric TEXT NOT NULL,
+    value REAL NOT NULL,
+    version_build INTEGER,
+    recorded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_by_metric ON samples (metric, recorded_at);
+CREATE TABLE IF NOT EXISTS updates (
+    run_id TEXT NOT NULL REFERENCES runs(run_id),
+    version_build INTEGER NOT NULL,
+    ota_update_id TEXT,
+    status TEXT NOT NULL,
+    image_bytes INTEGER,
+    recorded_at REAL NOT NULL
+);
+"""
+
+# Metrics a regression in is flagged by default: the end-to-end update time and the build time
+REGRESSION_METRICS = ('update', 'build')
+# A regression is a larger median with a p-value under SIGNIFICANCE, by more than MIN_CHANGE_PERCENT
+SIGNIFICANCE = 0.05
+MIN_CHANGE_PERCENT = 5.0
+
+BUCKETS_SEC = {'hour': 3600, 'day': 24 * 3600, 'week': 7 * 24 * 3600}
+_DURATION = re.compile(r'^(\d+(?:\.\d+)?)([smhdw])$')
+_DURATION_SEC = {'s': 1, 'm': 60, 'h': 3600, 'd': 24 * 3600, 'w': 7 * 24 * 3600}
+
+
+def git_commit(cwd=None):
+    """
+    Commit checked out in cwd, by default the checkout of this tool, None outside of a git checkout.
+    """
+    try:
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                encoding='utf-8', cwd=str(cwd or Path(__file__).resolve().parent), check=True)
+        return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_time(text, now=None):
+    """
+    Epoch timestamp of text: a duration before now such as 90m, 12h or 7d, an ISO date or
+    datetime, or an epoch timestamp. None stays None.
+    """
+    if text is None:
+        return None
+    now = now if now is not None else time.time()
+    match = _DURATION.match(text)
+    if match:
+        return now - float(match.group(1)) * _DURATION_SEC[match.group(2)]
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.fromisoformat(text).timestamp()
+
+
+class RunHistory:
+    """
+    SQLite database of the runs. A run records samples of metrics, in seconds unless the
+    metric name says otherwise, and the outcome of every OTA update it created.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            return self._db.execute(sql, parameters).fetchall()
+
+    def start_run(self, kind, thing_name=None, tool_commit=None, repository_commit=None, settings=None, started_at=None):
+        """
+        :param kind: What ran, e.g. canary or benchmark
+        :return: ID of the run
+        """
+        run_id = uuid4().hex
+        self._execute('INSERT INTO runs (run_id, kind, thing_name, tool_commit, repository_commit, settings, started_at) '
+                      'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                      (run_id, kind, thing_name, tool_commit, repository_commit, json.dumps(settings or {}),
+                       started_at if started_at is not None else time.time()))
+        return run_id
+
+    def finish_run(self, run_id, succeeded, failed):
+        self._execute('UPDATE runs SET finished_at = ?, succeeded = ?, failed = ? WHERE run_id = ?',
+                      (time.time(), succeeded, failed, run_id))
+
+    def add_samples(self, run_id, metric, values, version_build=None, recorded_at=None):
+        """
+        Record values of metric, the None ones are dropped.
+        """
+        recorded_at = recorded_at if recorded_at is not None else time.time()
+        rows = [(run_id, metric, value, version_build, recorded_at) for value in values if value is not None]
+        if rows:
+            with self._lock:
+                self._db.executemany('INSERT INTO samples (run_id, metric, value, version_build, recorded_at) '
+                                     'VALUES (?, ?, ?, ?, ?)', rows)
+
+    def add_sample(self, run_id, metric, value, version_build=None):
+        self.add_samples(run_id, metric, [value], version_build)
+
+    def record_update(self, run_id, version_build, ota_update_id, status, image_bytes=None):
+        self._execute('INSERT INTO updates (run_id, version_build, ota_update_id, status, image_bytes, recorded_at) '
+                      'VALUES (?, ?, ?, ?, ?, ?)', (run_id, version_build, ota_update_id, status, image_bytes, time.time()))
+
+    def runs(self, since=None, until=None, kind=None, limit=None):
+        sql, parameters = self._window('SELECT * FROM runs', 'runs.started_at', since, until, kind=kind)
+        sql += ' ORDER BY started_at DESC'
+        if limit:
+            sql += f' LIMIT {int(limit)}'
+        return [dict(row) for row in self._execute(sql, parameters)]
+
+    def metrics(self):
+        return [row['metric'] for row in self._execute('SELECT DISTINCT metric FROM samples ORDER BY metric')]
+
+    @staticmethod
+    def _window(sql, column, since=None, until=None, commit=None, kind=None, metric=None):
+        conditions, parameters = [], []
+        if metric is not None:
+            conditions.append('samples.metric = ?')
+            parameters.append(metric)
+        if since is not None:
+            conditions.append(f'{column} >= ?')
+            parameters.append(since)
+        if until is not None:
+            conditions.append(f'{column} < ?')
+            parameters.append(until)
+        if commit:
+            # Abbreviated commits match too
+            conditions.append('(runs.tool_commit LIKE ? OR runs.repository_commit LIKE ?)')
+            parameters += [f'{commit}%', f'{commit}%']
+        if kind:
+            conditions.append('runs.kind = ?')
+            parameters.append(kind)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        return sql, parameters
+
+    def samples(self, metric, since=None, until=None, commit=None, kind=None):
+        """
+        :return: List of (recorded_at, value) of metric in the window, oldest first
+        """
+        sql, parameters = self._window('SELECT samples.recorded_at, samples.value FROM samples '
+                                       'JOIN runs ON runs.run_id = samples.run_id', 'samples.recorded_at',
+                                       since, until, commit, kind, metric)
+        rows = self._execute(sql + ' ORDER BY samples.recorded_at', parameters)
+        return [(row['recorded_at'], row['value']) for row in rows]
+
+    def outcomes(self, since=None, until=None, commit=None, kind=None):
+        """
+        :return: Map of every job status to the number of updates which ended with it
+        """
+        sql, parameters = self._window('SELECT updates.status, COUNT(*) AS count FROM updates '
+                                       'JOIN runs ON runs.run_id = updates.run_id', 'updates.recorded_at',
+                                       since, until, commit, kind)
+        return {row['status']: row['count'] for row in self._execute(sql + ' GROUP BY updates.status', parameters)}
+
+    def distribution(self, metric, bucket_sec=BUCKETS_SEC['day'], since=None, until=None, commit=None, kind=None):
+        """
+        Percentiles of metric per time bucket.
+        :return: List of (start of the bucket, summarize() of its values), oldest first
+        """
+        buckets = {}
+        for recorded_at, value in self.samples(metric, since, until, commit, kind):
+            buckets.setdefault(recorded_at - recorded_at % bucket_sec, []).append(value)
+        return [(start, summarize(values)) for start, values in sorted(buckets.items())]
+
+    def compare(self, baseline, current, metrics=None, significance=SIGNIFICANCE, min_change_percent=MIN_CHANGE_PERCENT):
+        """
+        Compare metrics between two windows, each a dict of the since, until, commit and
+        kind filters of samples().
+        :return: List of dicts with the metric, the samples and p50 of either window, the
+            change of the p50 in percent, the p-value of the current window being slower and
+            whether that is a regression
+        """
+        rows = []
+        for metric in metrics or self.metrics():
+            before = [value for _, value in self.samples(metric, **baseline)]
+            after = [value for _, value in self.samples(metric, **current)]
+            old, new = percentile(before, 50), percentile(after, 50)
+            change = round((new - old) / old * 100, 1) if old and new is not None else None
+            _, p_value = mann_whitney_u(before, after)
+            rows.append({
+                'metric': metric,
+                'baseline_samples': len(before),
+                'baseline_p50': old,
+                'samples': len(after),
+                'p50': new,
+                'change_percent': change,
+                'p_value': None if p_value is None else round(p_value, 4),
+                'regression': bool(p_value is not None and p_value < significance
+                                   and change is not None and change > min_change_percent),
+            })
+        return rows
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class RunRecorder:
+    """
+    Record one run into the history, never failing the run: errors of the database are logged.
+    """
+
+    def __init__(self, history, kind, **run_fields):
+        self.history = history
+        self.run_id = None
+        self.succeeded = 0
+        self.failed = 0
+        try:
+            self.run_id = history.start_run(kind, **run_fields)
+        except Exception as e:
+            logger.warning(f'Unable to record the run into {history.path}: {e}')
+
+    def _guard(self, fn, *args, **kwargs):
+        if self.run_id is None:
+            return
+        try:
+            fn(self.run_id, *args, **kwargs)
+        except Exception as e:
+            logger.warning(f'Unable to record the run into {self.history.path}: {e}')
+
+    def sample(self, metric, value, version_build=None):
+        self._guard(self.history.add_sample, metric, value, version_build)
+
+    def samples(self, metric, values):
+        self._guard(self.history.add_samples, metric, values)
+
+    def update(self, version_build, ota_update_id, status, image_bytes=None):
+        if status == 'SUCCEEDED':
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        self._guard(self.history.record_update, version_build, ota_update_id, status, image_bytes)
+
+    def device(self, device_metrics, restarts=()):
+        """
+        Record the device side timings of the updates parsed by an OtaLogParser, and those of the restarts of RunBinary.
+        """
+        for metric, values in device_samples(device_metrics, restarts).items():
+            self.samples(metric, values)
+
+    def finish(self):
+        self._guard(self.history.finish_run, self.succeeded, self.failed)
+
+
+def device_samples(device_metrics, restarts=()):
+    """
+    The device side timings of the updates parsed by an OtaLogParser, and those of the restarts of RunBinary.
+    :return: Map of every metric to its samples, in seconds
+    """
+    updates = device_metrics.summary()
+    return {
+        'job_document': [update['time_to_job_document_sec'] for update in updates],
+        'download': [update['transfer_sec'] for update in updates],
+        'restart': [update['verification_to_self_test_sec'] for update in updates],
+        'exit_to_run': [restart['exit_to_start_sec'] for restart in restarts],
+        'image_to_run': [restart['landed_to_start_sec'] for restart in restarts],
+    }
+
+
+def _format_value(value, width=10):
+    return f'{value:>{width}.4f}' if isinstance(value, float) else f'{"-" if value is None else value:>{width}}'
+
+
+def format_distribution(metric, rows, bucket_sec):
+    time_format = '%Y-%m-%d %H:%M' if bucket_sec < BUCKETS_SEC['day'] else '%Y-%m-%d'
+    lines = [f"{metric:<18}{'samples':>8}{'p50':>10}{'p95':>10}{'max':>10}"]
+    for start, stats in rows:
+        lines.append(f"{datetime.fromtimestamp(start).strftime(time_format):<18}{stats['samples']:>8}"
+                     f"{_format_value(stats['p50'])}{_format_value(stats['p95'])}{_format_value(stats['max'])}")
+    return '\n'.join(lines)
+
+
+def format_comparison(rows):
+    lines = [f"{'metric':<16}{'base n':>7}{'base p50':>10}{'n':>5}{'p50':>10}{'change':>9}{'p-value':>9}"]
+    for row in rows:
+        change = '-' if row['change_percent'] is None else f"{row['change_percent']:+.1f}%"
+        lines.append(f"{row['metric']:<16}{row['baseline_samples']:>7}{_format_value(row['baseline_p50'])}"
+                     f"{row['samples']:>5}{_format_value(row['p50'])}{change:>9}{_format_value(row['p_value'], 9)}"
+                     f"{'  REGRESSION' if row['regression'] else ''}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Report and compare the OTA timings recorded by the canary and benchmark runs')
+    parser.add_argument('--db', default=None, help='Run history database, run_history_path of the project by default')
+    parser.add_argument('--kind', default=None, help='Only the runs of this kind, e.g. canary or benchmark')
+    parser.add_argument('--json', action='store_true', help='Print the result as JSON')
+    commands = parser.add_subparsers(dest='command')
+
+    runs_parser = commands.add_parser('runs', help='List the last runs')
+    runs_parser.add_argument('--limit', type=int, default=20)
+
+    report_parser = commands.add_parser('report', help='Percentiles of a metric per time bucket')
+    report_parser.add_argument('--metric', action='append', help='Metric to report, every metric by default')
+    report_parser.add_argument('--bucket', choices=sorted(BUCKETS_SEC), default='day')
+    report_parser.add_argument('--since', default=None, help='e.g. 7d, 12h or 2024-05-01')
+    report_parser.add_argument('--until', default=None)
+    report_parser.add_argument('--commit', default=None, help='Only the runs of this commit')
+
+    compare_parser = commands.add_parser('compare', help='Flag the regressions of a window or commit against a baseline')
+    compare_parser.add_argument('--metric', action='append', help=f'Metric to compare, {", ".join(REGRESSION_METRICS)} by default')
+    compare_parser.add_argument('--baseline-since', default=None, help='e.g. 14d')
+    compare_parser.add_argument('--baseline-until', default=None, help='e.g. 7d')
+    compare_parser.add_argument('--baseline-commit', default=None)
+    compare_parser.add_argument('--since', default=None, help='e.g. 7d')
+    compare_parser.add_argument('--until', default=None)
+    compare_parser.add_argument('--commit', default=None)
+    compare_parser.add_argument('--significance', type=float, default=SIGNIFICANCE)
+    compare_parser.add_argument('--min-change', type=float, default=MIN_CHANGE_PERCENT, help='In percent of the baseline p50')
+    args = parser.parse_args(argv)
+
+    path = args.db or OtaProject().run_history_path
+    if not path or not Path(path).exists():
+        print(f'No run history at {path}')
+        return 1
+    now = time.time()
+    with RunHistory(path) as history:
+        if args.command == 'report':
+            since, until = parse_time(args.since, now), parse_time(args.until, now)
+            result = {metric: history.distribution(metric, BUCKETS_SEC[args.bucket], since, until, args.commit, args.kind)
+                      for metric in args.metric or history.metrics()}
+            result_outcomes = history.outcomes(since, until, args.commit, args.kind)
+            if args.json:
+                print(json.dumps({'metrics': result, 'outcomes': result_outcomes}, indent=2))
+            else:
+                print('\n\n'.join(format_distribution(metric, rows, BUCKETS_SEC[args.bucket]) for metric, rows in result.items()))
+                print(f'\nOutcomes: {result_outcomes}')
+            return 0
+        if args.command == 'compare':
+            baseline = {'since': parse_time(args.baseline_since, now), 'until': parse_time(args.baseline_until, now),
+                        'commit': args.baseline_commit, 'kind': args.kind}
+            current = {'since': parse_time(args.since, now), 'until': parse_time(args.until, now),
+                       'commit': args.commit, 'kind': args.kind}
+            rows = history.compare(baseline, current, args.metric or list(REGRESSION_METRICS),
+                                   args.significance, args.min_change)
+            print(json.dumps(rows, indent=2) if args.json else format_comparison(rows))
+            return 1 if any(row['regression'] for row in rows) else 0
+
+        runs = history.runs(kind=args.kind, limit=getattr(args, 'limit', 20))
+        if args.json:
+            print(json.dumps(runs, indent=2))
+        else:
+            for run in runs:
+                started = datetime.fromtimestamp(run['started_at']).isoformat(timespec='seconds')
+                print(f"{run['run_id'][:12]}  {started}  {run['kind']:<10} {str(run['thing_name']):<24} "
+                      f"{(run['repository_commit'] or '-')[:10]:<11}{run['succeeded']} succeeded, {run['failed']} failed")
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
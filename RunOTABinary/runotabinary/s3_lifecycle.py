@@ -0,0 +1,216 @@
+# Expire the firmware versions piling up in the versioned bucket, following a retention
+# policy. Versions are listed and deleted as a stream, one page and one batch at a time.
+import sys
+import json
+import time
+import heapq
+import argparse
+from dataclasses import dataclass, asdict
+from runotabinary import aws_clients, tracing
+from runotabinary.configs.config_project import OtaProject
+from runotabinary.garbage_collector import age_sec
+from runotabinary.logger import logger
+
+# Most keys and versions a delete_objects request accepts
+DELETE_BATCH_SIZE = 1000
+
+
+@dataclass
+class RetentionPolicy:
+    """
+    Versions to keep: the keep_last newest ones, and only those younger than max_age_sec.
+    A limit left to None or 0 does not apply.
+
+    The versions are ranked across the prefix, so that the keep_last newest builds are kept
+    whatever their keys: content addressed keys hold one build each. per_key ranks the
+    versions of every key on their own instead.
+    """
+
+    keep_last: int = None
+    max_age_sec: float = None
+    per_key: bool = False
+
+    def expired(self, rank, age):
+        """
+        :param rank: Position of the version among the versions it is ranked with, 0 for the newest
+        :param age: Age of the version in seconds
+        """
+        return bool((self.keep_last and rank >= self.keep_last) or (self.max_age_sec and age > self.max_age_sec))
+
+
+@dataclass
+class LifecycleReport:
+    """
+    Counters of a lifecycle run. In a dry run, deleted counts what would have been deleted.
+    """
+
+    dry_run: bool = False
+    scanned: int = 0
+    scanned_bytes: int = 0
+    expired: int = 0
+    expired_bytes: int = 0
+    deleted: int = 0
+    failed: int = 0
+    requests: int = 0
+    seconds: float = 0.0
+
+    def as_dict(self):
+        report = asdict(self)
+        report['seconds'] = round(self.seconds, 3)
+        return report
+
+
+def object_versions(client, bucket, prefix='', page_size=1000):
+    """
+    Iterate over the versions and delete markers under prefix, page by page: keys in order,
+    the versions of every key newest first.
+    """
+    kwargs = {'Bucket': bucket, 'Prefix': prefix, 'MaxKeys': page_size}
+    while True:
+        response = client.list_object_versions(**kwargs)
+        entries = [dict(entry, IsDeleteMarker=False) for entry in response.get('Versions', [])]
+        entries += [dict(entry, IsDeleteMarker=True, Size=0) for entry in response.get('DeleteMarkers', [])]
+        # Versions and delete markers come in two lists, merge them back in listing order
+        entries.sort(key=lambda entry: entry['LastModified'], reverse=True)
+        entries.sort(key=lambda entry: entry['Key'])
+        for entry in entries:
+            yield entry
+        if not response.get('IsTruncated'):
+            return
+        kwargs['KeyMarker'] = response.get('NextKeyMarker')
+        kwargs['VersionIdMarker'] = response.get('NextVersionIdMarker')
+
+
+class ArtifactLifecycle:
+    """
+    Delete the versions of the objects of a versioned bucket which a retention policy
+    expires, with delete_objects requests of up to DELETE_BATCH_SIZE versions.
+
+    At most one page of the listing and one batch are held in memory, so that buckets
+    holding any number of versions can be processed.
+    """
+
+    def __init__(self, bucket, client=None, page_size=1000, batch_size=DELETE_BATCH_SIZE):
+        self.bucket = bucket
+        self._client = client
+        self.page_size = page_size
+        self.batch_size = min(batch_size, DELETE_BATCH_SIZE)
+
+    @property
+    def client(self):
+        return self._client if self._client is not None else aws_clients.get_client('s3')
+
+    def expired_versions(self, policy, prefix='', report=None):
+        """
+        Iterate over the versions under prefix which policy expires. Ranked across the
+        prefix, a version is expired once keep_last newer ones were listed, only the
+        keep_last newest versions listed so far are held in memory.
+        """
+        now = time.time()
+        key, rank = None, 0
+        # (-age, listing index, version) of the newest versions listed so far, oldest first
+        newest = []
+        for index, entry in enumerate(object_versions(self.client, self.bucket, prefix, self.page_size)):
+            if report is not None:
+                report.scanned += 1
+                report.scanned_bytes += entry.get('Size', 0)
+            age = age_sec(entry.get('LastModified'), now)
+            if policy.per_key:
+                # The versions of a key can span pages, the rank carries over
+                rank = rank + 1 if entry['Key'] == key else 0
+                key = entry['Key']
+            else:
+                rank = 0
+                if policy.keep_last and not policy.expired(rank, age):
+                    heapq.heappush(newest, (-age, index, entry))
+                    if len(newest) <= policy.keep_last:
+                        continue
+                    # The oldest of the kept versions, possibly this one, drops out of the newest
+                    _, _, entry = heapq.heappop(newest)
+                    rank = policy.keep_last
+            if policy.expired(rank, age):
+                if report is not None:
+                    report.expired += 1
+                    report.expired_bytes += entry.get('Size', 0)
+                yield entry
+
+    def delete_versions(self, versions, report=None, dry_run=False):
+        """
+        Delete versions, i.e. dicts with Key and VersionId, in batches. A VersionId of None
+        deletes the object of an unversioned bucket.
+        :return: The report
+        """
+        report = report if report is not None else LifecycleReport(dry_run=dry_run)
+        batch = []
+        for version in versions:
+            batch.append({'Key': version['Key'], **({'VersionId': version['VersionId']} if version['VersionId'] else {})})
+            if len(batch) == self.batch_size:
+                self._delete_batch(batch, report, dry_run)
+                batch = []
+        if batch:
+            self._delete_batch(batch, report, dry_run)
+        return report
+
+    def _delete_batch(self, batch, report, dry_run):
+        if dry_run:
+            report.deleted += len(batch)
+            return
+        with tracing.span('s3.delete_batch', bucket=self.bucket, versions=len(batch)) as batch_span:
+            report.requests += 1
+            try:
+                response = self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': batch, 'Quiet': True})
+            except Exception as e:
+                logger.error(f"Unable to delete a batch of {len(batch)} versions from {self.bucket}: {e}")
+                report.failed += len(batch)
+                batch_span.set(failed=len(batch))
+                return
+            errors = response.get('Errors', [])
+            for error in errors[:10]:
+                logger.error(f"Unable to delete {error.get('Key')} version {error.get('VersionId')}: {error.get('Code')}")
+            report.failed += len(errors)
+            report.deleted += len(batch) - len(errors)
+            batch_span.set(failed=len(errors))
+
+    def apply(self, policy, prefix='', dry_run=False):
+        """
+        Delete the versions under prefix which policy expires.
+        :return: LifecycleReport of the run
+        """
+        report = LifecycleReport(dry_run=dry_run)
+        start = time.monotonic()
+        with tracing.span('s3.lifecycle', bucket=self.bucket, prefix=prefix, dry_run=dry_run):
+            self.delete_versions(self.expired_versions(policy, prefix, report), report, dry_run)
+        report.seconds = time.monotonic() - start
+        logger.info(f"Lifecycle of s3://{self.bucket}/{prefix}: {report.as_dict()}")
+        return report
+
+
+def format_report(report):
+    action = 'Would delete' if report.dry_run else 'Deleted'
+    return (f"Scanned {report.scanned} versions ({report.scanned_bytes} bytes), {report.expired} expired "
+            f"({report.expired_bytes} bytes). {action} {report.deleted}, {report.failed} failed, "
+            f"in {report.requests} requests and {report.seconds:.3f}s")
+
+
+def main(argv=None):
+    project = OtaProject()
+    parser = argparse.ArgumentParser(description='Delete the firmware versions of the bucket expired by a retention policy')
+    parser.add_argument('--keep-last', type=int, default=project.s3_keep_last_versions,
+                        help='Number of versions kept under the prefix, 0 to keep them all')
+    parser.add_argument('--per-key', action='store_true', help='Keep the last versions of every key instead')
+    parser.add_argument('--max-age-days', type=float, default=project.s3_max_age_days,
+                        help='Versions older than this are deleted, 0 to keep them whatever their age')
+    parser.add_argument('--prefix', default=f'{project.s3_content_prefix}/', help='Only process the keys under this prefix')
+    parser.add_argument('--dry-run', action='store_true', help='Only report what would be deleted')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args(argv)
+
+    aws_clients.configure_from_project(project)
+    policy = RetentionPolicy(keep_last=args.keep_last, max_age_sec=args.max_age_days * 24 * 60 * 60, per_key=args.per_key)
+    report = ArtifactLifecycle(project.s3_bucket_name).apply(policy, args.prefix, args.dry_run)
+    print(json.dumps(report.as_dict(), indent=2) if args.json else format_report(report))
+    return 1 if report.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
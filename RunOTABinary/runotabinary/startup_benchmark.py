@@ -0,0 +1,95 @@
+import re
+import os
+import sys
+import json
+import argparse
+import subprocess
+from pathlib import Path
+
+# Modules which must only be imported by the code paths that need them
+HEAVY_MODULES = ('boto3', 'botocore', 'paho', 'OpenSSL')
+
+PYPROJECT_PATH = Path(__file__).resolve().parent.parent / 'pyproject.toml'
+# Directory holding the runotabinary package, importable by the probes wherever they run from
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+
+_IMPORT_PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(','.join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+
+def entry_points(pyproject_path=PYPROJECT_PATH):
+    """
+    Read the console scripts of the project.
+    :return: Dict of script name to the module implementing it
+    """
+    scripts = {}
+    in_scripts = False
+    for line in Path(pyproject_path).read_text().splitlines():
+        if line.startswith('['):
+            in_scripts = line.strip() == '[tool.poetry.scripts]'
+            continue
+        match = re.match(r'\s*([\w-]+)\s*=\s*"([\w.]+):\w+"', line)
+        if in_scripts and match:
+            scripts[match.group(1)] = match.group(2)
+    return scripts
+
+
+def measure_import(module, repeat=5):
+    """
+    Import a module in fresh interpreters.
+    :return: Best import time in milliseconds and the heavy modules the import pulled in
+    """
+    best = None
+    heavy = []
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(PACKAGE_ROOT), env.get('PYTHONPATH')]))
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, '-c', _IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8', check=True, env=env
+        )
+        elapsed, loaded = result.stdout.splitlines()[-2:]
+        best = min(best, float(elapsed)) if best is not None else float(elapsed)
+        heavy = [name for name in loaded.split(',') if name]
+    return round(best * 1000, 2), heavy
+
+
+def run(repeat=5, pyproject_path=PYPROJECT_PATH):
+    """
+    Measure every entry point of the project.
+    :return: List of dicts with the script, its module, import time and heavy modules
+    """
+    report = []
+    for script, module in entry_points(pyproject_path).items():
+        import_ms, heavy = measure_import(module, repeat)
+        report.append({'script': script, 'module': module, 'import_ms': import_ms, 'heavy_modules': heavy})
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the import time of every entry point')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=None,
+                        help='Fail if an entry point takes longer than this to import')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+
+    report = run(args.repeat)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for entry in report:
+            print(f"{entry['script']:<12} {entry['module']:<32} {entry['import_ms']:>8.2f} ms  {','.join(entry['heavy_modules'])}")
+
+    failed = [entry for entry in report if entry['heavy_modules']
+              or (args.budget_ms is not None and entry['import_ms'] > args.budget_ms)]
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import math
+
+
+def percentile(values, percent):
+    """
+    Nearest rank percentile of values, None when there are none.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(percent / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def summarize(values, digits=4):
+    """
+    :return: Dict with the number of samples, mean, min, p50, p95 and max of values
+    """
+    values = [value for value in values if value is not None]
+    if not values:
+        return {'samples': 0, 'mean': None, 'min': None, 'p50': None, 'p95': None, 'max': None}
+    return {
+        'samples': len(values),
+        'mean': round(sum(values) / len(values), digits),
+        'min': round(min(values), digits),
+        'p50': round(percentile(values, 50), digits),
+        'p95': round(percentile(values, 95), digits),
+        'max': round(max(values), digits),
+    }
+
+
+def mann_whitney_u(baseline, current):
+    """
+    One-sided Mann-Whitney U test of current being larger than baseline, with the normal
+    approximation and the tie correction. It makes no assumption on the distribution of
+    the values, which for latencies is rarely normal.
+    :return: (U statistic of current, p-value), p-value None when either side has no values
+    """
+    baseline = [value for value in baseline if value is not None]
+    current = [value for value in current if value is not None]
+    n1, n2 = len(current), len(baseline)
+    if not n1 or not n2:
+        return None, None
+
+    # Ranks of the pooled values, ties get the mean of their ranks
+    pooled = sorted([(value, 0) for value in current] + [(value, 1) for value in baseline])
+    ranks = [0.0] * len(pooled)
+    ties = 0.0
+    start = 0
+    while start < len(pooled):
+        end = start
+        while end + 1 < len(pooled) and pooled[end + 1][0] == pooled[start][0]:
+            end += 1
+        for index in range(start, end + 1):
+            ranks[index] = (start + end) / 2 + 1
+        count = end - start + 1
+        ties += count ** 3 - count
+        start = end + 1
+
+    u = sum(rank for rank, (_, side) in zip(ranks, pooled) if side == 0) - n1 * (n1 + 1) / 2
+    n = n1 + n2
+    variance = n1 * n2 / 12 * ((n + 1) - ties / (n * (n - 1))) if n > 1 else 0
+    if variance <= 0:
+        return u, 1.0
+    # Continuity correction
+    z = (u - n1 * n2 / 2 - 0.5) / math.sqrt(variance)
+    return u, 0.5 * math.erfc(z / math.sqrt(2))
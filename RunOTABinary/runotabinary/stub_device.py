@@ -0,0 +1,94 @@
+# Stand-in for the OTA demo used by the offline benchmark. The build stamps the
+# application version below and prepends an interpreter line, the resulting file is run
+# by RunBinary like the real demo. It only uses the standard library so that it runs
+# without the package installed.
+#
+# The device reads stub_device.json from its working directory, waits for job documents
+# written by the offline backend, downloads the image block by block while printing the
+# lines of the OTA agent, writes it next to itself and exits to be restarted on the new
+# image, which then runs its self-test and reports the job as succeeded.
+import os
+import sys
+import json
+import time
+from pathlib import Path
+
+APP_VERSION = '@APP_VERSION@'
+CONFIG_FILE = 'stub_device.json'
+PENDING_FILE = 'stub_device.pending'
+
+
+def log(message):
+    print(f'[OTA] {message}', flush=True)
+
+
+def report(jobs_dir, job_id, status, reason=''):
+    path = jobs_dir / f'{job_id}.status'
+    tmp_path = jobs_dir / f'.{job_id}.status.tmp'
+    tmp_path.write_text(json.dumps({'status': status, 'reason': reason}))
+    tmp_path.replace(path)
+
+
+def download(job, jobs_dir, config):
+    job_id = job['jobId']
+    log(f'Received OTA job document {job_id}')
+    report(jobs_dir, job_id, 'IN_PROGRESS', 'downloading')
+    block_size = config.get('block_size', 4096)
+    block_delay = config.get('block_delay_sec', 0.0)
+    for entry in job['files']:
+        target = Path(entry['fileName'])
+        tmp_target = target.with_name(f'.{target.name}.part')
+        with open(entry['filePath'], 'rb') as source, open(tmp_target, 'wb') as image:
+            index = 0
+            while True:
+                log('Requesting the next file block')
+                block = source.read(block_size)
+                if not block:
+                    break
+                if block_delay:
+                    time.sleep(block_delay)
+                image.write(block)
+                log(f'Received valid file block: Block index={index}, Size={len(block)}')
+                index += 1
+        os.chmod(tmp_target, 0o755)
+        tmp_target.replace(target)
+    log('Received final block of the update')
+    log('Received entire update and validated the signature')
+    Path(PENDING_FILE).write_text(job_id)
+    log('Attempting to activate the new image')
+
+
+def main():
+    config = json.loads(Path(CONFIG_FILE).read_text())
+    jobs_dir = Path(config['jobs_dir']) / config['thing_name']
+    jobs_dir.mkdir(parents=True, exist_ok=True)
+    stop_file = Path(config['stop_file'])
+    log(f'Application version {APP_VERSION}')
+
+    pending = Path(PENDING_FILE)
+    if pending.exists():
+        job_id = pending.read_text().strip()
+        log('In self test mode')
+        pending.unlink()
+        log('Image version is valid')
+        report(jobs_dir, job_id, 'SUCCEEDED', f'accepted v{APP_VERSION}')
+
+    poll_sec = config.get('poll_sec', 0.01)
+    while not stop_file.exists():
+        for document in sorted(jobs_dir.glob('*.json')):
+            if (jobs_dir / f'{document.stem}.status').exists():
+                continue
+            try:
+                job = json.loads(document.read_text())
+            except (OSError, ValueError):
+                # Canceled or still being written
+                continue
+            download(job, jobs_dir, config)
+            return 0
+        time.sleep(poll_sec)
+    log('Stopping')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,230 @@
+# Watch the working directory of a device for the images written by its OTA downloads,
+# so that RunBinary restarts on a new image as soon as it is complete.
+import os
+import re
+import stat
+import time
+import select
+import struct
+import threading
+import subprocess
+from pathlib import Path
+from runotabinary.logger import logger
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+_EVENT_HEADER = struct.Struct('iIII')
+
+# Name of the images downloaded by the device: <binary>_<file version>
+IMAGE_NAME = '{prefix}_(\\d+)'
+
+
+def make_executable(path):
+    """
+    Give execute permission on path in-process, through sudo only if the file belongs to another user.
+    """
+    try:
+        mode = os.stat(path).st_mode
+        if mode & stat.S_IXUSR:
+            return
+        os.chmod(path, mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    except PermissionError:
+        logger.warning(f'Unable to make {path} executable, retrying with sudo')
+        subprocess.run(['sudo', 'chmod', '777', str(path)], check=True)
+
+
+def _inotify():
+    """
+    :return: The libc functions of inotify, None where inotify is not available
+    """
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        return libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+
+
+class ImageWatcher:
+    """
+    Report the images landing in a directory.
+
+    An image is a file named <prefix>_<file version>, e.g. ota_demo_core_mqtt_3 for the
+    prefix ota_demo_core_mqtt, which did not exist when the watcher started. It lands
+    once it is complete: as soon as the writer renames it into place, or once its size
+    and mtime stay the same for settle_sec after the writer closed it (inotify) or
+    after it was last seen changing (polling fallback). Landing times are
+    time.monotonic() seconds.
+    """
+
+    def __init__(self, directory, prefix, use_inotify=True, poll_interval=0.02, settle_sec=0.1):
+        self.directory = Path(directory)
+        self.prefix = prefix
+        self.use_inotify = use_inotify
+        self.poll_interval = poll_interval
+        self.settle_sec = settle_sec
+        self.mode = None
+        self._pattern = re.compile(IMAGE_NAME.format(prefix=re.escape(prefix)))
+        self._known = set()
+        self._landed = {}
+        self._pending = {}
+        self._cv = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        self._fd = None
+
+    def is_candidate(self, name):
+        return self._pattern.fullmatch(name) is not None and name not in self._known
+
+    def start(self):
+        self._known.update(entry.name for entry in os.scandir(self.directory))
+        functions = _inotify() if self.use_inotify else None
+        if functions is not None:
+            inotify_init1, inotify_add_watch = functions
+            fd = inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0 and inotify_add_watch(fd, str(self.directory).encode(), IN_CLOSE_WRITE | IN_MOVED_TO) >= 0:
+                self._fd = fd
+                self.mode = 'inotify'
+            elif fd >= 0:
+                os.close(fd)
+        if self._fd is None:
+            self.mode = 'poll'
+        self._thread = threading.Thread(target=self._watch, name=f'image-watcher-{self.prefix}', daemon=True)
+        self._thread.start()
+        logger.debug(f'Watching {self.directory} for {self.prefix} images ({self.mode})')
+        return self
+
+    def stop(self):
+        with self._cv:
+            self._stopped = True
+            self._cv.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def wake(self):
+        """
+        Wake up the callers of wait_for_image so that they check should_stop.
+        """
+        with self._cv:
+            self._cv.notify_all()
+
+    def _land(self, name, landed_at):
+        with self._cv:
+            if name in self._known:
+                return
+            self._landed[name] = landed_at
+            self._cv.notify_all()
+        logger.debug(f'Image {name} landed in {self.directory}')
+
+    def _watch(self):
+        if self.mode == 'inotify':
+            self._watch_inotify()
+        else:
+            self._watch_polling()
+
+    def _watch_inotify(self):
+        while not self._stopped:
+            readable, _, _ = select.select([self._fd], [], [], min(self.settle_sec, 0.2) if self._pending else 0.2)
+            now = time.monotonic()
+            if readable:
+                try:
+                    data = os.read(self._fd, 64 * 1024)
+                except BlockingIOError:
+                    data = b''
+                self._read_events(data, now)
+            # Closed images land once no other write followed for settle_sec
+            self._settle(list(self._pending), now)
+
+    def _read_events(self, data, now):
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + _EVENT_HEADER.size:offset + _EVENT_HEADER.size + length].rstrip(b'\0').decode()
+            offset += _EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                logger.warning(f'Lost events watching {self.directory}, checking the directory')
+                self._scan(now)
+            elif not self.is_candidate(name):
+                continue
+            elif mask & IN_MOVED_TO:
+                self._pending.pop(name, None)
+                self._land(name, now)
+            else:
+                # A close may end a partial write, wait for the size to settle
+                self._pending[name] = (self._state(name), now)
+
+    def _state(self, name):
+        try:
+            info = os.stat(self.directory / name)
+        except FileNotFoundError:
+            return None
+        return info.st_size, info.st_mtime_ns
+
+    def _settle(self, names, now):
+        """
+        Land the candidates among names whose size and mtime did not change for settle_sec,
+        as of when they stopped changing.
+        """
+        for name in names:
+            state = self._state(name)
+            previous = self._pending.get(name)
+            if state is None:
+                self._pending.pop(name, None)
+            elif previous is None or previous[0] != state:
+                self._pending[name] = (state, now)
+            elif now - previous[1] >= self.settle_sec:
+                self._pending.pop(name, None)
+                if name not in self._landed:
+                    self._land(name, previous[1])
+
+    def _scan(self, now):
+        """
+        Check every candidate of the directory, see _settle().
+        """
+        self._settle([entry.name for entry in os.scandir(self.directory)
+                      if self.is_candidate(entry.name) and entry.is_file()], now)
+
+    def _watch_polling(self):
+        while not self._stopped:
+            self._scan(time.monotonic())
+            with self._cv:
+                self._cv.wait(self.poll_interval)
+
+    def wait_for_image(self, expected=None, timeout=None, should_stop=None):
+        """
+        Wait for an image to land. The expected name is preferred, otherwise the image
+        which landed last is returned, whatever its version. The image returned is never
+        returned again.
+        :return: (path, landed_at in time.monotonic() seconds), None on timeout or when should_stop() is true
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._cv:
+            while True:
+                if expected in self._landed:
+                    name = expected
+                elif self._landed:
+                    name = max(self._landed, key=self._landed.get)
+                else:
+                    name = None
+                if name is not None:
+                    landed_at = self._landed.pop(name)
+                    self._known.add(name)
+                    self._pending.pop(name, None)
+                    return self.directory / name, landed_at
+                if should_stop is not None and should_stop():
+                    return None
+                remaining = deadline - time.monotonic() if deadline is not None else 0.2
+                if remaining <= 0:
+                    return None
+                self._cv.wait(min(remaining, 0.2))
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
@@ -0,0 +1,287 @@
+# Call layer of the AWS clients: every API gets its own token bucket, throttling and
+# transient errors are retried with jittered exponential backoff, and the calls, throttles
+# and time spent waiting are counted per API.
+import time
+import random
+import threading
+from runotabinary.logger import logger
+
+# Calls per second allowed per API, kept under the per account quotas of AWS IoT so that
+# several canaries can share an account. APIs not listed are not rate limited.
+DEFAULT_RATES = {
+    'iot.create_ota_update': 1.0,
+    'iot.get_ota_update': 10.0,
+    'iot.delete_ota_update': 5.0,
+    'iot.list_ota_updates': 5.0,
+    'iot.describe_job_execution': 10.0,
+    'iot.list_job_executions_for_thing': 10.0,
+    'iot.cancel_job': 5.0,
+    'iot.list_streams': 5.0,
+    'iot.delete_stream': 5.0,
+    'acm.get_certificate': 10.0,
+}
+
+DEFAULT_CONFIG = {
+    'rates': DEFAULT_RATES,
+    'max_attempts': 5,
+    'base_delay_sec': 0.1,
+    'max_delay_sec': 20.0,
+}
+
+THROTTLING_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'TooManyRequestsException',
+    'RequestLimitExceeded', 'RequestThrottled', 'RequestThrottledException', 'SlowDown',
+}
+TRANSIENT_CODES = {
+    'InternalFailure', 'InternalError', 'InternalServerError', 'InternalServerException',
+    'ServiceUnavailable', 'ServiceUnavailableException', 'RequestTimeout', 'RequestTimeoutException',
+}
+# botocore exceptions raised when a request does not get a response, matched by name
+# so that botocore is not imported
+TRANSIENT_EXCEPTIONS = {
+    'EndpointConnectionError', 'ConnectionClosedError', 'ReadTimeoutError', 'ConnectTimeoutError',
+}
+
+_lock = threading.Lock()
+_config = dict(DEFAULT_CONFIG)
+_buckets = {}
+_counters = {}
+
+
+class TokenBucket:
+    """
+    Allow rate calls per second on average and bursts of burst calls. The rate adapts:
+    it is halved on every throttle, down to rate / 16, and recovers a little on every
+    success. A rate of 0 or None does not limit anything.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(1, burst if burst is not None else (rate or 1))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting for one if needed.
+        :return: Seconds waited
+        """
+        if not self.rate:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def throttled(self):
+        if self.rate:
+            with self._lock:
+                self.rate = max(self.max_rate / 16, self.rate / 2)
+
+    def succeeded(self):
+        if self.rate and self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+def configure(**kwargs):
+    """
+    Set the rates and retry settings, see DEFAULT_CONFIG. rates is merged into DEFAULT_RATES.
+    The buckets are rebuilt if a setting changes.
+    """
+    unknown = set(kwargs) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError(f'Unknown throttling settings: {sorted(unknown)}')
+    if 'rates' in kwargs:
+        kwargs['rates'] = dict(DEFAULT_RATES, **(kwargs['rates'] or {}))
+    with _lock:
+        config = dict(_config, **kwargs)
+        if config != _config:
+            _config.update(config)
+            _buckets.clear()
+
+
+def configure_from_project(project):
+    configure(
+        rates=project.aws_call_rates,
+        max_attempts=project.aws_max_attempts,
+        base_delay_sec=project.aws_retry_base_delay_sec,
+        max_delay_sec=project.aws_retry_max_delay_sec,
+    )
+
+
+def _bucket(api):
+    with _lock:
+        if api not in _buckets:
+            _buckets[api] = TokenBucket(_config['rates'].get(api))
+        return _buckets[api]
+
+
+def _count(api, **increments):
+    with _lock:
+        counters = _counters.setdefault(api, dict.fromkeys(
+            ('calls', 'attempts', 'throttles', 'transient_errors', 'errors', 'retry_delay_sec', 'wait_sec'), 0))
+        for name, value in increments.items():
+            counters[name] += value
+
+
+def classify(error):
+    """
+    :return: 'throttle', 'transient', or None for the errors which are not worth retrying
+    """
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        code = response.get('Error', {}).get('Code')
+        status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        if code in THROTTLING_CODES or status == 429:
+            return 'throttle'
+        if code in TRANSIENT_CODES or (status is not None and status >= 500):
+            return 'transient'
+        return None
+    if any(cls.__name__ in TRANSIENT_EXCEPTIONS for cls in type(error).__mro__):
+        return 'transient'
+    return None
+
+
+def backoff_delay(attempt):
+    """
+    Full jitter: a random delay up to base_delay_sec * 2^attempt, capped by max_delay_sec.
+    """
+    return random.uniform(0, min(_config['max_delay_sec'], _config['base_delay_sec'] * 2 ** attempt))
+
+
+def _stream_positions(args, kwargs):
+    """
+    Positions of the file objects among the arguments of a call, e.g. the Body of
+    put_object, which a retry has to rewind.
+    :return: List of (stream, position), position is None for the streams which can not seek
+    """
+    positions = []
+    for value in list(args) + list(kwargs.values()):
+        if hasattr(value, 'read'):
+            try:
+                positions.append((value, value.tell() if value.seekable() else None))
+            except (AttributeError, OSError):
+                positions.append((value, None))
+    return positions
+
+
+def call(service, operation, fn, *args, **kwargs):
+    """
+    Call fn once the token bucket of service.operation allows it, retrying throttling
+    and transient errors up to max_attempts attempts in total. File objects passed to fn
+    are rewound before a retry, calls streaming from one which can not seek are not retried.
+    """
+    api = f'{service}.{operation}'
+    bucket = _bucket(api)
+    max_attempts = max(1, _config['max_attempts'])
+    streams = _stream_positions(args, kwargs)
+    if any(position is None for _, position in streams):
+        max_attempts = 1
+    _count(api, calls=1)
+    for attempt in range(max_attempts):
+        _count(api, attempts=1, wait_sec=bucket.acquire())
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            kind = classify(e)
+            if kind == 'throttle':
+                bucket.throttled()
+                _count(api, throttles=1)
+            elif kind == 'transient':
+                _count(api, transient_errors=1)
+            if kind is None or attempt == max_attempts - 1:
+                _count(api, errors=1)
+                raise
+            delay = backoff_delay(attempt)
+            _count(api, retry_delay_sec=delay)
+            logger.warning(f'{api} failed ({kind}: {e}), retrying in {delay:.2f}s')
+            time.sleep(delay)
+            for stream, position in streams:
+                stream.seek(position)
+            continue
+        bucket.succeeded()
+        return result
+
+
+def counters():
+    """
+    Snapshot of the counters of every API called: calls, attempts, throttles,
+    transient_errors, errors (calls which failed for good), retry_delay_sec and wait_sec
+    (time spent waiting for the token bucket).
+    """
+    with _lock:
+        return {api: dict(values, retry_delay_sec=round(values['retry_delay_sec'], 3), wait_sec=round(values['wait_sec'], 3))
+                for api, values in _counters.items()}
+
+
+def format_counters():
+    lines = []
+    for api, values in sorted(counters().items()):
+        lines.append(f"{api}: {values['calls']} calls, {values['attempts']} attempts, {values['throttles']} throttles, "
+                     f"{values['errors']} errors, {values['retry_delay_sec']}s retry delay, {values['wait_sec']}s waiting")
+    return '\n'.join(lines)
+
+
+def reset():
+    """
+    Restore the default settings and drop the buckets and counters.
+    """
+    with _lock:
+        _config.clear()
+        _config.update(DEFAULT_CONFIG)
+        _buckets.clear()
+        _counters.clear()
+
+
+class ThrottledClient:
+    """
+    Proxy of an AWS client making every call through call(), including the page requests
+    of its paginators and the polls of its waiters, and so those of the resource collections.
+    """
+
+    def __init__(self, service, client):
+        self._service = service
+        self._client = client
+
+    @property
+    def wrapped(self):
+        return self._client
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name.startswith('_') or not callable(attribute) or name == 'can_paginate':
+            return attribute
+
+        def throttled_call(*args, **kwargs):
+            return call(self._service, name, attribute, *args, **kwargs)
+        return throttled_call
+
+    def get_paginator(self, operation_name):
+        paginator = self._client.get_paginator(operation_name)
+        # The paginator requests its pages from the method of the botocore client, point it at the proxy
+        paginator._method = getattr(self, operation_name)
+        return paginator
+
+    def get_waiter(self, waiter_name):
+        from botocore import xform_name
+        from botocore.waiter import NormalizedOperationMethod
+        waiter = self._client.get_waiter(waiter_name)
+        waiter._operation_method = NormalizedOperationMethod(getattr(self, xform_name(waiter.config.operation)))
+        return waiter
+
+
+def throttled_client(service, client):
+    if isinstance(client, ThrottledClient):
+        return client
+    return ThrottledClient(service, client)
@@ -0,0 +1,329 @@
+# Lightweight tracing of the work done by the tools: nestable spans with attributes,
+# timed with the monotonic clock and handed to exporters once finished. Spans cost next
+# to nothing while no exporter is configured.
+import os
+import json
+import time
+import itertools
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from runotabinary.logger import logger
+
+_lock = threading.Lock()
+_local = threading.local()
+_exporters = []
+_ids = itertools.count(1)
+_origin_ns = time.monotonic_ns()
+_origin_unix = time.time()
+
+# Keyword arguments of the AWS calls recorded as span attributes
+_CALL_ATTRIBUTES = {
+    'otaUpdateId': 'ota_update_id',
+    'jobId': 'job_id',
+    'thingName': 'thing',
+    'Bucket': 'bucket',
+    'Key': 'key',
+    'PartNumber': 'part',
+    'CertificateArn': 'certificate_arn',
+}
+
+
+class Span:
+    """
+    A timed piece of work. Attributes can be added until the span ends.
+    """
+
+    def __init__(self, name, parent_id=None, attributes=None, start_ns=None):
+        self.name = name
+        self.span_id = next(_ids)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start_ns = start_ns if start_ns is not None else time.monotonic_ns()
+        self.end_ns = None
+        self.error = None
+        thread = threading.current_thread()
+        self.thread_id = thread.ident
+        self.thread_name = thread.name
+
+    @property
+    def duration_ms(self):
+        return (self.end_ns - self.start_ns) / 1e6 if self.end_ns is not None else None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+        return self
+
+    def end(self, end_ns=None):
+        if self.end_ns is None:
+            self.end_ns = end_ns if end_ns is not None else time.monotonic_ns()
+            _export(self)
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_ns': self.start_ns - _origin_ns,
+            'start_unix': round(_origin_unix + (self.start_ns - _origin_ns) / 1e9, 6),
+            'duration_ms': round(self.duration_ms, 3) if self.end_ns is not None else None,
+            'thread': self.thread_name,
+            'error': self.error,
+            'attributes': self.attributes,
+        }
+
+
+class _NoopSpan:
+    span_id = None
+    attributes = {}
+
+    def set(self, **attributes):
+        return self
+
+    def end(self, end_ns=None):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def enabled():
+    return bool(_exporters)
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def current_span():
+    """
+    Innermost span opened with span() by the calling thread, None outside of any span.
+    """
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+def _parent_id(parent):
+    if parent is None:
+        parent = current_span()
+    return parent.span_id if parent is not None else None
+
+
+def start_span(name, parent=None, **attributes):
+    """
+    Start a span ended explicitly with end(), e.g. a span started and ended by different
+    threads. The parent defaults to the current span of the calling thread.
+    """
+    if not _exporters:
+        return _NOOP_SPAN
+    return Span(name, _parent_id(parent), attributes)
+
+
+@contextmanager
+def span(name, parent=None, **attributes):
+    """
+    Time the enclosed block. Spans opened inside the block, in the same thread, are its children.
+    """
+    if not _exporters:
+        yield _NOOP_SPAN
+        return
+    current = Span(name, _parent_id(parent), attributes)
+    stack = _stack()
+    stack.append(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        stack.remove(current)
+        current.end()
+
+
+def record(name, start, end, parent=None, **attributes):
+    """
+    Record a span which already happened, start and end being time.monotonic() seconds.
+    """
+    if not _exporters:
+        return _NOOP_SPAN
+    recorded = Span(name, _parent_id(parent), attributes, start_ns=int(start * 1e9))
+    recorded.end(int(end * 1e9))
+    return recorded
+
+
+def _export(finished):
+    for exporter in list(_exporters):
+        try:
+            exporter.export(finished)
+        except Exception as e:
+            logger.error(f"Unable to export span {finished.name}: {e}")
+
+
+class MemoryExporter:
+    """
+    Keep the finished spans in memory.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, finished):
+        with self._lock:
+            self.spans.append(finished)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonlExporter:
+    """
+    Append every finished span as one JSON line to a file, as soon as it ends.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, 'a', buffering=1)
+        self._lock = threading.Lock()
+
+    def export(self, finished):
+        line = json.dumps(finished.as_dict(), default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class ChromeTraceExporter(MemoryExporter):
+    """
+    Write the finished spans in the Chrome trace event format, which chrome://tracing
+    and Perfetto open. The file is rewritten on every flush.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = Path(path)
+
+    def events(self):
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self.spans)
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': 'runota'}}]
+        threads = {}
+        for finished in spans:
+            threads.setdefault(finished.thread_id, finished.thread_name)
+            args = dict(finished.attributes, span_id=finished.span_id, parent_id=finished.parent_id)
+            if finished.error:
+                args['error'] = finished.error
+            events.append({
+                'name': finished.name,
+                'cat': finished.name.split('.', 1)[0],
+                'ph': 'X',
+                'ts': (finished.start_ns - _origin_ns) / 1e3,
+                'dur': (finished.end_ns - finished.start_ns) / 1e3,
+                'pid': pid,
+                'tid': finished.thread_id,
+                'args': args,
+            })
+        for thread_id, thread_name in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread_id, 'args': {'name': thread_name}})
+        return events
+
+    def flush(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f'.{self.path.name}.tmp')
+        tmp_path.write_text(json.dumps({'traceEvents': self.events(), 'displayTimeUnit': 'ms'}, default=str))
+        tmp_path.replace(self.path)
+
+    def close(self):
+        self.flush()
+
+
+def add_exporter(exporter):
+    with _lock:
+        _exporters.append(exporter)
+    return exporter
+
+
+def remove_exporter(exporter):
+    with _lock:
+        if exporter in _exporters:
+            _exporters.remove(exporter)
+    exporter.close()
+
+
+def configure(jsonl_path=None, chrome_path=None):
+    """
+    Export the spans to a JSONL stream and/or a Chrome trace file. Paths already exported to are skipped.
+    """
+    with _lock:
+        paths = {str(getattr(exporter, 'path', '')) for exporter in _exporters}
+    if jsonl_path and str(Path(jsonl_path)) not in paths:
+        add_exporter(JsonlExporter(jsonl_path))
+    if chrome_path and str(Path(chrome_path)) not in paths:
+        add_exporter(ChromeTraceExporter(chrome_path))
+
+
+def configure_from_project(project):
+    configure(project.trace_jsonl_path, project.trace_chrome_path)
+
+
+def flush():
+    for exporter in list(_exporters):
+        exporter.flush()
+
+
+def reset():
+    """
+    Close and drop every exporter.
+    """
+    with _lock:
+        exporters = list(_exporters)
+        _exporters.clear()
+    for exporter in exporters:
+        exporter.close()
+
+
+class TracedClient:
+    """
+    Proxy of an AWS client running every call in an aws.<service>.<operation> span.
+    """
+
+    def __init__(self, service, client):
+        self._service = service
+        self._client = client
+
+    @property
+    def wrapped(self):
+        return self._client
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            if not _exporters:
+                return attribute(*args, **kwargs)
+            attributes = {_CALL_ATTRIBUTES[key]: value for key, value in kwargs.items() if key in _CALL_ATTRIBUTES}
+            with span(f'aws.{self._service}.{name}', **attributes):
+                return attribute(*args, **kwargs)
+        return call
+
+
+def traced_client(service, client):
+    if isinstance(client, TracedClient):
+        return client
+    return TracedClient(service, client)
@@ -0,0 +1,278 @@
+import time
+import heapq
+import itertools
+from threading import Thread, Condition, Lock
+from collections import namedtuple, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from runotabinary.logger import logger
+
+JobStatus = namedtuple('JobStatus', 'status reason')
+TrackedResult = namedtuple('TrackedResult', 'ota_update_id job_id status summary')
+
+FINISHED_JOB_STATUSES = {'CANCELED', 'SUCCEEDED', 'FAILED', 'REJECTED', 'REMOVED', 'TIMED_OUT'}
+FINISHED_CREATE_STATUSES = {'CREATE_COMPLETE', 'CREATE_FAILED'}
+# Job statuses kept for the updates whose job ID is not known yet, the oldest are dropped
+MAX_JOB_EVENTS = 1024
+
+
+class _Tracked:
+    """
+    State of a single OTA update followed by the tracker
+    """
+
+    def __init__(self, ota_update_id, thing_name, timeout, wait_for_job, interval):
+        self.ota_update_id = ota_update_id
+        self.thing_name = thing_name
+        self.wait_for_job = wait_for_job
+        self.deadline = time.monotonic() + timeout
+        self.interval = interval
+        self.job_id = None
+        self.last_status = None
+        self.errors = 0
+        self.ota_update_info = None
+        self.generation = 0
+        self.resolved = False
+        self.future = Future()
+
+
+class OtaUpdateTracker:
+    """
+    Follow many OTA updates and their job executions at once.
+
+    A single scheduler thread keeps every tracked update in a heap ordered by its next
+    poll time and hands due polls to a small thread pool. Polling starts fast right after
+    creation and backs off while the status does not change, IN_PROGRESS jobs are allowed
+    to back off the furthest since a download takes a while. Every track call returns a
+    Future which resolves once the update reaches a terminal state.
+
+    Job statuses pushed by a JobsObserver resolve the futures right away, the job
+    executions are then only polled every job_interval seconds as a fallback while the
+    creation of the updates is still polled with backoff. A failed poll is retried with
+    backoff until the timeout of the update.
+    """
+
+    def __init__(self, iot_client, max_workers=4, initial_interval=0.5, queued_interval=2.0,
+                 max_interval=10.0, backoff=1.5, job_interval=None):
+        self._iot_client = iot_client
+        self.initial_interval = initial_interval
+        self.queued_interval = queued_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.job_interval = job_interval
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._heap = []
+        self._counter = itertools.count()
+        self._cv = Condition()
+        self._closed = False
+        self._thread = None
+        self._resolve_lock = Lock()
+        self._by_job = {}
+        # (thing name, job ID) -> (status, reason) of the last status notified
+        self._job_events = OrderedDict()
+
+    def attach_observer(self, observer):
+        """
+        Resolve tracked jobs from the statuses reported by a JobsObserver.
+        """
+        observer.add_listener(self.notify_job_status)
+
+    def notify_job_status(self, thing_name, job_id, status, reason=''):
+        """
+        Report the status of a job execution learnt out of band. A terminal status resolves
+        the updates tracking the job on the thing. A None status, notified when the job left
+        the pending list without its final status being seen, makes them poll right away.
+        Other statuses, e.g. IN_PROGRESS, leave them as they are. The status is kept for
+        the updates whose job ID is not known yet.
+        """
+        with self._cv:
+            self._job_events[(thing_name, job_id)] = (status, reason)
+            self._job_events.move_to_end((thing_name, job_id))
+            while len(self._job_events) > MAX_JOB_EVENTS:
+                self._job_events.popitem(last=False)
+            entries = [entry for entry in self._by_job.get(job_id, ()) if entry.thing_name == thing_name]
+        for entry in entries:
+            self._apply_job_event(entry, status, reason)
+
+    def track_creation(self, ota_update_id, timeout=60, callback=None):
+        """
+        Follow an OTA update until it is CREATE_COMPLETE or CREATE_FAILED.
+        :param ota_update_id: AWS OTA update id
+        :param timeout: Seconds after which the future fails with TimeoutError
+        :param callback: Optional callable invoked with the future once it is done
+        :return: Future resolving to the otaUpdateInfo of the update
+        """
+        return self._track(_Tracked(ota_update_id, None, timeout, False, self.initial_interval), callback)
+
+    def track_job(self, ota_update_id, thing_name, timeout, callback=None):
+        """
+        Follow the job execution of an OTA update on a thing until it finishes.
+        :param ota_update_id: AWS OTA update id
+        :param thing_name: Thing whose job execution is followed
+        :param timeout: Seconds after which the update is reported as timed out
+        :param callback: Optional callable invoked with the future once it is done
+        :return: Future resolving to a TrackedResult
+        """
+        return self._track(_Tracked(ota_update_id, thing_name, timeout, True, self.initial_interval), callback)
+
+    def close(self):
+        """
+        Stop the scheduler, updates still tracked are cancelled.
+        """
+        with self._cv:
+            self._closed = True
+            pending = [entry for _, _, _, entry in self._heap]
+            self._heap = []
+            self._cv.notify_all()
+        for entry in pending:
+            entry.future.cancel()
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _track(self, entry, callback):
+        if callback is not None:
+            entry.future.add_done_callback(callback)
+        with self._cv:
+            if self._closed:
+                raise RuntimeError('Tracker is closed')
+            if self._thread is None:
+                self._thread = Thread(target=self._schedule, name='ota-tracker', daemon=True)
+                self._thread.start()
+        self._push(entry, 0)
+        return entry.future
+
+    def _push(self, entry, delay):
+        with self._cv:
+            if self._closed:
+                entry.future.cancel()
+                return
+            entry.generation += 1
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), entry.generation, entry))
+            self._cv.notify()
+
+    def _schedule(self):
+        while True:
+            with self._cv:
+                while not self._closed and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    self._cv.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                if self._closed:
+                    return
+                _, _, generation, entry = heapq.heappop(self._heap)
+            if generation == entry.generation and not entry.resolved:
+                self._pool.submit(self._poll, entry)
+
+    def _next_interval(self, entry, status):
+        if self.job_interval is not None and entry.job_id is not None and status not in FINISHED_CREATE_STATUSES:
+            entry.last_status = status
+            return self.job_interval
+        if status != entry.last_status:
+            entry.last_status = status
+            return self.initial_interval
+        cap = self.max_interval if status == 'IN_PROGRESS' else self.queued_interval
+        return min(entry.interval * self.backoff, cap)
+
+    def _resolve(self, entry, result=None, exception=None):
+        """
+        Resolve the future of entry once, polls and observer events may race to do it.
+        """
+        with self._resolve_lock:
+            if entry.resolved or entry.future.done():
+                return False
+            entry.resolved = True
+        with self._cv:
+            if entry.job_id in self._by_job:
+                self._by_job[entry.job_id].discard(entry)
+        if exception is not None:
+            entry.future.set_exception(exception)
+        else:
+            entry.future.set_result(result)
+        return True
+
+    def _set_job_id(self, entry, job_id):
+        with self._cv:
+            entry.job_id = job_id
+            self._by_job.setdefault(job_id, set()).add(entry)
+            event = self._job_events.get((entry.thing_name, job_id))
+        if event is not None:
+            self._apply_job_event(entry, *event)
+
+    def _apply_job_event(self, entry, status, reason):
+        if status in FINISHED_JOB_STATUSES:
+            logger.info(f"ID:{entry.job_id[-12:]} {JobStatus(status, reason)} (notified)")
+            self._resolve(entry, TrackedResult(entry.ota_update_id, entry.job_id, JobStatus(status, reason), None))
+        elif status is None and not entry.resolved:
+            self._push(entry, 0)
+
+    def _poll(self, entry):
+        if entry.resolved or entry.future.cancelled():
+            return
+        try:
+            status = self._poll_ota_update(entry) if entry.job_id is None else self._poll_job(entry)
+        except Exception as e:
+            entry.errors += 1
+            if time.monotonic() > entry.deadline:
+                self._timeout(entry, entry.last_status, e)
+                return
+            delay = min(self.initial_interval * self.backoff ** entry.errors, self.max_interval)
+            logger.warning(f"Polling OTA update {entry.ota_update_id} failed, retrying in {delay:.1f}s. Err: {e}")
+            self._push(entry, self._until_deadline(entry, delay))
+            return
+        entry.errors = 0
+        if entry.resolved:
+            return
+
+        if time.monotonic() > entry.deadline:
+            self._timeout(entry, status)
+            return
+
+        entry.interval = self._next_interval(entry, status)
+        self._push(entry, self._until_deadline(entry, entry.interval))
+
+    def _until_deadline(self, entry, delay):
+        """
+        Delay of the next poll, cut short at the deadline so that a long interval does not push the timeout back.
+        """
+        return min(delay, max(0, entry.deadline - time.monotonic()))
+
+    def _timeout(self, entry, status, error=None):
+        logger.error(f"Timeout on OTA update {entry.ota_update_id} (last status: {status})")
+        if entry.wait_for_job:
+            self._resolve(entry, TrackedResult(entry.ota_update_id, entry.job_id,
+                                               JobStatus(status, ''), 'Timeout on OTA Update\'s job.'))
+        elif error is not None:
+            self._resolve(entry, exception=error)
+        else:
+            self._resolve(entry, exception=TimeoutError(f'OTA update creation timed out for {entry.ota_update_id}'))
+
+    def _poll_ota_update(self, entry):
+        response = self._iot_client.get_ota_update(otaUpdateId=entry.ota_update_id)
+        info = response.get('otaUpdateInfo', {})
+        entry.ota_update_info = info
+        status = info.get('otaUpdateStatus', 'UNDEFINED')
+
+        if not entry.wait_for_job:
+            if status in FINISHED_CREATE_STATUSES:
+                self._resolve(entry, info)
+            return status
+
+        if status == 'CREATE_FAILED':
+            reason = info.get('errorInfo', {}).get('message', '')
+            self._resolve(entry, TrackedResult(entry.ota_update_id, None, JobStatus('FAILED', reason),
+                                               'OTA update creation failed.'))
+        elif info.get('awsIotJobId'):
+            self._set_job_id(entry, info['awsIotJobId'])
+        return status
+
+    def _poll_job(self, entry):
+        response = self._iot_client.describe_job_execution(jobId=entry.job_id, thingName=entry.thing_name)
+        execution = response['execution']
+        job_status = JobStatus(execution['status'], execution.get('statusDetails', {}).get('detailsMap', {}).get('reason', ''))
+        if job_status.status != entry.last_status:
+            logger.info(f"ID:{entry.job_id[-12:]} {job_status}")
+        if job_status.status in FINISHED_JOB_STATUSES:
+            self._resolve(entry, TrackedResult(entry.ota_update_id, entry.job_id, job_status, None))
+        return job_status.status
@@ -0,0 +1,164 @@
+# Produce the images of new application versions from one built image: the image is built
+# once with a placeholder version and the AppVersion32_t constant holding it is patched.
+import os
+import struct
+import tempfile
+from pathlib import Path
+from runotabinary.logger import logger
+
+# Symbol of the demos holding the application version, read by the OTA library
+VERSION_SYMBOL = 'appFirmwareVersion'
+
+# Version built into the template image, chosen to be unlikely to appear anywhere else
+PLACEHOLDER_VERSION = (165, 90, 50145)
+
+ELF_MAGIC = b'\x7fELF'
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHT_DYNSYM = 11
+
+
+def encode_version(major, minor, build, little_endian=True):
+    """
+    Bytes of an AppVersion32_t: major, minor and build packed in one 32 bit integer.
+    """
+    if not (0 <= major <= 0xFF and 0 <= minor <= 0xFF and 0 <= build <= 0xFFFF):
+        raise ValueError(f'Version {major}.{minor}.{build} does not fit in AppVersion32_t')
+    return struct.pack('<I' if little_endian else '>I', major << 24 | minor << 16 | build)
+
+
+def decode_version(data, little_endian=True):
+    value, = struct.unpack('<I' if little_endian else '>I', data)
+    return value >> 24, (value >> 16) & 0xFF, value & 0xFFFF
+
+
+class ElfImage:
+    """
+    Sections and symbols of an ELF file, as much as needed to find the bytes of a symbol.
+    """
+
+    def __init__(self, data):
+        if data[:4] != ELF_MAGIC:
+            raise ValueError('Not an ELF file')
+        self.is_64 = data[4] == 2
+        self.little_endian = data[5] == 1
+        self.data = data
+        self._endian = '<' if self.little_endian else '>'
+        if self.is_64:
+            shoff, = self._unpack('Q', 0x28)
+            shentsize, shnum = self._unpack('HH', 0x3A)
+        else:
+            shoff, = self._unpack('I', 0x20)
+            shentsize, shnum = self._unpack('HH', 0x2E)
+        self.sections = [self._section(shoff + index * shentsize) for index in range(shnum)]
+
+    def _unpack(self, fmt, offset):
+        return struct.unpack_from(self._endian + fmt, self.data, offset)
+
+    def _section(self, offset):
+        if self.is_64:
+            name, kind, _, addr, file_offset, size, link, _, _, entsize = self._unpack('IIQQQQIIQQ', offset)
+        else:
+            name, kind, _, addr, file_offset, size, link, _, _, entsize = self._unpack('IIIIIIIIII', offset)
+        return {'type': kind, 'addr': addr, 'offset': file_offset, 'size': size, 'link': link, 'entsize': entsize}
+
+    def _string(self, section, offset):
+        start = section['offset'] + offset
+        return self.data[start:self.data.index(b'\0', start)].decode(errors='replace')
+
+    def symbols(self):
+        """
+        :return: Iterator of (name, value, size) of the static and dynamic symbols
+        """
+        for section in self.sections:
+            if section['type'] not in (SHT_SYMTAB, SHT_DYNSYM) or not section['entsize']:
+                continue
+            strings = self.sections[section['link']]
+            for offset in range(section['offset'], section['offset'] + section['size'], section['entsize']):
+                if self.is_64:
+                    name, _, _, _, value, size = self._unpack('IBBHQQ', offset)
+                else:
+                    name, value, size, _, _, _ = self._unpack('IIIBBH', offset)
+                yield self._string(strings, name), value, size
+
+    def symbol_offset(self, symbol):
+        """
+        File offset of the bytes of symbol, None if the symbol or its section cannot be found.
+        """
+        for name, value, size in self.symbols():
+            if name != symbol:
+                continue
+            for section in self.sections:
+                if section['type'] != SHT_NOBITS and section['addr'] and section['addr'] <= value < section['addr'] + section['size']:
+                    return section['offset'] + value - section['addr']
+        return None
+
+
+def _write_image(path, data, mode):
+    """
+    Atomically write an image, with the permissions of the template.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), prefix=f'.{path.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(data)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, str(path))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_version(path, symbol=VERSION_SYMBOL):
+    """
+    Version held by the symbol of an ELF image, None if the image has no such symbol.
+    """
+    image = ElfImage(Path(path).read_bytes())
+    offset = image.symbol_offset(symbol)
+    if offset is None:
+        return None
+    return decode_version(image.data[offset:offset + 4], image.little_endian)
+
+
+class VersionStamper:
+    """
+    Write copies of a template image, built with PLACEHOLDER_VERSION, holding other versions.
+
+    The version is found through its symbol, or where the image is stripped, as the only
+    occurrence of the placeholder bytes. It must be read from memory at run time, as the
+    OTA library does from its own translation unit, i.e. not folded by link time optimization.
+    """
+
+    def __init__(self, template, symbol=VERSION_SYMBOL, placeholder=PLACEHOLDER_VERSION):
+        self.template = Path(template)
+        self.symbol = symbol
+        self.image = ElfImage(self.template.read_bytes())
+        self.mode = os.stat(self.template).st_mode & 0o7777
+        expected = encode_version(*placeholder, little_endian=self.image.little_endian)
+        self.offset = self.image.symbol_offset(symbol)
+        self.has_symbol = self.offset is not None
+        if self.offset is None:
+            if self.image.data.count(expected) != 1:
+                raise ValueError(f'{self.template} has no {symbol} symbol and {placeholder} is not found exactly once')
+            self.offset = self.image.data.index(expected)
+        elif self.image.data[self.offset:self.offset + 4] != expected:
+            found = decode_version(self.image.data[self.offset:self.offset + 4], self.image.little_endian)
+            raise ValueError(f'{symbol} of {self.template} holds {found}, not the placeholder {placeholder}')
+
+    def stamp(self, version, output):
+        """
+        Write the image holding version to output, and check the version read back from it.
+        :param version: (major, minor, build)
+        :return: Path of the image
+        """
+        data = bytearray(self.image.data)
+        data[self.offset:self.offset + 4] = encode_version(*version, little_endian=self.image.little_endian)
+        _write_image(output, bytes(data), self.mode)
+        stamped = read_version(output, self.symbol) if self.has_symbol else decode_version(
+            Path(output).read_bytes()[self.offset:self.offset + 4], self.image.little_endian)
+        if stamped != tuple(version):
+            raise RuntimeError(f'{output} holds version {stamped} instead of {tuple(version)}')
+        logger.debug(f'Stamped version {".".join(map(str, version))} into {output}')
+        return Path(output)
@@ -0,0 +1,137 @@
+import os
+import threading
+import botocore.exceptions
+import pytest
+from runotabinary import aws_clients
+from runotabinary.create_update import AWSS3Bucket, file_digest
+from runotabinary.fake_aws import FakeAwsBackend
+
+
+class FakeS3Client:
+    """Versioned bucket kept in memory, implementing the calls AWSS3Bucket makes"""
+
+    def __init__(self):
+        self.objects = {}
+        self.calls = []
+        self.parts = {}
+
+    def head_bucket(self, Bucket):
+        self.calls.append('head_bucket')
+
+    def get_bucket_versioning(self, Bucket):
+        self.calls.append('get_bucket_versioning')
+        return {'Status': 'Enabled'}
+
+    def head_object(self, Bucket, Key):
+        self.calls.append('head_object')
+        if Key not in self.objects:
+            raise botocore.exceptions.ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        body, metadata, version = self.objects[Key]
+        return {'Metadata': metadata, 'VersionId': version}
+
+    def put_object(self, Bucket, Key, Body, Metadata):
+        self.calls.append('put_object')
+        version = f'v{len(self.objects)}'
+        self.objects[Key] = (Body.read(), Metadata, version)
+        return {'VersionId': version}
+
+
+@pytest.fixture
+def fake_s3():
+    aws_clients.reset()
+    client = FakeS3Client()
+    aws_clients.register_client('s3', client)
+    yield client
+    aws_clients.reset()
+
+
+def test_once_runs_check_a_single_time():
+    aws_clients.reset()
+    calls = []
+    threads = [threading.Thread(target=aws_clients.once, args=('key', lambda: calls.append(1))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == [1]
+
+
+def test_transfers_keep_the_retries_of_botocore():
+    aws_clients.reset()
+    aws_clients.configure(region_name='us-east-1', max_attempts=3)
+    try:
+        transfer = aws_clients.get_transfer_client('s3').wrapped.wrapped
+        client = aws_clients.get_client('s3').wrapped.wrapped
+        assert transfer is not client and aws_clients.get_transfer_client('s3').wrapped.wrapped is transfer
+        # botocore counts max_attempts as retries after the first attempt
+        assert transfer.meta.config.retries['total_max_attempts'] == 4
+        # The calls of the client are retried by the throttle layer only
+        assert client.meta.config.retries['total_max_attempts'] == 1
+    finally:
+        aws_clients.reset()
+
+
+def test_bucket_is_checked_once_and_uploads_are_deduplicated(fake_s3, tmp_path):
+    image = tmp_path / 'ota_demo_core_mqtt'
+    image.write_bytes(b'firmware' * 10)
+
+    first = AWSS3Bucket('bucket').upload_file(str(image), 'ota_demo_core_mqtt_2')
+    # A new bucket object, e.g. from the next CreateUpdate, only pays a HEAD for known bytes
+    second = AWSS3Bucket('bucket').upload_file(str(image), 'ota_demo_core_mqtt_3')
+
+    assert first == second
+    assert first[1] == 'v0'
+    assert fake_s3.calls.count('head_bucket') == 1
+    # The version comes with the response of the PUT, the only HEADs are the miss and the hit
+    assert fake_s3.calls == ['head_bucket', 'get_bucket_versioning', 'head_object', 'put_object', 'head_object']
+
+
+def test_large_images_use_multipart_upload(tmp_path):
+    import boto3
+    from botocore.stub import Stubber, ANY
+    image = tmp_path / 'ota_demo_core_mqtt'
+    image.write_bytes(os.urandom(1000))
+    key = f'firmware/{file_digest(str(image))}'
+    client = boto3.session.Session(region_name='us-east-1', aws_access_key_id='key',
+                                   aws_secret_access_key='secret').client('s3')
+    parts = []
+
+    def record_part(params, **kwargs):
+        parts.append(params['Body'].read())
+        params['Body'].seek(0)
+    client.meta.events.register('before-parameter-build.s3.UploadPart', record_part)
+
+    stubber = Stubber(client)
+    stubber.add_client_error('head_object', '404', expected_params={'Bucket': 'bucket', 'Key': key})
+    stubber.add_response('create_multipart_upload', {'UploadId': 'upload'})
+    # The managed upload raises the part size to the 5 MiB minimum of S3, a single part here
+    stubber.add_response('upload_part', {'ETag': '"etag1"'})
+    # The version is taken from the completed upload, no HEAD follows
+    stubber.add_response('complete_multipart_upload', {'Bucket': 'bucket', 'Key': key, 'VersionId': 'multipart'},
+                         {'Bucket': 'bucket', 'Key': key, 'UploadId': 'upload', 'MultipartUpload': ANY})
+
+    aws_clients.reset()
+    aws_clients.register_client('s3', client)
+    try:
+        with stubber:
+            aws_clients.once(('s3_bucket', 'bucket'), lambda: True)
+            bucket = AWSS3Bucket('bucket', multipart_threshold=600, multipart_chunksize=600, max_concurrency=1)
+            assert bucket.upload_file(str(image), 'ota_demo_core_mqtt_2') == (key, 'multipart')
+            stubber.assert_no_pending_responses()
+    finally:
+        aws_clients.reset()
+    assert b''.join(parts) == image.read_bytes()
+
+
+def test_fake_backend_uploads_in_parts_above_the_threshold(tmp_path):
+    image = tmp_path / 'ota_demo_core_mqtt'
+    image.write_bytes(os.urandom(1000))
+    with FakeAwsBackend(tmp_path / 'cloud') as backend:
+        bucket = AWSS3Bucket('bucket', multipart_threshold=100, multipart_chunksize=64)
+        calls = []
+        create_multipart_upload = backend.s3.create_multipart_upload
+        backend.s3.create_multipart_upload = lambda **kwargs: calls.append(kwargs) or create_multipart_upload(**kwargs)
+        key, version = bucket.upload_file(str(image), 'ota_demo_core_mqtt_2')
+        assert len(calls) == 1 and calls[0]['Metadata']['file-name'] == 'ota_demo_core_mqtt_2'
+        assert version == backend.s3.head_object(Bucket='bucket', Key=key)['VersionId']
+        assert backend.s3.object_path('bucket', key, version).read_bytes() == image.read_bytes()
@@ -0,0 +1,111 @@
+import os
+import re
+import shutil
+from pathlib import Path
+import pytest
+from runotabinary.build_binary import BuildBinary, BuildVariant
+from runotabinary.fake_aws import FakeAwsBackend
+from runotabinary.ota_benchmark import scaffold_repository, benchmark_project
+
+
+@pytest.fixture
+def build_task(tmp_path, monkeypatch):
+    # Build logs are written to the working directory
+    monkeypatch.chdir(tmp_path)
+    repository = scaffold_repository(tmp_path / 'repository')
+    with FakeAwsBackend(tmp_path / 'cloud'):
+        yield BuildBinary(benchmark_project(tmp_path, repository))
+
+
+def stamped_version(path):
+    return re.search(r"APP_VERSION = '([^']*)'", Path(path).read_text()).group(1)
+
+
+def test_variant_overlay_overrides_the_demo_config(build_task):
+    variant = build_task.resolve_variant(BuildVariant(version='1.2.3', protocol='HTTP'))
+    assert (variant.target, variant.endpoint) == ('ota_demo_core_http', 'localhost')
+    assert '#define APP_VERSION_BUILD 3\n' in build_task.variant_overlay(variant)
+    assert '#define AWS_IOT_ENDPOINT "localhost"\n' in build_task.variant_overlay(variant)
+    device = build_task.resolve_variant(BuildVariant(version='1.2.3', thing_name='thing1', client_cert_path='thing1.crt'))
+    assert '#define CLIENT_IDENTIFIER "thing1"\n' in build_task.variant_overlay(device)
+    assert '#define CLIENT_CERT_PATH "thing1.crt"\n' in build_task.variant_overlay(device)
+    with pytest.raises(ValueError):
+        build_task.resolve_variant(BuildVariant(version='1.2'))
+
+
+
+def test_variants_resolving_alike_are_built_once(build_task, monkeypatch):
+    built = []
+    monkeypatch.setattr(build_task, '_build_variant', lambda slot, variant, jobs, parent: built.append(variant) or f'build{slot}')
+    protocol = build_task.project.data_protocol
+    variants = [BuildVariant(version='0.9.1'), BuildVariant(version='0.9.1', protocol=protocol),
+                BuildVariant('ota_demo_core_mqtt', '0.9.1'), BuildVariant(version='0.9.2')]
+    paths = build_task.build_variants(variants)
+    assert built == [build_task.resolve_variant(variants[0]), build_task.resolve_variant(variants[3])]
+    assert paths == {variants[0]: 'build0', variants[1]: 'build0', variants[2]: 'build0', variants[3]: 'build1'}
+
+@pytest.mark.skipif(shutil.which('cmake') is None, reason='cmake is required to build the stub device')
+def test_variants_build_concurrently_in_their_own_build_dirs(build_task):
+    variants = [BuildVariant(version=f'0.9.{build}') for build in (1, 2, 3)] + [BuildVariant(version='0.9.1', protocol='HTTP')]
+    paths = build_task.build_variants(variants)
+
+    assert [stamped_version(paths[variant]) for variant in variants] == ['0.9.1', '0.9.2', '0.9.3', '0.9.1']
+    assert paths[variants[3]].endswith('ota_demo_core_http')
+    assert len(set(paths.values())) == 4
+    # The shared tree keeps its own version, guarded so that the overlays take precedence
+    config = (build_task.target_file(build_task.DEMO_CONFIG_PATH)).read_text()
+    assert '#ifndef APP_VERSION_BUILD\n#define APP_VERSION_BUILD 0\n#endif\n' in config
+
+    # Unchanged variants are served from the artifact cache
+    assert build_task.build_variants(variants[:1]) == {variants[0]: paths[variants[0]]}
+
+
+def test_fingerprint_covers_the_whole_source_tree(build_task):
+    generator = 'Unix Makefiles'
+    fingerprint = build_task.build_fingerprint(generator)
+    assert build_task.build_fingerprint(generator) == fingerprint
+    root = Path(build_task.project.repository_root)
+    (root / 'build').mkdir(exist_ok=True)
+    (root / 'build' / 'output.o').write_text('not an input')
+    assert build_task.build_fingerprint(generator) == fingerprint
+
+    (root / 'CMakeLists.txt').write_text((root / 'CMakeLists.txt').read_text() + '# changed\n')
+    changed = build_task.build_fingerprint(generator)
+    assert changed != fingerprint
+    (root / 'source').mkdir()
+    (root / 'source' / 'extra.c').write_text('int extra;\n')
+    assert build_task.build_fingerprint(generator) not in (fingerprint, changed)
+
+
+def test_least_recently_used_artifacts_are_evicted(build_task):
+    build_task.project.build_cache_max_artifacts = 2
+    cache_dir = Path(build_task.project.repository_root) / 'build' / 'runota_artifacts'
+    for index in range(4):
+        artifact = cache_dir / f'fingerprint{index}' / 'ota_demo_core_mqtt'
+        artifact.parent.mkdir(parents=True)
+        artifact.write_text('image')
+        os.utime(artifact.parent, (index, index))
+    in_use = cache_dir / 'fingerprint0' / 'ota_demo_core_mqtt'
+
+    build_task.evict_artifacts([str(in_use)])
+    assert sorted(path.name for path in cache_dir.iterdir()) == ['fingerprint0', 'fingerprint2', 'fingerprint3']
+    # Only the artifacts of the current call are pinned
+    build_task.use_artifact(cache_dir / 'fingerprint2' / 'ota_demo_core_mqtt')
+    build_task.evict_artifacts()
+    assert sorted(path.name for path in cache_dir.iterdir()) == ['fingerprint2', 'fingerprint3']
+
+
+@pytest.mark.skipif(shutil.which('cmake') is None, reason='cmake is required to build the stub device')
+def test_out_of_band_source_changes_are_rebuilt(build_task):
+    build_task.set_application_version(build=1)
+    status, first = build_task.build()
+    assert stamped_version(first) == '0.9.1'
+    # Built or reused, the path handed out is the copy of the cache which later builds never overwrite
+    assert '/runota_artifacts/' in first
+    assert build_task.build()[1] == first
+
+    # Edited behind the back of the patcher, e.g. by a git checkout
+    config = build_task.target_file(build_task.DEMO_CONFIG_PATH)
+    config.write_text(config.read_text().replace('#define APP_VERSION_BUILD 1', '#define APP_VERSION_BUILD 7'))
+    status, second = build_task.build()
+    assert stamped_version(second) == '0.9.7'
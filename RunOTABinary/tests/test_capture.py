@@ -0,0 +1,60 @@
+import gzip
+import time
+from runotabinary.capture import LogWriter
+from runotabinary.run_binary import RunBinary
+
+
+def test_writer_rotates_compresses_and_decodes_lazily(tmp_path):
+    log = tmp_path / 'logfile.txt'
+    writer = LogWriter(log, max_bytes=100, backup_count=2, compress=True)
+    lines = []
+    writer.add_line_consumer(lines.append)
+
+    chunks = [
+        b'[INFO] Received: 1   Queued: 0   Processed: 0   Dropped: 0\n[INFO] Rece',
+        b'ived block \xe2\x82',
+        b'\xac\n',
+        b'x' * 90 + b'\n',
+    ]
+    for chunk in chunks:
+        writer.write(chunk)
+    writer.close()
+
+    assert lines[0].startswith('[INFO] Received: 1')
+    assert lines[1] == '[INFO] Received block €\n'
+    assert log.read_bytes() == b'x' * 90 + b'\n'
+    assert gzip.open(str(log) + '.1.gz').read() == b''.join(chunks[:3])
+    assert writer.bytes_written == sum(len(chunk) for chunk in chunks)
+
+
+def test_run_binary_captures_chatty_device(tmp_path):
+    device = tmp_path / 'ota_demo_core_mqtt'
+    device.write_text('#!/bin/sh\ni=0\nwhile [ $i -lt 2000 ]; do echo "[DEBUG] block $i"; i=$((i+1)); done\n')
+    device.chmod(0o755)
+    log = tmp_path / 'logfile.txt'
+
+    task = RunBinary(str(device), str(log))
+    seen = []
+    task.add_line_consumer(seen.append)
+    task.run_indefinitely = False
+    task.start()
+    deadline = time.monotonic() + 10
+    while len(seen) < 2000 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    task.close()
+    task.join(timeout=5)
+
+    assert seen[:2000] == [f'[DEBUG] block {i}\n' for i in range(2000)]
+    assert log.read_text().startswith('[DEBUG] block 0\n[DEBUG] block 1\n')
+
+
+def test_consumers_see_lines_before_the_file_io(tmp_path):
+    log = tmp_path / 'logfile.txt'
+    writer = LogWriter(log, max_bytes=10, backup_count=1, max_queued=2)
+    sizes = []
+    writer.add_line_consumer(lambda line: sizes.append(writer.bytes_written))
+    for index in range(5):
+        writer.write(f'line {index}\n'.encode())
+    writer.close()
+    # Every line reached the consumers before it was written or rotated
+    assert sizes == [0, 7, 14, 21, 28]
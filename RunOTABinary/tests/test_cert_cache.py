@@ -0,0 +1,63 @@
+import time
+import pytest
+from OpenSSL import crypto
+from runotabinary.cert_cache import CertificateCache
+
+ARN = 'arn:aws:acm:us-west-2:123456789012:certificate/signer'
+
+
+def make_certificate(valid_for_sec):
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 1024)
+    cert = crypto.X509()
+    cert.get_subject().CN = 'signer'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(-60)
+    cert.gmtime_adj_notAfter(valid_for_sec)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    return crypto.dump_certificate(crypto.FILETYPE_PEM, cert).decode()
+
+
+class CountingFetch:
+    def __init__(self, certificate=None, error=None):
+        self.certificate = certificate
+        self.error = error
+        self.calls = 0
+
+    def __call__(self, arn):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return self.certificate
+
+
+def test_certificate_is_fetched_once_within_ttl(tmp_path):
+    certificate = make_certificate(3600)
+    fetch = CountingFetch(certificate)
+    assert CertificateCache(tmp_path, ttl=60).get(ARN, fetch) == certificate
+    # A new cache on the same directory, e.g. the next process, reuses the file
+    assert CertificateCache(tmp_path, ttl=60).get(ARN, fetch) == certificate
+    assert fetch.calls == 1
+
+
+def test_stale_certificate_is_refetched_and_reused_offline(tmp_path):
+    certificate = make_certificate(3600)
+    cache = CertificateCache(tmp_path, ttl=0)
+    cache.get(ARN, CountingFetch(certificate))
+
+    fetch = CountingFetch(certificate)
+    assert cache.get(ARN, fetch) == certificate
+    assert fetch.calls == 1
+
+    offline = CountingFetch(error=ConnectionError('offline'))
+    assert cache.get(ARN, offline) == certificate
+    assert offline.calls == 1
+
+
+def test_expired_certificate_is_never_reused(tmp_path):
+    cache = CertificateCache(tmp_path, ttl=3600)
+    cache.store(ARN, make_certificate(-1))
+    with pytest.raises(ConnectionError):
+        cache.get(ARN, CountingFetch(error=ConnectionError('offline')))
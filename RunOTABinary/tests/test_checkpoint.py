@@ -0,0 +1,92 @@
+import sys
+import pytest
+from runotabinary import canary as canary_module
+from runotabinary.canary import OtaCanary, CanaryStep
+from runotabinary.checkpoint import CheckpointStore
+from runotabinary.create_update import file_digest
+from runotabinary.ota_benchmark import benchmark_project, THING_NAME
+
+
+def test_unfinished_run_is_resumed_until_completed(tmp_path):
+    with CheckpointStore(tmp_path / 'canary.db') as store:
+        run, resumed = store.open_run(THING_NAME, 10, 3)
+        assert not resumed
+        store.record(run['run_id'], 11, 2, 'built', build_path='a', build_sha256='0')
+        store.record(run['run_id'], 11, 2, 'uploaded', s3_key='a_2', s3_version='v1')
+
+        again, resumed = store.open_run(THING_NAME, 12, 5)
+        assert resumed and again['run_id'] == run['run_id'] and again['iterations'] == 3
+        row = store.steps(run['run_id'])[11]
+        assert (row['stage'], row['build_path'], row['s3_version']) == ('uploaded', 'a', 'v1')
+
+        store.set_run(run['run_id'], status='completed')
+        assert not store.open_run(THING_NAME, 12, 5)[1]
+
+
+def test_fresh_run_abandons_the_unfinished_ones(tmp_path):
+    with CheckpointStore(tmp_path / 'canary.db') as store:
+        run, _ = store.open_run(THING_NAME, 10, 3)
+        fresh, resumed = store.open_run(THING_NAME, 10, 3, resume=False)
+        assert not resumed and fresh['run_id'] != run['run_id']
+        assert store.run(run['run_id'])['status'] == 'abandoned'
+
+
+def test_resumed_canary_skips_what_is_done(tmp_path):
+    project = benchmark_project(tmp_path, tmp_path)
+    project.version_build = 10
+    image = tmp_path / 'image'
+    image.write_bytes(b'firmware 12')
+    with CheckpointStore(tmp_path / 'canary.db') as store:
+        run, _ = store.open_run(THING_NAME, 10, 4)
+        store.record(run['run_id'], 11, 2, 'finished', job_status='SUCCEEDED')
+        store.record(run['run_id'], 12, 3, 'created', build_path=str(image), build_sha256=file_digest(image),
+                     s3_key='image_3', s3_version='v1', ota_update_id='runota-12')
+        store.record(run['run_id'], 13, 4, 'finished', s3_key='image_4', s3_version='v2', ota_update_id='runota-13',
+                     job_status='FAILED')
+
+        canary = OtaCanary(project, checkpoint=store)
+        steps, _ = canary._plan(iterations=2, resume=True)
+
+    assert project.version_build == 11
+    assert [step.version_build for step in steps] == [12, 13, 14]
+    in_flight, failed, new = steps
+    assert (in_flight.stage, in_flight.ota_update_id, in_flight.artifact_intact()) == ('created', 'runota-12', True)
+    # A failed rollout is redone from the uploaded image
+    assert (failed.stage, failed.ota_update_id, failed.s3_object) == ('uploaded', None, ('image_4', 'v2'))
+    assert new == CanaryStep(14, 5)
+    assert canary.update_counter == 5
+
+
+def test_modified_artifact_is_not_intact(tmp_path):
+    image = tmp_path / 'image'
+    image.write_bytes(b'firmware')
+    step = CanaryStep(11, 2, build_path=str(image), build_sha256=file_digest(image), stage='built')
+    image.write_bytes(b'tampered')
+    assert not step.artifact_intact()
+
+
+def _fail(canary, resume):
+    raise RuntimeError('Build of version 11 failed')
+
+
+@pytest.mark.parametrize('start, exit_status', [
+    (lambda canary, resume: setattr(canary, 'completed', True), 0),
+    # A job which did not succeed stops the run without raising
+    (lambda canary, resume: [], 1),
+    (_fail, 1),
+])
+def test_canary_exit_status_tells_whether_the_run_completed(monkeypatch, start, exit_status):
+    monkeypatch.setattr(sys, 'argv', ['canary'])
+    monkeypatch.setattr(canary_module, 'OtaProject', lambda: None)
+    monkeypatch.setattr(OtaCanary, 'start', start)
+    assert canary_module.main() == exit_status
+
+
+def test_canary_resumes_only_when_asked(monkeypatch):
+    calls = []
+    monkeypatch.setattr(canary_module, 'OtaProject', lambda: None)
+    monkeypatch.setattr(OtaCanary, 'start', lambda canary, resume: calls.append(resume))
+    for argv in (['canary'], ['canary', '--resume']):
+        monkeypatch.setattr(sys, 'argv', argv)
+        canary_module.main()
+    assert calls == [False, True]
@@ -0,0 +1,135 @@
+import time
+import threading
+import paho.mqtt.client as mqtt
+from runotabinary.fault_injection import (FaultInjector, TimeTrigger, ProgressTrigger, JobStateTrigger, EventTrigger,
+                                          parse_trigger, format_report)
+from runotabinary.interrupt_mqtt import InterruptMQTTConnection, TakeoverConnection
+from runotabinary.local_broker import LocalMqttBroker
+from runotabinary.ota_benchmark import benchmark_project
+
+
+class Device:
+    """MQTT client of the thing, counting the times the broker dropped it"""
+
+    def __init__(self, broker):
+        self.disconnects = 0
+        self.connected = threading.Event()
+        self.client = mqtt.Client(client_id='thing')
+        self.client.on_connect = lambda *args: self.connected.set()
+        self.client.on_disconnect = self._on_disconnect
+        self.client.reconnect_delay_set(0.01, 0.05)
+        self.client.connect('127.0.0.1', broker.port)
+        self.client.loop_start()
+        assert self.connected.wait(5)
+
+    def _on_disconnect(self, *args):
+        self.disconnects += 1
+        self.connected.clear()
+
+    def stop(self):
+        self.client.loop_stop()
+
+
+def injector(broker, triggers):
+    return FaultInjector(lambda: TakeoverConnection('127.0.0.1', broker.port, 'thing'), triggers).start()
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return predicate()
+
+
+def test_progress_and_event_triggers_drop_the_device(tmp_path):
+    with LocalMqttBroker() as broker:
+        device = Device(broker)
+        faults = injector(broker, [ProgressTrigger(50), ProgressTrigger(90), EventTrigger('verified')])
+        faults.start_update(file_size=10 * 1024)
+        faults.feed('[OTA] Received OTA job document AFR_OTA-runota-1\n')
+        for index in range(10):
+            # The device reconnects before the next interrupt, and the next warm connection is ready
+            assert faults.ready(5) and device.connected.wait(5)
+            faults.feed(f'[OTA] Received valid file block: Block index={index}, Size=1024\n')
+            if index in (4, 8):
+                assert wait_for(lambda: device.disconnects == len(faults.injections))
+        assert faults.ready(5) and device.connected.wait(5)
+        faults.feed('[OTA] Received entire update and validated the signature\n')
+        assert wait_for(lambda: device.disconnects == 3)
+        assert wait_for(lambda: all(i.acked_at for i in faults.injections))
+        faults.stop()
+        device.stop()
+
+    assert [injection.trigger for injection in faults.injections] == ['progress:50', 'progress:90', 'event:verified']
+    assert not any(injection.cold or injection.error for injection in faults.injections)
+    assert all(i.triggered_at <= i.sent_at <= i.acked_at for i in faults.injections)
+    assert faults.report()['ack_ms']['samples'] == 3
+    assert 'progress:90' in format_report(faults.injections)
+
+
+def test_time_triggers_fire_on_time():
+    with LocalMqttBroker() as broker:
+        faults = injector(broker, [TimeTrigger(0.05, every_sec=0.1, count=3)])
+        assert faults.ready(5)
+        start = time.perf_counter()
+        faults.start_update()
+        assert wait_for(lambda: len(faults.injections) == 3 and all(i.acked_at for i in faults.injections))
+        faults.stop()
+
+    # Never early, and in order
+    offsets = [injection.triggered_at - start for injection in faults.injections]
+    assert offsets == sorted(offsets)
+    for offset, expected in zip(offsets, (0.05, 0.15, 0.25)):
+        assert offset >= expected
+
+
+
+def test_cold_interrupts_connect_off_the_calling_thread():
+    with LocalMqttBroker() as broker:
+        device = Device(broker)
+        connected_on = []
+
+        def connection():
+            connected_on.append(threading.current_thread())
+            return TakeoverConnection('127.0.0.1', broker.port, 'thing')
+
+        # Without start() no warm connection is kept
+        faults = FaultInjector(connection, [])
+        injection = faults.fire()
+        assert wait_for(lambda: injection.acked_at is not None)
+        assert wait_for(lambda: device.disconnects == 1)
+        faults.stop()
+        device.stop()
+
+    assert injection.cold and not injection.error
+    assert connected_on and threading.current_thread() not in connected_on
+
+def test_job_state_trigger_fires_once_per_update():
+    with LocalMqttBroker() as broker:
+        faults = injector(broker, [JobStateTrigger('IN_PROGRESS')])
+        faults.start_update()
+        faults.on_job_status('thing', 'AFR_OTA-1', 'IN_PROGRESS')
+        faults.on_job_status('thing', 'AFR_OTA-1', 'IN_PROGRESS')
+        faults.start_update()
+        faults.on_job_status('thing', 'AFR_OTA-2', 'IN_PROGRESS')
+        assert wait_for(lambda: all(i.acked_at for i in faults.injections))
+        faults.stop()
+    assert len(faults.injections) == 2
+
+
+def test_parse_trigger():
+    assert parse_trigger('time:1:0.5:4') == TimeTrigger(1.0, 0.5, 4)
+    assert parse_trigger('progress:25') == ProgressTrigger(25.0)
+    assert parse_trigger('job:IN_PROGRESS') == JobStateTrigger('IN_PROGRESS')
+    assert TimeTrigger(1.0, 0.5, 3).deadlines() == [1.0, 1.5, 2.0]
+
+
+def test_interrupt_mqtt_connection_takes_the_session_over(tmp_path):
+    with LocalMqttBroker() as broker:
+        device = Device(broker)
+        project = benchmark_project(tmp_path, tmp_path)
+        project.thing_name, project.aws_iot_endpoint = 'thing', '127.0.0.1'
+        project.interrupt_port, project.interrupt_tls = broker.port, False
+        assert InterruptMQTTConnection(project).interrupt_mqtt_connection() == 1
+        assert wait_for(lambda: device.disconnects == 1)
+        device.stop()
@@ -0,0 +1,133 @@
+import json
+import threading
+from concurrent.futures import Future
+from runotabinary.configs.config_project import OtaProject, DeviceIdentity
+from runotabinary.fleet import OtaFleetCanary, parse_device, load_devices
+from runotabinary.run_binary import RunBinary
+from runotabinary.tracker import JobStatus, TrackedResult
+
+# Jobs which are not all in flight together fail after this many seconds
+JOB_TIMEOUT = 5
+
+
+def make_stub_binary(path):
+    path.write_text('#!/bin/sh\necho "stub device $PWD"\n')
+    path.chmod(0o755)
+    return path
+
+
+class StubBuild:
+    def __init__(self, project, binary):
+        self.project = project
+        self.binary = binary
+        self.batches = []
+
+    def build_variants(self, variants, max_workers=None):
+        self.batches.append(variants)
+        return {variant: str(self.binary) for variant in variants}
+
+
+class StubTracker:
+    """Shared by the updates of the fleet: the jobs of an iteration only finish once every device has one"""
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.lock = threading.Lock()
+        self.pending = []
+        self.batches = []
+        self.closed = False
+
+    def track(self, ota_update_id):
+        future = Future()
+        timer = threading.Timer(JOB_TIMEOUT, lambda: future.done() or future.set_exception(TimeoutError(ota_update_id)))
+        timer.daemon = True
+        timer.start()
+        with self.lock:
+            self.pending.append((ota_update_id, future))
+            if len(self.pending) < self.devices:
+                return future
+            batch, self.pending = self.pending, []
+            self.batches.append(len(batch))
+        for ota_update_id, pending in batch:
+            if not pending.done():
+                pending.set_result(TrackedResult(ota_update_id, None, JobStatus('SUCCEEDED', ''), None))
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.closed = True
+
+
+class StubUpdate:
+    """Stands in for the IoT backend: every update succeeds once the shared tracker lets its job finish"""
+    created = []
+    closed = 0
+
+    def __init__(self, file_name, file_path, project, tracker=None):
+        self.file_name = file_name
+        self.project = project
+        self.tracker = tracker
+
+    def close(self):
+        StubUpdate.closed += 1
+
+    def clear_pending_jobs(self):
+        pass
+
+    def create_ota_update(self):
+        StubUpdate.created.append((self.project.thing_name, self.file_name))
+        return f'{self.project.thing_name}-{self.file_name}'
+
+    def track_ota_update(self, ota_update_id, timeout):
+        return self.tracker.track(ota_update_id)
+
+    def finish_ota_update(self, result):
+        return result.status, result.summary
+
+
+def quiet_device(filename, logfilename, **kwargs):
+    task = RunBinary(filename, logfilename, **kwargs)
+    task.run_indefinitely = False
+    return task
+
+
+def test_fleet_updates_devices_concurrently(tmp_path):
+    binary = make_stub_binary(tmp_path / 'ota_demo_core_mqtt')
+    devices = [DeviceIdentity(f'thing{i}', f'arn:thing{i}', 'cert', 'key') for i in range(4)]
+    builds = []
+    tracker = StubTracker(len(devices))
+    # Fewer workers than devices, no worker may wait for a job
+    canary = OtaFleetCanary(
+        OtaProject(), devices=devices, work_root=tmp_path / 'fleet', max_workers=2,
+        build_factory=lambda project: builds.append(StubBuild(project, binary)) or builds[-1],
+        update_factory=StubUpdate, run_factory=quiet_device, tracker_factory=lambda project: tracker
+    )
+
+    results = canary.start(iterations=2)
+
+    assert sorted(results) == ['thing0', 'thing1', 'thing2', 'thing3']
+    for thing_name, result in results.items():
+        assert result.passed
+        assert [u['version'] for u in result.updates] == ['0.9.1', '0.9.2']
+        assert (tmp_path / 'fleet' / thing_name / 'ota_demo_core_mqtt').exists()
+        assert 'stub device' in result.log_file.read_text()
+    assert ('thing3', 'ota_demo_core_mqtt_3') in StubUpdate.created
+    # Every update task is closed, the tracker they share once the run is over
+    assert StubUpdate.closed == len(StubUpdate.created)
+    assert tracker.closed
+    # The jobs of all devices of an iteration were in flight together
+    assert tracker.batches == [len(devices), len(devices)]
+    # The images of an iteration are built together, one variant per device
+    assert len(builds) == 1
+    assert [[(variant.thing_name, variant.version) for variant in batch] for batch in builds[0].batches] == [
+        [(f'thing{i}', f'0.9.{build}') for i in range(4)] for build in range(3)]
+
+
+def test_devices_are_read_from_the_command_line_and_json(tmp_path):
+    assert parse_device('thing0,arn:thing0,cert,key') == DeviceIdentity('thing0', 'arn:thing0', 'cert', 'key')
+    path = tmp_path / 'devices.json'
+    path.write_text(json.dumps([{'thing_name': 'thing1', 'thing_arn': 'arn:thing1',
+                                 'client_cert_path': 'cert', 'client_private_key_path': 'key'}]))
+    assert load_devices(path) == [DeviceIdentity('thing1', 'arn:thing1', 'cert', 'key')]
@@ -0,0 +1,57 @@
+import pytest
+from runotabinary import aws_clients
+from runotabinary.fake_aws import FakeAwsBackend
+from runotabinary.garbage_collector import GarbageCollector, format_report
+from runotabinary.ota_benchmark import benchmark_project, THING_NAME
+
+
+@pytest.fixture
+def backend(tmp_path):
+    with FakeAwsBackend(tmp_path / 'cloud') as backend:
+        backend.iot.page_size = 3
+        s3 = aws_clients.get_client('s3')
+        s3.create_bucket(Bucket='bucket')
+        version = s3.put_object(Bucket='bucket', Key='image', Body=b'firmware')['VersionId']
+        backend.files = [{'fileName': 'image_2', 'fileLocation': {
+            's3Location': {'bucket': 'bucket', 'key': 'image', 'version': version}}}]
+        yield backend
+
+
+def create_updates(backend, prefix, count, thing=THING_NAME):
+    for index in range(count):
+        backend.iot.create_ota_update(otaUpdateId=f'{prefix}{index}', targets=[f'arn:aws:iot:local:0:thing/{thing}'],
+                                      files=backend.files)
+
+
+def test_collect_pages_through_everything_left_behind(tmp_path, backend):
+    create_updates(backend, 'runota-', 8)
+    create_updates(backend, 'other-', 2, thing='other-device')
+    # A job and a stream left behind by an update deleted without them
+    backend.iot.delete_ota_update(otaUpdateId='runota-7')
+
+    collector = GarbageCollector(benchmark_project(tmp_path, tmp_path), rate_per_sec=0, min_age_sec=0)
+    jobs, updates, streams = collector.collect()
+
+    assert (jobs.found, jobs.deleted, jobs.failed) == (8, 8, 0)
+    assert (updates.found, updates.deleted) == (7, 7)
+    assert (streams.found, streams.deleted) == (1, 1)
+    iot = aws_clients.get_client('iot')
+    assert [update['otaUpdateId'] for update in iot.list_ota_updates()['otaUpdates']] == ['other-0', 'other-1']
+    assert [stream['streamId'] for stream in iot.list_streams()['streams']] == ['AFR_OTA-other-0', 'AFR_OTA-other-1']
+    assert 'ota_updates' in format_report([jobs, updates, streams])
+
+
+def test_young_updates_are_left_alone(tmp_path, backend):
+    create_updates(backend, 'runota-', 2)
+    jobs, updates, streams = GarbageCollector(benchmark_project(tmp_path, tmp_path), min_age_sec=3600).collect()
+    assert (jobs.found, updates.found, streams.found) == (0, 0, 0)
+    assert len(aws_clients.get_client('iot').list_streams()['streams']) == 2
+
+
+def test_clear_pending_jobs_survives_list_failures(tmp_path, backend):
+    def fail(**kwargs):
+        raise RuntimeError('throttled')
+    backend.iot.list_job_executions_for_thing = fail
+    stats = GarbageCollector(benchmark_project(tmp_path, tmp_path)).clear_pending_jobs()
+    assert (stats.found, stats.failed) == (0, 1)
+
@@ -0,0 +1,76 @@
+import json
+import time
+import paho.mqtt.client as mqtt
+from runotabinary.jobs_mqtt import JobsObserver
+from runotabinary.local_broker import LocalMqttBroker, topic_matches
+from runotabinary.tracker import OtaUpdateTracker
+
+
+class InProgressIotClient:
+    """Polling never sees the job finish, only the MQTT notification can resolve it"""
+
+    def __init__(self):
+        self.job_polls = 0
+
+    def get_ota_update(self, otaUpdateId):
+        return {'otaUpdateInfo': {'otaUpdateStatus': 'CREATE_COMPLETE', 'awsIotJobId': f'AFR_OTA-{otaUpdateId}'}}
+
+    def describe_job_execution(self, jobId, thingName):
+        self.job_polls += 1
+        return {'execution': {'status': 'IN_PROGRESS', 'statusDetails': {}}}
+
+
+def device_client(broker):
+    client = mqtt.Client(client_id='thing')
+    client.connect('127.0.0.1', broker.port)
+    client.loop_start()
+    return client
+
+
+def test_topic_matching():
+    assert topic_matches('$aws/things/t/jobs/+/update/accepted', '$aws/things/t/jobs/AFR_OTA-1/update/accepted')
+    assert topic_matches('$aws/things/#', '$aws/things/t/jobs/notify')
+    assert not topic_matches('$aws/things/t/jobs/notify', '$aws/things/u/jobs/notify')
+
+
+def test_job_completion_is_pushed_without_waiting_for_polls():
+    with LocalMqttBroker() as broker:
+        observer = JobsObserver('127.0.0.1', port=broker.port, use_tls=False)
+        assert observer.start(timeout=5)
+        observer.watch('thing')
+        client = InProgressIotClient()
+        tracker = OtaUpdateTracker(client, initial_interval=0.05, job_interval=30)
+        tracker.attach_observer(observer)
+
+        future = tracker.track_job('update', 'thing', timeout=60)
+        time.sleep(0.5)
+        assert not future.done()
+
+        device = device_client(broker)
+        device.publish('$aws/things/thing/jobs/AFR_OTA-update/update/accepted',
+                       json.dumps({'executionState': {'status': 'SUCCEEDED', 'statusDetails': {'reason': 'accepted v0.9.1'}}}))
+        result = future.result(timeout=5)
+
+        device.loop_stop()
+        tracker.close()
+        observer.stop()
+
+    assert result.status.status == 'SUCCEEDED'
+    assert result.status.reason == 'accepted v0.9.1'
+    # Resolved by the notification, the next fallback poll of the job was 30s away
+    assert client.job_polls == 1
+
+
+def test_job_leaving_pending_list_triggers_a_poll():
+    events = []
+    observer = JobsObserver('127.0.0.1', use_tls=False)
+    observer.add_listener(lambda *event: events.append(event))
+
+    class Message:
+        def __init__(self, topic, payload):
+            self.topic = topic
+            self.payload = json.dumps(payload).encode()
+
+    observer._on_message(None, None, Message('$aws/things/thing/jobs/notify', {'jobs': {'IN_PROGRESS': [{'jobId': 'AFR_OTA-1'}]}}))
+    observer._on_message(None, None, Message('$aws/things/thing/jobs/notify', {'jobs': {}}))
+    assert events == [('thing', 'AFR_OTA-1', None, '')]
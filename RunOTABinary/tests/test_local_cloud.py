@@ -0,0 +1,165 @@
+import json
+import time
+import base64
+import threading
+import paho.mqtt.client as mqtt
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from runotabinary import aws_clients, cbor, local_cloud
+from runotabinary.create_update import CreateUpdate
+from runotabinary.fake_aws import FakeAwsBackend, latency
+from runotabinary.ota_benchmark import benchmark_project, THING_NAME
+
+BLOCK_SIZE = 1024
+
+
+class StreamingDevice:
+    """
+    MQTT client of the thing taking its next job and downloading its image over the stream
+    topics in stream_format, over TLS checked with the CA at ca_path when given.
+    """
+
+    def __init__(self, port, stream_format='json', ca_path=None):
+        self.image = {}
+        self.job = None
+        self.stream_format = stream_format
+        self.done = threading.Event()
+        self.accepted = []
+        subscribed = threading.Event()
+        self.client = mqtt.Client(client_id=THING_NAME)
+        self.client.on_message = self._on_message
+        self.client.on_subscribe = lambda *args: subscribed.set()
+        if ca_path:
+            self.client.tls_set(ca_certs=ca_path)
+        self.client.connect('127.0.0.1', port)
+        self.client.subscribe(f'$aws/things/{THING_NAME}/#')
+        self.client.loop_start()
+        assert subscribed.wait(5)
+
+    def topic(self, suffix):
+        return f'$aws/things/{THING_NAME}/{suffix}'
+
+    def _on_message(self, client, userdata, message):
+        if message.topic.endswith('/cbor'):
+            payload = cbor.decode(message.payload)
+        else:
+            payload = json.loads(message.payload)
+        if message.topic == self.topic('jobs/notify-next') and 'execution' in payload and self.job is None:
+            self.job = payload['execution']
+            document = self.job['jobDocument']['afr_ota']
+            self.size = document['files'][0]['filesize']
+            blocks = -(-self.size // BLOCK_SIZE)
+            client.publish(self.topic(f'jobs/{self.job["jobId"]}/update'), json.dumps({'status': 'IN_PROGRESS'}))
+            topic = self.topic(f'streams/{document["streamname"]}/get/{self.stream_format}')
+            if self.stream_format == 'cbor':
+                # The bitmap asks for every block but the second, then the second alone
+                bitmap = bytearray(b'\xff' * -(-blocks // 8))
+                bitmap[0] &= 0xfd
+                client.publish(topic, cbor.encode({'c': 'token', 'f': 0, 'l': BLOCK_SIZE, 'o': 0, 'b': bytes(bitmap)}))
+                client.publish(topic, cbor.encode({'c': 'token', 'f': 0, 'l': BLOCK_SIZE, 'o': 1, 'n': 1}))
+            else:
+                client.publish(topic, json.dumps({'c': 'token', 'f': 0, 'l': BLOCK_SIZE, 'o': 0, 'n': blocks}))
+        elif message.topic.endswith(f'/data/{self.stream_format}'):
+            block = payload['p'] if self.stream_format == 'cbor' else base64.b64decode(payload['p'])
+            self.image[payload['i']] = block
+            if sum(len(block) for block in self.image.values()) == self.size:
+                client.publish(self.topic(f'jobs/{self.job["jobId"]}/update'),
+                               json.dumps({'status': 'SUCCEEDED', 'statusDetails': {'reason': 'accepted'}}))
+        elif message.topic.endswith('/update/accepted'):
+            self.accepted.append(payload['executionState']['status'])
+            if payload['executionState']['status'] == 'SUCCEEDED':
+                self.done.set()
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+def test_update_is_streamed_to_the_device_over_mqtt(tmp_path):
+    project = benchmark_project(tmp_path, tmp_path)
+    project.local_cloud_dir = str(tmp_path / 'cloud')
+    project.local_cloud_mqtt = True
+    aws_clients.reset()
+    try:
+        update_task = CreateUpdate(ota_project=project)
+        cloud = local_cloud.install_from_project(project)
+        assert project.aws_iot_endpoint == '127.0.0.1' and project.jobs_observer_port == cloud.broker.port
+        assert project.certificate_cache_dir == tmp_path.resolve() / 'cloud' / 'certificates'
+        device = StreamingDevice(cloud.broker.port)
+
+        image = tmp_path / 'image.bin'
+        image.write_bytes(bytes(range(256)) * 20 + b'tail')
+        s3_object = update_task.upload_firmware_to_s3_bucket(str(image), 'image.bin')
+        update_task.setParams('image.bin', str(image))
+        ota_update_id = update_task.create_ota_update(s3Object=s3_object)
+        status, _ = update_task.get_ota_update_result(ota_update_id, 10)
+
+        assert device.done.wait(5)
+        assert status.status == 'SUCCEEDED'
+        assert device.accepted == ['IN_PROGRESS', 'SUCCEEDED']
+        assert b''.join(device.image[index] for index in sorted(device.image)) == image.read_bytes()
+        signature = base64.b64decode(device.job['jobDocument']['afr_ota']['files'][0]['sig-sha256-ecdsa'])
+        certificate = x509.load_pem_x509_certificate(
+            aws_clients.get_client('acm').get_certificate(CertificateArn=project.ecdsa_signer_certificate_arn)['Certificate'].encode())
+        certificate.public_key().verify(signature, image.read_bytes(), ec.ECDSA(hashes.SHA256()))
+        device.stop()
+        cloud.stop()
+    finally:
+        aws_clients.reset()
+
+
+def test_cbor_stream_is_served_over_tls(tmp_path):
+    image = tmp_path / 'image.bin'
+    image.write_bytes(bytes(range(256)) * 40 + b'tail')
+    with local_cloud.LocalCloud(tmp_path / 'cloud', mqtt=True, mqtt_tls=True) as cloud:
+        update_task = CreateUpdate(ota_project=benchmark_project(tmp_path, tmp_path))
+        device = StreamingDevice(cloud.broker.port, stream_format='cbor', ca_path=str(cloud.credentials.ca_path))
+        s3_object = update_task.upload_firmware_to_s3_bucket(str(image), 'image.bin')
+        update_task.setParams('image.bin', str(image))
+        update_task.create_ota_update(s3Object=s3_object)
+
+        assert device.done.wait(5)
+        assert b''.join(device.image[index] for index in sorted(device.image)) == image.read_bytes()
+        device.stop()
+
+
+def test_only_the_endpoint_fields_of_the_project_are_changed(tmp_path):
+    project = benchmark_project(tmp_path, tmp_path)
+    before = dict(vars(project))
+    with local_cloud.LocalCloud(tmp_path / 'cloud', mqtt=True, mqtt_tls=True) as cloud:
+        cloud.configure_project(project)
+        changed = {name for name, value in vars(project).items() if before[name] != value}
+        assert changed <= {'certificate_cache_dir', 'aws_iot_endpoint', 'jobs_observer_port', 'interrupt_port',
+                           'jobs_observer_tls', 'interrupt_tls', 'mqtt_ca_path'}
+        assert project.jobs_observer_tls and project.mqtt_ca_path == str(cloud.credentials.ca_path)
+    with local_cloud.LocalCloud(tmp_path / 'cloud') as cloud:
+        project = benchmark_project(tmp_path, tmp_path)
+        endpoint = project.aws_iot_endpoint
+        cloud.configure_project(project)
+        assert project.aws_iot_endpoint == endpoint
+        assert project.certificate_cache_dir == tmp_path / 'cloud' / 'certificates'
+
+
+def test_cbor_round_trip():
+    value = {'c': 'token', 'f': 0, 'l': 1024, 'o': 300, 'b': b'\xff\x01', 'x': [-1, -70000, True, None, 1.5, 2 ** 40]}
+    assert cbor.decode(cbor.encode(value)) == value
+    assert cbor.encode({'f': 0}) == bytes.fromhex('a1616600')
+
+
+def test_calls_take_their_configured_latency(tmp_path, monkeypatch):
+    latencies = {'iot.list_streams': 0.2, 'iot': 0.0, '*': 0.1}
+    assert latency(latencies, 'iot', 'list_streams') == 0.2
+    assert latency(latencies, 'iot', 'get_ota_update') == 0.0
+    assert latency(latencies, 'acm', 'get_certificate') == 0.1
+
+    sleeps = []
+    sleep = time.sleep
+    monkeypatch.setattr(time, 'sleep', lambda seconds: sleeps.append(seconds) or sleep(seconds))
+    with FakeAwsBackend(tmp_path, latencies=latencies):
+        start = time.perf_counter()
+        aws_clients.get_client('iot').list_streams()
+        assert time.perf_counter() - start >= 0.2
+        aws_clients.get_client('iot').list_ota_updates()
+    # The call without latency does not wait
+    assert sleeps == [0.2]
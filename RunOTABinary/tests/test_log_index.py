@@ -0,0 +1,112 @@
+import time
+from runotabinary.capture import LogWriter
+from runotabinary.log_index import LogIndexer, LogIndex, index_path, main
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def write(path, lines):
+    with open(path, 'ab') as f:
+        f.write(''.join(line + '\n' for line in lines).encode())
+
+
+def test_index_grows_with_the_log(tmp_path):
+    log = tmp_path / 'device.log'
+    clock = Clock(1000.0)
+    indexer = LogIndexer(log, clock=clock)
+    write(log, ['[INFO] [OTA] [ota.c:10] Started', '[INFO] [OTA] [ota.c:11] Received OTA job document AFR_OTA-runota-1'])
+    assert indexer.update() > 0
+
+    clock.now = 1010.0
+    write(log, ['[ERROR] [OTA] [ota.c:12] Failed to validate AFR_OTA-runota-1', '[INFO] [OTA] [ota.c:13] Stopping'])
+    # A partial line waits for the next update
+    with open(log, 'ab') as f:
+        f.write(b'[ERROR] [OTA] half')
+    indexer.update()
+
+    # A new indexer carries on from the sidecar
+    clock.now = 1020.0
+    with open(log, 'ab') as f:
+        f.write(b' a line AFR_OTA-runota-2\n')
+    assert LogIndexer(log, clock=clock).update() == len(b'[ERROR] [OTA] half a line AFR_OTA-runota-2\n')
+
+    with LogIndex(log) as log_index:
+        assert [len(text.splitlines()) for text in log_index.read(log_index.job('runota-1'))] == [2]
+        assert log_index.read(log_index.level('error')) == [
+            '[ERROR] [OTA] [ota.c:12] Failed to validate AFR_OTA-runota-1\n', '[ERROR] [OTA] half a line AFR_OTA-runota-2\n']
+        assert log_index.read(log_index.level('error', since=1015)) == ['[ERROR] [OTA] half a line AFR_OTA-runota-2\n']
+        assert log_index.read(log_index.around(1010.5, 1, 1))[0].splitlines()[-1] == '[INFO] [OTA] [ota.c:13] Stopping'
+        around = log_index.with_context(log_index.job('runota-2'), lines=1)
+        assert log_index.read(around)[0].startswith('[INFO] [OTA] [ota.c:13] Stopping')
+
+
+def test_timestamps_in_the_lines_are_used(tmp_path):
+    log = tmp_path / 'device.log'
+    write(log, [f'2024-05-01 10:00:{second:02d} [INFO] line {second}' for second in range(10)])
+    LogIndexer(log).update()
+    with LogIndex(log) as log_index:
+        start = time.mktime((2024, 5, 1, 10, 0, 0, 0, 0, -1))
+        assert log_index.read(log_index.around(start + 5, 1, 1))[0].splitlines() == [
+            '2024-05-01 10:00:04 [INFO] line 4', '2024-05-01 10:00:05 [INFO] line 5', '2024-05-01 10:00:06 [INFO] line 6']
+
+
+def test_replaced_log_is_indexed_again(tmp_path):
+    log = tmp_path / 'device.log'
+    write(log, ['[INFO] first run AFR_OTA-runota-1'] * 3)
+    LogIndexer(log).update()
+    log.write_bytes(b'[WARN] second run\n' * 4)
+    LogIndexer(log).update()
+    with LogIndex(log) as log_index:
+        assert log_index.job('runota-1') == []
+        assert log_index.level('WARN') == [(0, log.stat().st_size)]
+
+
+def test_queries_do_not_scan_the_log(tmp_path):
+    log = tmp_path / 'device.log'
+    block = ''.join(f'[INFO] [OTA] [ota.c:1] Received valid file block: Block index={index}, Size=4096\n'
+                    for index in range(1000)).encode()
+    with open(log, 'wb') as f:
+        for _ in range(200):
+            f.write(block)
+        f.write(b'[ERROR] [OTA] [ota.c:2] Failed to validate AFR_OTA-runota-9\n')
+    LogIndexer(log).update()
+    assert index_path(log).stat().st_size < 1024
+
+    with LogIndex(log) as log_index:
+        # The job is found from the index alone, as the byte range of its line
+        error_at = 200 * len(block)
+        assert log_index.job('runota-9') == [(error_at, log.stat().st_size)]
+        texts = log_index.read(log_index.with_context(log_index.job('runota-9'), lines=2))
+    assert texts[0].splitlines() == [block.splitlines()[-2].decode(), block.splitlines()[-1].decode(),
+                                     '[ERROR] [OTA] [ota.c:2] Failed to validate AFR_OTA-runota-9']
+
+
+
+def test_rotated_logs_keep_their_index(tmp_path):
+    log = tmp_path / 'device.log'
+    writer = LogWriter(log, max_bytes=120, backup_count=2, compress=True)
+    LogIndexer(log).attach(writer)
+    for run in range(3):
+        writer.write(f'[INFO] Received OTA job document AFR_OTA-runota-{run}\n'.encode())
+        writer.write(b'[ERROR] [OTA] [ota.c:12] Failed to validate the image\n')
+        writer.flush()
+    writer.close()
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        'device.log', 'device.log.1.gz', 'device.log.1.gz.idx', 'device.log.2.gz', 'device.log.2.gz.idx', 'device.log.idx']
+    for path, run in ((log, 2), (tmp_path / 'device.log.1.gz', 1), (tmp_path / 'device.log.2.gz', 0)):
+        with LogIndex(path) as log_index:
+            assert log_index.read(log_index.job(f'runota-{run}')) == [f'[INFO] Received OTA job document AFR_OTA-runota-{run}\n']
+            assert len(log_index.level('ERROR')) == 1
+
+def test_cli_prints_the_lines_of_a_job(tmp_path, capsys):
+    log = tmp_path / 'device.log'
+    write(log, ['[INFO] idle', '[INFO] Received OTA job document AFR_OTA-runota-1', '[INFO] idle'])
+    assert main([str(log), '--job', 'runota-1']) == 0
+    assert capsys.readouterr().out == '[INFO] Received OTA job document AFR_OTA-runota-1\n'
@@ -0,0 +1,58 @@
+import json
+import shutil
+import pytest
+from runotabinary import aws_clients
+from runotabinary.fake_aws import FakeAwsBackend, write_json
+from runotabinary.ota_benchmark import run, compare
+from runotabinary.run_history import RunHistory
+from runotabinary.stats import summarize
+
+
+def test_fake_backend_publishes_jobs_and_reads_device_status(tmp_path):
+    backend = FakeAwsBackend(tmp_path).install()
+    try:
+        s3 = aws_clients.get_client('s3')
+        s3.create_bucket(Bucket='bucket')
+        version = s3.put_object(Bucket='bucket', Key='image', Body=b'firmware')['VersionId']
+        iot = aws_clients.get_client('iot')
+        iot.create_ota_update(otaUpdateId='update', targets=['arn:aws:iot:local:0:thing/device'], files=[{
+            'fileName': 'image_2',
+            'fileLocation': {'s3Location': {'bucket': 'bucket', 'key': 'image', 'version': version}},
+        }])
+        job_id = iot.get_ota_update(otaUpdateId='update')['otaUpdateInfo']['awsIotJobId']
+        document = json.loads((backend.iot.jobs_dir('device') / f'{job_id}.json').read_text())
+        assert document['files'][0]['fileSize'] == len(b'firmware')
+        assert iot.describe_job_execution(jobId=job_id, thingName='device')['execution']['status'] == 'QUEUED'
+
+        write_json(backend.iot.jobs_dir('device') / f'{job_id}.status', {'status': 'SUCCEEDED', 'reason': 'ok'})
+        execution = iot.describe_job_execution(jobId=job_id, thingName='device')['execution']
+        assert (execution['status'], execution['statusDetails']['detailsMap']['reason']) == ('SUCCEEDED', 'ok')
+        assert iot.list_job_executions_for_thing(thingName='device', status='QUEUED')['executionSummaries'] == []
+    finally:
+        backend.uninstall()
+
+
+def test_compare_reports_relative_changes():
+    baseline = {'stages': {'build': summarize([1.0, 2.0])}, 'updates_per_hour': 100.0}
+    report = {'stages': {'build': summarize([2.0, 4.0])}, 'updates_per_hour': 50.0}
+    rows = {metric: change for metric, _, _, change in compare(baseline, report)}
+    assert rows == {'build.p50': 100.0, 'build.p95': 100.0, 'updates_per_hour': -50.0}
+
+
+@pytest.mark.skipif(shutil.which('cmake') is None, reason='cmake is required to build the stub device')
+def test_offline_benchmark_runs_updates_end_to_end(tmp_path, monkeypatch):
+    # Build logs are written to the working directory
+    monkeypatch.chdir(tmp_path)
+    with RunHistory(tmp_path / 'history.db') as history:
+        report = run(tmp_path, iterations=2, image_kib=16, block_size=1024, history=history)
+        assert len(history.samples('update')) == 2
+        assert history.outcomes() == {'SUCCEEDED': 2}
+        assert history.runs()[0]['kind'] == 'benchmark'
+
+    assert (report['succeeded'], report['failed']) == (2, 0)
+    assert report['updates_per_hour'] > 0
+    for stage in ('build', 'upload', 'create', 'rollout', 'update', 'download', 'restart', 'exit_to_run'):
+        assert report['stages'][stage]['samples'] == 2, stage
+    # The device restarted twice on the downloaded images
+    assert (tmp_path / 'device' / 'ota_demo_core_mqtt_3').exists()
+    json.dumps(report)
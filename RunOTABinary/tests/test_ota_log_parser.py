@@ -0,0 +1,73 @@
+from runotabinary.ota_log_parser import OtaLogParser
+
+DEVICE_LOG = [
+    (0.0, '[INFO] [MQTT] [core_mqtt.c:886] Packet received. ReceivedBytes=2.\n'),
+    (1.5, '[INFO] [OTA] [ota.c:1645] Job document was accepted. Attempting to begin the update.\n'),
+    (1.6, '[INFO] [OTA] [ota_mqtt.c:1005] Published to MQTT topic to request the next block: topic=$aws/things/t/streams/s/get/cbor\n'),
+    (1.8, '[INFO] [OTA] [ota.c:2399] Received valid file block: Block index=0, Size=4096\n'),
+    (1.9, '[INFO] [OTA] [ota_mqtt.c:1005] Published to MQTT topic to request the next block: topic=$aws/things/t/streams/s/get/cbor\n'),
+    (2.0, '[WARN] [OTA] [ota.c:2104] Data request retry: Retrying block request.\n'),
+    (2.3, '[INFO] [OTA] [ota.c:2399] Received valid file block: Block index=1, Size=4096\n'),
+    (2.4, '[INFO] [OTA] [ota.c:2446] Received final block of the update.\n'),
+    (2.9, '[INFO] [OTA] [ota.c:2470] Received entire update and validated the signature.\n'),
+    (3.0, '[INFO] [DEMO] [ota_demo_core_mqtt.c:821] Received OtaJobEventActivate callback from OTA Agent.\n'),
+    (5.0, '[INFO] [DEMO] [ota_demo_core_mqtt.c:861] Received OtaJobEventStartTest callback from OTA Agent.\n'),
+    (5.2, '[INFO] [OTA] [ota.c:1125] Image version is valid: Begin testing file: File ID=0\n'),
+]
+
+
+def test_parser_derives_device_side_metrics():
+    parser = OtaLogParser()
+    parser.mark_update_created(timestamp=0.5)
+    events = [parser.feed(line, timestamp) for timestamp, line in DEVICE_LOG]
+
+    assert events[0] is None
+    assert [event.name for event in events[1:4]] == ['job_document', 'block_request', 'block_received']
+    assert events[3].fields == {'index': '0', 'size': '4096'}
+
+    metrics = parser.snapshot()
+    assert metrics['time_to_job_document_sec'] == 1.0
+    assert metrics['blocks'] == 2
+    assert metrics['block_bytes'] == 8192
+    assert metrics['retries'] == 1
+    assert metrics['blocks_per_sec'] == 2.0
+    assert round(metrics['block_latency_p95_sec'], 3) == 0.4
+    assert metrics['verification_to_self_test_sec'] == 2.1
+    assert metrics['self_test_passed']
+
+
+def test_reconnects_and_backoff_are_not_block_retries():
+    parser = OtaLogParser()
+    parser.mark_update_created(timestamp=0.5)
+    for timestamp, line in DEVICE_LOG[:3]:
+        parser.feed(line, timestamp)
+    for line in ['[WARN] [MQTT] [core_mqtt.c:2262] Retrying connection to the broker after 500 ms backoff.\n',
+                 '[INFO] [DEMO] [ota_demo_core_mqtt.c:1342] Connection to the broker failed. Retrying connection with backoff and jitter.\n',
+                 '[WARN] [OTA] [ota.c:1562] Job document request retry: Re-requesting the job document.\n']:
+        assert parser.feed(line, 1.7) is None
+    assert parser.snapshot()['retries'] == 0
+
+
+def test_next_job_document_starts_a_new_update():
+    parser = OtaLogParser()
+    for timestamp, line in DEVICE_LOG + [(9.0, DEVICE_LOG[1][1])]:
+        parser.feed(line, timestamp)
+
+    summary = parser.summary()
+    assert len(summary) == 2
+    assert summary[0]['blocks'] == 2 and summary[1]['blocks'] == 0
+    assert 'Update 2:' in parser.format_summary()
+
+
+def test_job_document_seen_before_the_update_is_marked_stays_with_it():
+    parser = OtaLogParser()
+    for timestamp, line in DEVICE_LOG:
+        parser.feed(line, timestamp)
+    # The next update was requested at 8.0, its job document arrived before mark_update_created returned
+    parser.feed(DEVICE_LOG[1][1], 8.5)
+    parser.mark_update_created(8.0)
+    parser.feed(DEVICE_LOG[3][1], 9.0)
+
+    summary = parser.summary()
+    assert len(summary) == 2
+    assert summary[1]['time_to_job_document_sec'] == 0.5 and summary[1]['blocks'] == 1
@@ -0,0 +1,58 @@
+import os
+from runotabinary.patcher import SourcePatcher, guard_lines, patch_lines
+
+DEMO_CONFIG = """/*
+ * #define APP_VERSION_BUILD 1
+ */
+#define APP_VERSION_MAJOR 0
+#define APP_VERSION_BUILD 0
+#define OTHER 1
+"""
+
+
+def test_patch_lines_keeps_fileinput_semantics():
+    lines = DEMO_CONFIG.splitlines(keepends=True)
+    patched = patch_lines(lines, {'#define APP_VERSION_MAJOR': 1, '#define APP_VERSION_BUILD': 7})
+    assert "".join(patched) == """/*
+ * #define APP_VERSION_BUILD 1
+ */
+#define APP_VERSION_BUILD 7
+#define APP_VERSION_MAJOR 1
+#define OTHER 1
+"""
+
+
+def test_patcher_writes_each_file_once_and_only_if_changed(tmp_path):
+    config = tmp_path / 'demo_config.h'
+    pal = tmp_path / 'ota_pal_posix.c'
+    config.write_text(DEMO_CONFIG)
+    pal.write_text('static const char PEM[] = "old";\nint x;\n')
+
+    patcher = SourcePatcher()
+    patcher.set_macros(config, {'#define APP_VERSION_MAJOR': 0})
+    patcher.set_macros(config, {'#define OTHER': 2})
+    patcher.set_line(pal, 'static const char PEM[] = ', 'static const char PEM[] = "new";\n')
+    assert patcher.apply() == [config, pal]
+    assert '#define OTHER 2\n' in config.read_text()
+    assert pal.read_text() == 'static const char PEM[] = "new";\nint x;\n'
+
+    os.utime(config, ns=(0, 0))
+    patcher.set_macros(config, {'#define OTHER': 2})
+    assert patcher.apply() == []
+    assert os.stat(config).st_mtime_ns == 0
+    assert list(tmp_path.iterdir()) and not list(tmp_path.glob('*.tmp'))
+
+
+def test_guard_lines_lets_forced_definitions_win():
+    lines = DEMO_CONFIG.splitlines(keepends=True)
+    guarded = guard_lines(lines, ['#define APP_VERSION_BUILD', '#define APP_VERSION_MINOR'])
+    assert "".join(guarded) == """/*
+ * #define APP_VERSION_BUILD 1
+ */
+#define APP_VERSION_MAJOR 0
+#ifndef APP_VERSION_BUILD
+#define APP_VERSION_BUILD 0
+#endif
+#define OTHER 1
+"""
+    assert guard_lines(guarded, ['#define APP_VERSION_BUILD']) == guarded
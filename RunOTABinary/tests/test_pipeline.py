@@ -0,0 +1,98 @@
+import time
+import threading
+from runotabinary.pipeline import Pipeline
+
+
+def test_pipeline_keeps_order_and_overlaps_stages():
+    events = []
+    lock = threading.Lock()
+
+    def stage(name, delay):
+        def run(item):
+            with lock:
+                events.append((name, 'start', item))
+            time.sleep(delay)
+            with lock:
+                events.append((name, 'end', item))
+            return item
+        return run
+
+    pipeline = Pipeline([('build', stage('build', 0.02)), ('rollout', stage('rollout', 0.05))], lookahead=1)
+    assert pipeline.run([1, 2, 3]) == [1, 2, 3]
+
+    rollouts = [item for name, kind, item in events if name == 'rollout' and kind == 'start']
+    assert rollouts == [1, 2, 3]
+    # The build of item 2 starts before the rollout of item 1 ends
+    assert events.index(('build', 'start', 2)) < events.index(('rollout', 'end', 1))
+    # Rollouts never overlap
+    for item in (1, 2):
+        assert events.index(('rollout', 'end', item)) < events.index(('rollout', 'start', item + 1))
+
+
+def test_pipeline_lookahead_bounds_work_ahead():
+    started = []
+    release = threading.Event()
+
+    def build(item):
+        started.append(item)
+        return item
+
+    def rollout(item):
+        release.wait(1)
+        return item
+
+    pipeline = Pipeline([('build', build), ('rollout', rollout)], lookahead=1)
+    thread = threading.Thread(target=pipeline.run, args=(list(range(10)),))
+    thread.start()
+    time.sleep(0.2)
+    # One item in the rollout stage, one waiting in the queue, one blocked in the build stage
+    assert len(started) == 3
+    release.set()
+    thread.join(5)
+    assert len(started) == 10
+
+
+def test_pipeline_stops_on_request_and_on_error():
+    def rollout(item):
+        if item == 2:
+            pipeline.stop()
+        return item
+
+    pipeline = Pipeline([('build', lambda item: item), ('rollout', rollout)], lookahead=2)
+    assert pipeline.run([1, 2, 3, 4]) == [1, 2]
+    assert pipeline.stopped
+
+    rolled_out = threading.Event()
+
+    def build(item):
+        if item == 3:
+            # Fail once the items before have gone through, the output of the last stage is kept
+            assert rolled_out.wait(5)
+            raise RuntimeError('build failed')
+        return item
+
+    def rollout_and_signal(item):
+        if item == 2:
+            rolled_out.set()
+        return item
+
+    failing = Pipeline([('build', build), ('rollout', rollout_and_signal)])
+    assert failing.run([1, 2, 3, 4]) == [1, 2]
+    assert isinstance(failing.error, RuntimeError)
+
+
+def test_pipeline_reports_stage_stats():
+    def rollout(item):
+        time.sleep(0.02)
+        return item
+
+    pipeline = Pipeline([('build', lambda item: item), ('rollout', rollout)], lookahead=2)
+    pipeline.run(list(range(5)))
+    build, rollout_stats = pipeline.report()
+    assert build['name'] == 'build' and build['items'] == 5
+    assert rollout_stats['items'] == 5
+    assert rollout_stats['busy_sec'] >= 0.09
+    # The build stage runs ahead and waits on the rollout queue
+    assert build['blocked_sec'] > 0
+    assert rollout_stats['max_queue_depth'] >= 2
+    assert set(build) >= {'idle_sec', 'mean_queue_depth'}
@@ -0,0 +1,68 @@
+import json
+import random
+from runotabinary.run_history import RunHistory, RunRecorder, main, parse_time
+from runotabinary.stats import mann_whitney_u
+
+DAY = 24 * 3600
+
+
+def record_week(history, start, median, commit):
+    rng = random.Random(start)
+    run_id = history.start_run('canary', thing_name='device', repository_commit=commit, started_at=start)
+    for day in range(7):
+        history.add_samples(run_id, 'update', [median * rng.uniform(0.9, 1.1) for _ in range(10)],
+                            recorded_at=start + day * DAY)
+        history.add_samples(run_id, 'build', [30 * rng.uniform(0.9, 1.1) for _ in range(10)],
+                            recorded_at=start + day * DAY)
+    history.finish_run(run_id, 70, 0)
+
+
+def test_slower_week_is_flagged_as_a_regression(tmp_path):
+    now = 100 * DAY
+    with RunHistory(tmp_path / 'history.db') as history:
+        record_week(history, now - 14 * DAY, 100.0, 'aaaa1111')
+        record_week(history, now - 7 * DAY, 140.0, 'bbbb2222')
+
+        rows = {row['metric']: row for row in history.compare(
+            {'since': parse_time('14d', now), 'until': parse_time('7d', now)}, {'since': parse_time('7d', now)})}
+        assert rows['update']['regression'] and 30 < rows['update']['change_percent'] < 50
+        assert not rows['build']['regression']
+
+        # The same by commit, abbreviated
+        rows = history.compare({'commit': 'aaaa'}, {'commit': 'bbbb'}, ['update'])
+        assert rows[0]['regression'] and rows[0]['samples'] == 70
+
+        distribution = history.distribution('update', DAY, since=now - 7 * DAY)
+        assert len(distribution) == 7 and all(stats['samples'] == 10 for _, stats in distribution)
+
+
+def test_cli_exits_with_failure_on_regression(tmp_path, capsys):
+    path = tmp_path / 'history.db'
+    with RunHistory(path) as history:
+        record_week(history, 0, 100.0, 'aaaa')
+        record_week(history, 7 * DAY, 140.0, 'bbbb')
+    assert main(['--db', str(path), 'compare', '--baseline-commit', 'aaaa', '--commit', 'bbbb']) == 1
+    assert 'REGRESSION' in capsys.readouterr().out
+    assert main(['--db', str(path), 'compare', '--baseline-commit', 'aaaa', '--commit', 'aaaa']) == 0
+    capsys.readouterr()
+    assert main(['--db', str(path), '--json', 'report', '--metric', 'update', '--bucket', 'week']) == 0
+    assert len(json.loads(capsys.readouterr().out)['metrics']['update']) == 2
+
+
+def test_mann_whitney_u():
+    _, p_value = mann_whitney_u([1, 2, 3, 4, 5] * 4, [6, 7, 8, 9, 10] * 4)
+    assert p_value < 0.001
+    _, p_value = mann_whitney_u([6, 7, 8, 9, 10] * 4, [1, 2, 3, 4, 5] * 4)
+    assert p_value > 0.99
+    assert mann_whitney_u([], [1]) == (None, None)
+    assert mann_whitney_u([1, 1], [1, 1])[1] == 1.0
+
+
+def test_recorder_outlives_a_broken_database(tmp_path):
+    history = RunHistory(tmp_path / 'history.db')
+    recorder = RunRecorder(history, 'canary')
+    recorder.update(11, 'runota-1', 'SUCCEEDED', 1024)
+    history.close()
+    # Logged, not raised
+    recorder.sample('build', 1.0)
+    recorder.finish()
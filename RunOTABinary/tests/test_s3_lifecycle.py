@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+from runotabinary import aws_clients
+from runotabinary.create_update import AWSS3Bucket
+from runotabinary.fake_aws import FakeAwsBackend
+from runotabinary.s3_lifecycle import ArtifactLifecycle, RetentionPolicy
+
+
+@pytest.fixture
+def s3(tmp_path):
+    with FakeAwsBackend(tmp_path / 'cloud') as backend:
+        # Versions of a key span several pages of the listing
+        backend.s3.page_size = 4
+        client = aws_clients.get_client('s3')
+        client.create_bucket(Bucket='bucket')
+        for key in ('firmware/a', 'firmware/b', 'other/c'):
+            for index in range(5):
+                client.put_object(Bucket='bucket', Key=key, Body=b'x' * (index + 1))
+        yield backend.s3
+
+
+def remaining(s3, key):
+    return [version['Path'].read_bytes() for version in s3._buckets['bucket']['objects'].get(key, [])]
+
+
+def test_keep_last_versions_in_batches(s3):
+    report = ArtifactLifecycle('bucket', batch_size=3).apply(RetentionPolicy(keep_last=2, per_key=True), prefix='firmware/')
+    assert (report.scanned, report.expired, report.deleted, report.failed, report.requests) == (10, 6, 6, 0, 2)
+    assert report.expired_bytes == 2 * (1 + 2 + 3)
+    assert remaining(s3, 'firmware/a') == [b'xxxx', b'xxxxx']
+    assert len(remaining(s3, 'other/c')) == 5
+
+
+def test_dry_run_deletes_nothing(s3):
+    report = ArtifactLifecycle('bucket').apply(RetentionPolicy(keep_last=1, per_key=True), dry_run=True)
+    assert (report.expired, report.deleted, report.requests) == (12, 12, 0)
+    assert len(remaining(s3, 'firmware/a')) == 5
+
+
+def test_max_age_and_failed_deletes_are_reported(s3):
+    for version in s3._buckets['bucket']['objects']['firmware/b'][:3]:
+        version['LastModified'] = datetime.now(timezone.utc) - timedelta(days=10)
+    s3.denied_keys.add('firmware/b')
+    report = ArtifactLifecycle('bucket').apply(RetentionPolicy(max_age_sec=24 * 60 * 60), prefix='firmware/')
+    assert (report.expired, report.deleted, report.failed) == (3, 0, 3)
+    s3.denied_keys.clear()
+    assert ArtifactLifecycle('bucket').apply(RetentionPolicy(max_age_sec=24 * 60 * 60)).deleted == 3
+    assert remaining(s3, 'firmware/b') == [b'xxxx', b'xxxxx']
+
+
+def test_newest_builds_are_kept_across_content_addressed_keys(s3, tmp_path):
+    bucket = AWSS3Bucket('bucket', content_prefix='builds')
+    keys = []
+    for build in range(5):
+        image = tmp_path / f'image_{build}'
+        image.write_bytes(f'firmware {build}'.encode())
+        keys.append(bucket.upload_file(str(image), image.name)[0])
+    for days, key in zip(range(5, 0, -1), keys):
+        s3._buckets['bucket']['objects'][key][0]['LastModified'] = datetime.now(timezone.utc) - timedelta(days=days)
+
+    report = ArtifactLifecycle('bucket').apply(RetentionPolicy(keep_last=2), prefix='builds/')
+    assert (report.scanned, report.expired, report.deleted) == (5, 3, 3)
+    assert [bool(remaining(s3, key)) for key in keys] == [False, False, False, True, True]
+
+
+def test_bucket_cleanup_leaves_the_shared_objects(s3, tmp_path):
+    image = tmp_path / 'image'
+    image.write_bytes(b'firmware')
+    bucket = AWSS3Bucket('bucket')
+    key, version = bucket.upload_file(str(image), 'image_2')
+    # Another process finds the same content and rolls it out
+    assert AWSS3Bucket('bucket').upload_file(str(image), 'image_3') == (key, version)
+    bucket.cleanup()
+    assert remaining(s3, key) == [b'firmware'] and len(remaining(s3, 'firmware/a')) == 5
+    assert bucket.s3_versions == []
+
+
+def test_listing_resumes_after_a_deleted_marker(s3):
+    client = aws_clients.get_client('s3')
+    page = client.list_object_versions(Bucket='bucket', Prefix='firmware/', MaxKeys=4)
+    marker = page['Versions'][-1]
+    client.delete_object(Bucket='bucket', Key=marker['Key'], VersionId=marker['VersionId'])
+    rest = client.list_object_versions(Bucket='bucket', Prefix='firmware/', MaxKeys=4,
+                                       KeyMarker=page['NextKeyMarker'], VersionIdMarker=page['NextVersionIdMarker'])
+    assert [entry['Key'] for entry in rest['Versions']] == ['firmware/a', 'firmware/b', 'firmware/b', 'firmware/b']
+    assert rest['Versions'][0]['VersionId'] < marker['VersionId']
+
+    # Versions deleted while the listing streams do not cut it short
+    report = ArtifactLifecycle('bucket', batch_size=1).apply(RetentionPolicy(keep_last=1, per_key=True), prefix='firmware/')
+    assert (report.scanned, report.deleted) == (9, 7)
@@ -0,0 +1,20 @@
+from runotabinary.startup_benchmark import entry_points, measure_import, run
+
+# Generous bound, the guard against heavy imports below is the precise check
+AGENT_IMPORT_BUDGET_MS = 1000
+
+
+def test_entry_points_are_read_from_pyproject():
+    scripts = entry_points()
+    assert scripts['agent'] == 'runotabinary.run_binary'
+    assert scripts['canary'] == 'runotabinary.canary'
+
+
+def test_entry_points_do_not_import_heavy_dependencies():
+    report = run(repeat=1)
+    assert {entry['script']: entry['heavy_modules'] for entry in report} == {entry['script']: [] for entry in report}
+
+
+def test_agent_import_time_budget():
+    import_ms, heavy = measure_import('runotabinary.run_binary', repeat=3)
+    assert import_ms < AGENT_IMPORT_BUDGET_MS
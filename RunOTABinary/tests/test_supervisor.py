@@ -0,0 +1,95 @@
+import os
+import time
+import pytest
+from runotabinary.run_binary import RunBinary
+from runotabinary.supervisor import ImageWatcher, make_executable
+
+
+@pytest.mark.parametrize('use_inotify', [True, False])
+def test_image_lands_once_written(tmp_path, use_inotify):
+    (tmp_path / 'ota_demo_core_mqtt').write_text('initial')
+    with ImageWatcher(tmp_path, 'ota_demo_core_mqtt', use_inotify=use_inotify, settle_sec=0.05) as watcher:
+        assert watcher.mode == ('inotify' if use_inotify else 'poll')
+        for name in ('ota_demo_core_mqtt_2.part', 'ota_demo_core_mqtt_v2', 'ota_demo_core_mqtt.bak', 'logfile.txt'):
+            (tmp_path / name).write_text('not an image')
+        assert watcher.wait_for_image(timeout=0.2) is None
+
+        with open(tmp_path / 'ota_demo_core_mqtt_2', 'w') as image:
+            image.write('new image')
+        path, landed_at = watcher.wait_for_image('ota_demo_core_mqtt_2', timeout=2)
+        assert path == tmp_path / 'ota_demo_core_mqtt_2' and landed_at <= time.monotonic()
+        # An image is only returned once
+        assert watcher.wait_for_image(timeout=0.2) is None
+
+
+def test_image_closed_between_writes_lands_once_complete(tmp_path):
+    with ImageWatcher(tmp_path, 'ota_demo_core_mqtt', settle_sec=0.3) as watcher:
+        assert watcher.mode == 'inotify'
+        image = tmp_path / 'ota_demo_core_mqtt_2'
+        image.write_bytes(b'first block')
+        time.sleep(0.1)
+        with open(image, 'ab') as stream:
+            stream.write(b', last block')
+        path, landed_at = watcher.wait_for_image('ota_demo_core_mqtt_2', timeout=2)
+        assert path.read_bytes() == b'first block, last block'
+        # Landed as of the last write, not when the size was seen settled
+        assert time.monotonic() - landed_at >= 0.3
+
+
+def test_expected_image_is_preferred_and_others_accepted(tmp_path):
+    with ImageWatcher(tmp_path, 'ota_demo_core_mqtt') as watcher:
+        for name in ('ota_demo_core_mqtt_3', 'ota_demo_core_mqtt_2'):
+            (tmp_path / f'.{name}.part').write_text(name)
+            (tmp_path / f'.{name}.part').replace(tmp_path / name)
+        assert watcher.wait_for_image('ota_demo_core_mqtt_3', timeout=2)[0].name == 'ota_demo_core_mqtt_3'
+        assert watcher.wait_for_image('ota_demo_core_mqtt_4', timeout=2)[0].name == 'ota_demo_core_mqtt_2'
+
+
+def test_make_executable_sets_permissions_in_process(tmp_path):
+    image = tmp_path / 'ota_demo_core_mqtt_2'
+    image.write_text('image')
+    image.chmod(0o644)
+    make_executable(image)
+    assert os.access(image, os.X_OK)
+
+
+def test_device_restarts_on_the_image_it_downloaded(tmp_path):
+    (tmp_path / 'next').write_text('#!/bin/sh\necho "running version 7"\n')
+    device = tmp_path / 'device'
+    device.mkdir()
+    initial = device / 'ota_demo_core_mqtt'
+    # The downloaded image is not the expected <binary>_2 and is not executable
+    initial.write_text('#!/bin/sh\ncp ../next ./ota_demo_core_mqtt_7\nchmod 644 ./ota_demo_core_mqtt_7\n')
+    initial.chmod(0o755)
+
+    task = RunBinary(str(initial), str(tmp_path / 'logfile.txt'), restart_timeout=5)
+    task.start()
+    deadline = time.monotonic() + 5
+    while not task.restarts and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.2)
+    task.close()
+    task.join(5)
+
+    assert not task.is_alive()
+    assert task.restarts[0]['image'] == str(device / 'ota_demo_core_mqtt_7')
+    assert 0 <= task.restarts[0]['exit_to_start_sec'] <= task.restarts[0]['landed_to_start_sec']
+    assert 'running version 7' in (tmp_path / 'logfile.txt').read_text()
+
+
+def test_device_restarts_on_its_image_when_none_lands(tmp_path):
+    initial = tmp_path / 'ota_demo_core_mqtt'
+    initial.write_text('#!/bin/sh\necho "booted"\n')
+    initial.chmod(0o755)
+
+    task = RunBinary(str(initial), str(tmp_path / 'logfile.txt'), restart_timeout=0.1)
+    task.start()
+    deadline = time.monotonic() + 5
+    while len(task.restarts) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    task.close()
+    task.join(5)
+
+    assert not task.is_alive()
+    assert [restart['image'] for restart in task.restarts[:2]] == [str(initial)] * 2
+    assert (tmp_path / 'logfile.txt').read_text().count('booted') >= 2
@@ -0,0 +1,119 @@
+import io
+import time
+import botocore.exceptions
+import pytest
+from runotabinary import aws_clients, throttle
+
+
+@pytest.fixture(autouse=True)
+def fast_retries():
+    throttle.reset()
+    throttle.configure(base_delay_sec=0.001, max_attempts=4, rates={'iot.create_ota_update': 1000})
+    yield
+    throttle.reset()
+    aws_clients.reset()
+
+
+def client_error(code, status=400):
+    return botocore.exceptions.ClientError(
+        {'Error': {'Code': code, 'Message': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}, 'CreateOTAUpdate')
+
+
+class FlakyIot:
+    def __init__(self, errors):
+        self.errors = list(errors)
+
+    def create_ota_update(self, otaUpdateId):
+        if self.errors:
+            raise self.errors.pop(0)
+        return {'otaUpdateId': otaUpdateId}
+
+
+def test_throttles_and_transient_errors_are_retried_through_the_registry():
+    aws_clients.register_client('iot', FlakyIot([client_error('ThrottlingException'), client_error('InternalFailure', 500)]))
+    assert aws_clients.get_client('iot').create_ota_update(otaUpdateId='id') == {'otaUpdateId': 'id'}
+    counters = throttle.counters()['iot.create_ota_update']
+    assert (counters['calls'], counters['attempts'], counters['throttles'], counters['transient_errors'],
+            counters['errors']) == (1, 3, 1, 1, 0)
+    # The rate of the API was halved by the throttle and is recovering
+    assert 500 <= throttle._bucket('iot.create_ota_update').rate < 1000
+
+
+def test_other_errors_and_exhausted_retries_are_raised():
+    client = throttle.throttled_client('iot', FlakyIot([client_error('ResourceNotFoundException')]))
+    with pytest.raises(botocore.exceptions.ClientError):
+        client.create_ota_update(otaUpdateId='id')
+    client = throttle.throttled_client('iot', FlakyIot([client_error('SlowDown', 503)] * 4))
+    with pytest.raises(botocore.exceptions.ClientError):
+        client.create_ota_update(otaUpdateId='id')
+    counters = throttle.counters()['iot.create_ota_update']
+    assert (counters['calls'], counters['attempts'], counters['errors']) == (2, 5, 2)
+
+
+
+class FlakyS3:
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.bodies = []
+
+    def put_object(self, Bucket, Key, Body):
+        self.bodies.append(Body.read())
+        if self.errors:
+            raise self.errors.pop(0)
+        return {'VersionId': '1'}
+
+
+class Pipe(io.RawIOBase):
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        return 0
+
+
+def test_streaming_bodies_are_rewound_or_not_retried():
+    s3 = FlakyS3([client_error('SlowDown', 503)])
+    body = io.BytesIO(b'header firmware')
+    body.seek(len(b'header '))
+    throttle.throttled_client('s3', s3).put_object(Bucket='bucket', Key='key', Body=body)
+    assert s3.bodies == [b'firmware', b'firmware']
+
+    s3 = FlakyS3([client_error('SlowDown', 503)])
+    with pytest.raises(botocore.exceptions.ClientError):
+        throttle.throttled_client('s3', s3).put_object(Bucket='bucket', Key='key', Body=Pipe())
+    assert throttle.counters()['s3.put_object']['attempts'] == 3
+
+def test_classify_connection_errors_by_name():
+    assert throttle.classify(botocore.exceptions.EndpointConnectionError(endpoint_url='https://iot')) == 'transient'
+    assert throttle.classify(ValueError('bad')) is None
+
+
+def test_token_bucket_spaces_calls():
+    bucket = throttle.TokenBucket(rate=50, burst=2)
+    start = time.monotonic()
+    for _ in range(7):
+        bucket.acquire()
+    # Two calls of burst, then one every 20ms
+    assert time.monotonic() - start >= 0.09
+    bucket.throttled()
+    assert bucket.rate == 25
+    for _ in range(30):
+        bucket.succeeded()
+    assert bucket.rate == 50
+
+
+def test_paginator_pages_are_throttled_and_retried():
+    import boto3
+    from botocore.stub import Stubber
+    client = boto3.session.Session(region_name='us-east-1', aws_access_key_id='key',
+                                   aws_secret_access_key='secret').client('iot')
+    stubber = Stubber(client)
+    stubber.add_response('list_ota_updates', {'otaUpdates': [{'otaUpdateId': 'a'}], 'nextToken': 'next'})
+    stubber.add_client_error('list_ota_updates', 'ThrottlingException', http_status_code=429)
+    stubber.add_response('list_ota_updates', {'otaUpdates': [{'otaUpdateId': 'b'}]})
+    aws_clients.register_client('iot', client)
+    with stubber:
+        pages = aws_clients.get_client('iot').get_paginator('list_ota_updates').paginate()
+        assert [update['otaUpdateId'] for update in pages.search('otaUpdates')] == ['a', 'b']
+    counters = throttle.counters()['iot.list_ota_updates']
+    assert (counters['calls'], counters['attempts'], counters['throttles'], counters['errors']) == (2, 3, 1, 0)
@@ -0,0 +1,115 @@
+import json
+import time
+import threading
+import pytest
+from runotabinary import aws_clients, tracing
+from runotabinary.ota_log_parser import OtaLogParser
+
+
+@pytest.fixture
+def spans():
+    tracing.reset()
+    exporter = tracing.add_exporter(tracing.MemoryExporter())
+    yield exporter.spans
+    tracing.reset()
+
+
+def test_spans_nest_and_carry_attributes(spans):
+    with tracing.span('update.create', thing='thing1') as parent:
+        with tracing.span('aws.iot.create_ota_update') as child:
+            child.set(ota_update_id='id1')
+    with pytest.raises(ValueError):
+        with tracing.span('build'):
+            raise ValueError('boom')
+
+    child, parent, failed = spans
+    assert child.parent_id == parent.span_id and parent.parent_id is None
+    assert child.attributes == {'ota_update_id': 'id1'} and parent.attributes == {'thing': 'thing1'}
+    assert parent.start_ns <= child.start_ns <= child.end_ns <= parent.end_ns
+    assert failed.error == 'ValueError: boom'
+
+
+def test_spans_are_noop_without_exporter():
+    tracing.reset()
+    with tracing.span('build') as noop:
+        noop.set(version='0.9.1')
+    assert noop.span_id is None and not tracing.enabled()
+
+
+def test_explicit_parent_links_spans_across_threads(spans):
+    with tracing.span('canary') as root:
+        thread = threading.Thread(target=lambda: tracing.span('canary.rollout', parent=root).__enter__().end())
+        thread.start()
+        thread.join()
+    assert spans[0].name == 'canary.rollout' and spans[0].parent_id == root.span_id
+
+
+def test_aws_calls_are_traced_through_the_registry(spans):
+    class StubIot:
+        def describe_job_execution(self, jobId, thingName):
+            return {'execution': {'status': 'QUEUED'}}
+
+    aws_clients.reset()
+    aws_clients.register_client('iot', StubIot())
+    try:
+        aws_clients.get_client('iot').describe_job_execution(jobId='AFR_OTA-1', thingName='thing1')
+    finally:
+        aws_clients.reset()
+    assert spans[0].name == 'aws.iot.describe_job_execution'
+    assert spans[0].attributes == {'job_id': 'AFR_OTA-1', 'thing': 'thing1'}
+
+
+
+def test_resource_calls_are_traced_through_the_registry(spans):
+    import boto3
+    from botocore.stub import Stubber
+    client = boto3.session.Session(region_name='us-east-1', aws_access_key_id='key',
+                                   aws_secret_access_key='secret').client('s3')
+    stubber = Stubber(client)
+    stubber.add_response('head_object', {'ContentLength': 4}, {'Bucket': 'bucket', 'Key': 'firmware/abc'})
+
+    aws_clients.reset()
+    aws_clients.configure(region_name='us-east-1')
+    aws_clients.register_client('s3', client)
+    try:
+        with stubber:
+            assert aws_clients.get_resource('s3').Bucket('bucket').Object('firmware/abc').content_length == 4
+    finally:
+        aws_clients.reset()
+    assert [span.name for span in spans] == ['aws.s3.head_object']
+    assert spans[0].attributes['key'] == 'firmware/abc'
+
+def test_device_phases_are_recorded_from_the_log(spans):
+    parser = OtaLogParser(trace_attributes={'thing': 'thing1'})
+    start = time.monotonic()
+    parser.mark_update_created(start)
+    for offset, line in enumerate(['Received OTA job document', 'Received entire update', 'Attempting to activate',
+                                   'In self test mode', 'Image version is valid'], 1):
+        parser.feed(line, start + offset)
+    assert [(span.name, span.duration_ms) for span in spans] == [
+        ('device.job_document', 1000.0), ('device.download', 1000.0), ('device.activate', 1000.0),
+        ('device.reboot', 1000.0), ('device.self_test', 1000.0)]
+    assert spans[0].attributes == {'thing': 'thing1'}
+
+
+def test_exporters_write_jsonl_and_chrome_trace(tmp_path):
+    tracing.reset()
+    tracing.configure(jsonl_path=tmp_path / 'spans.jsonl', chrome_path=tmp_path / 'trace.json')
+    try:
+        with tracing.span('upload', key='firmware/abc'):
+            with tracing.span('aws.s3.put_object'):
+                pass
+        tracing.flush()
+    finally:
+        tracing.reset()
+
+    lines = [json.loads(line) for line in (tmp_path / 'spans.jsonl').read_text().splitlines()]
+    assert [line['name'] for line in lines] == ['aws.s3.put_object', 'upload']
+    assert lines[0]['parent_id'] == lines[1]['span_id'] and lines[1]['attributes'] == {'key': 'firmware/abc'}
+
+    events = json.loads((tmp_path / 'trace.json').read_text())['traceEvents']
+    complete = {event['name']: event for event in events if event['ph'] == 'X'}
+    assert set(complete) == {'upload', 'aws.s3.put_object'}
+    assert complete['upload']['cat'] == 'upload' and complete['upload']['args']['key'] == 'firmware/abc'
+    assert complete['upload']['ts'] <= complete['aws.s3.put_object']['ts']
+    assert any(event['name'] == 'thread_name' for event in events)
@@ -0,0 +1,126 @@
+import time
+import threading
+from runotabinary import tracker as tracker_module
+from runotabinary.tracker import OtaUpdateTracker
+
+
+class FakeIotClient:
+    """Every job goes QUEUED -> IN_PROGRESS -> SUCCEEDED after a fixed number of polls"""
+
+    def __init__(self, polls_per_status=2, final_status='SUCCEEDED'):
+        self.polls_per_status = polls_per_status
+        self.final_status = final_status
+        self.polls = {}
+        # ('created', update) on the first poll of an update, ('finished', job) when its job is first reported done
+        self.events = []
+        self.lock = threading.Lock()
+
+    def _count(self, key):
+        with self.lock:
+            self.polls[key] = self.polls.get(key, 0) + 1
+            return self.polls[key]
+
+    def get_ota_update(self, otaUpdateId):
+        count = self._count(otaUpdateId)
+        if count == 1:
+            self.events.append(('created', otaUpdateId))
+        info = {'otaUpdateId': otaUpdateId, 'otaUpdateStatus': 'CREATE_PENDING'}
+        if count > self.polls_per_status:
+            info.update(otaUpdateStatus='CREATE_COMPLETE', awsIotJobId=f'AFR_OTA-{otaUpdateId}')
+        return {'otaUpdateInfo': info}
+
+    def describe_job_execution(self, jobId, thingName):
+        count = self._count(jobId)
+        statuses = ['QUEUED', 'IN_PROGRESS', self.final_status]
+        status = statuses[min((count - 1) // self.polls_per_status, 2)]
+        if count == 2 * self.polls_per_status + 1:
+            self.events.append(('finished', jobId))
+        return {'execution': {'status': status, 'statusDetails': {'detailsMap': {'reason': 'done'}}}}
+
+
+def fast_tracker(client):
+    return OtaUpdateTracker(client, initial_interval=0.01, queued_interval=0.02, max_interval=0.05)
+
+
+def test_tracker_follows_many_updates_at_once():
+    client = FakeIotClient()
+    done = []
+    with fast_tracker(client) as tracker:
+        futures = [tracker.track_job(f'update{i}', 'thing', timeout=10, callback=done.append) for i in range(20)]
+        results = [future.result(timeout=5) for future in futures]
+
+    assert [r.status.status for r in results] == ['SUCCEEDED'] * 20
+    assert results[3].job_id == 'AFR_OTA-update3'
+    assert len(done) == 20
+    # Every update was followed before the first job finished, serial loops would alternate
+    kinds = [kind for kind, _ in client.events]
+    assert kinds == ['created'] * 20 + ['finished'] * 20
+
+
+def test_tracker_creation_and_timeout():
+    client = FakeIotClient(final_status='IN_PROGRESS')
+    with fast_tracker(client) as tracker:
+        info = tracker.track_creation('update', timeout=5).result(timeout=5)
+        assert info['otaUpdateStatus'] == 'CREATE_COMPLETE'
+
+        result = tracker.track_job('stuck', 'thing', timeout=0.3).result(timeout=5)
+        assert result.status.status == 'IN_PROGRESS'
+        assert result.summary == 'Timeout on OTA Update\'s job.'
+
+
+def test_timeout_is_not_pushed_back_by_a_long_interval():
+    client = FakeIotClient(final_status='IN_PROGRESS')
+    with OtaUpdateTracker(client, initial_interval=60, job_interval=60) as tracker:
+        # Without the cap, the first poll after the deadline would be a minute away
+        result = tracker.track_job('stuck', 'thing', timeout=0.2).result(timeout=30)
+    assert result.summary == 'Timeout on OTA Update\'s job.'
+    assert client.polls == {'stuck': 2}
+
+
+class FlakyIotClient(FakeIotClient):
+    """Fails every other call, as a client out of retries would"""
+
+    def __init__(self):
+        super().__init__(polls_per_status=1)
+        self.calls = 0
+
+    def _count(self, key):
+        self.calls += 1
+        if self.calls % 2:
+            raise ConnectionError('Connection reset by peer')
+        return super()._count(key)
+
+
+def test_tracker_retries_failed_polls():
+    client = FlakyIotClient()
+    with fast_tracker(client) as tracker:
+        result = tracker.track_job('update', 'thing', timeout=10).result(timeout=5)
+    assert result.status.status == 'SUCCEEDED'
+    assert client.calls > 4
+
+
+def test_job_interval_only_slows_down_job_polls():
+    client = FakeIotClient(final_status='IN_PROGRESS')
+    with OtaUpdateTracker(client, initial_interval=0.01, max_interval=0.05, job_interval=30) as tracker:
+        info = tracker.track_creation('update', timeout=5).result(timeout=5)
+        assert info['otaUpdateStatus'] == 'CREATE_COMPLETE'
+
+        future = tracker.track_job('pushed', 'thing', timeout=60)
+        deadline = time.monotonic() + 5
+        while client.polls.get('AFR_OTA-pushed', 0) < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.2)
+        assert client.polls['AFR_OTA-pushed'] == 1
+        tracker.notify_job_status('thing', 'AFR_OTA-pushed', 'SUCCEEDED', 'accepted')
+        assert future.result(timeout=5).status.status == 'SUCCEEDED'
+
+
+def test_job_statuses_kept_for_later_updates_are_bounded(monkeypatch):
+    monkeypatch.setattr(tracker_module, 'MAX_JOB_EVENTS', 3)
+    with fast_tracker(FakeIotClient(final_status='IN_PROGRESS')) as tracker:
+        for index in range(5):
+            tracker.notify_job_status('thing', f'AFR_OTA-update{index}', 'SUCCEEDED')
+        tracker.notify_job_status('other', 'AFR_OTA-update4', 'FAILED')
+        assert list(tracker._job_events) == [('thing', 'AFR_OTA-update3'), ('thing', 'AFR_OTA-update4'),
+                                             ('other', 'AFR_OTA-update4')]
+        assert tracker.track_job('update4', 'thing', timeout=5).result(timeout=5).status.status == 'SUCCEEDED'
@@ -0,0 +1,62 @@
+import shutil
+import subprocess
+import pytest
+from runotabinary.version_stamp import PLACEHOLDER_VERSION, VersionStamper, encode_version, read_version
+
+# Laid out like the demos: the version is an AppVersion32_t constant read by another function
+DEMO_SOURCE = """#include <stdint.h>
+#include <stdio.h>
+typedef union { struct { uint16_t build; uint8_t minor; uint8_t major; } x; uint32_t unsignedVersion32; } AppVersion32_t;
+const AppVersion32_t appFirmwareVersion = { .x = { APP_VERSION_BUILD, APP_VERSION_MINOR, APP_VERSION_MAJOR } };
+int main(void)
+{
+    const volatile AppVersion32_t * version = &appFirmwareVersion;
+    printf("%u.%u.%u\\n", version->x.major, version->x.minor, version->x.build);
+    return 0;
+}
+"""
+
+needs_compiler = pytest.mark.skipif(shutil.which('cc') is None, reason='a C compiler is required to build the template')
+
+
+def build_template(tmp_path, *flags):
+    source = tmp_path / 'demo.c'
+    source.write_text(DEMO_SOURCE)
+    template = tmp_path / 'ota_demo_core_mqtt'
+    major, minor, build = PLACEHOLDER_VERSION
+    subprocess.run(['cc', '-O2', f'-DAPP_VERSION_MAJOR={major}', f'-DAPP_VERSION_MINOR={minor}',
+                    f'-DAPP_VERSION_BUILD={build}', *flags, '-o', str(template), str(source)], check=True)
+    return template
+
+
+def run_image(path):
+    return subprocess.run([str(path)], stdout=subprocess.PIPE, encoding='utf-8', check=True).stdout.strip()
+
+
+def test_encode_version_matches_app_version32():
+    assert encode_version(1, 2, 3) == bytes([3, 0, 2, 1])
+    assert encode_version(1, 2, 3, little_endian=False) == bytes([1, 2, 0, 3])
+    with pytest.raises(ValueError):
+        encode_version(256, 0, 0)
+
+
+@needs_compiler
+@pytest.mark.parametrize('flags', [(), ('-s',)], ids=['symbols', 'stripped'])
+def test_stamped_images_run_with_their_version(tmp_path, flags):
+    stamper = VersionStamper(build_template(tmp_path, *flags))
+    assert stamper.has_symbol == (not flags)
+
+    for build in range(1, 11):
+        image = stamper.stamp((0, 9, build), tmp_path / f'0.9.{build}' / 'ota_demo_core_mqtt')
+        assert run_image(image) == f'0.9.{build}'
+    assert run_image(stamper.template) == '.'.join(map(str, PLACEHOLDER_VERSION))
+    if not flags:
+        assert read_version(tmp_path / '0.9.10' / 'ota_demo_core_mqtt') == (0, 9, 10)
+
+
+@needs_compiler
+def test_template_without_the_placeholder_is_refused(tmp_path):
+    template = build_template(tmp_path)
+    VersionStamper(template).stamp((1, 0, 0), template)
+    with pytest.raises(ValueError):
+        VersionStamper(template)